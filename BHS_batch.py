@@ -0,0 +1,431 @@
+#-----------------------------------------------------
+# BHS_batch.py
+#
+# Created on:   18-10-2026
+#
+# Description: Register a whole cohort of 03MO/12MO XCT image pairs in parallel.
+#              Image pairs are found in a directory (by file name) or read from a
+#              CSV manifest. Each pair is registered with BHS_reg() on a process pool.
+#              A status file is kept for every pair so that an interrupted or crashed
+#              run picks up where it left off instead of starting over.
+#              With --stacks, the stacks of one joint (e.g. PRX, MID and DST) are registered
+#              as a group: the middle stack is registered first and its transform is the
+#              initial transform of the other stacks, which are then registered in parallel.
+#
+#-----------------------------------------------------
+# Usage: python BHS_batch.py arg1 arg2 [-n workers] [-t threads] [--profile name] [--mask] [--mask-dilation N]
+#                                    [--crop] [--crop-margin mm] [--float32] [--remodelling] [--cache dir]
+#                                    [--interpolator name] [--seg-interpolator name] [--force] [--stacks] [--stitch]
+#                                    [--multi-start N] [--multi-start-angle deg] [--multi-start-workers N]
+#
+# Where:  arg1 = A directory of MHA images or a CSV manifest
+#         arg2 = The output directory for registered images, transforms, logs and status files
+#
+# Outputs: With --remodelling, the formation/resorption statistics of all pairs are written to
+#          <arg2>/remodelling_stats.csv (see BHS_remodellingStats.py).
+#          With --stitch, the stacks of each joint are stitched into one image (see BHS_stitch.py):
+#          <joint>_03MO.mha, <joint>_03MO_SEG.mha, <joint>_12MO_TO_03MO.mha and <joint>_12MO_TO_03MO_SEG.mha,
+#          where <joint> is BHS_<subject>_<joint>. With --remodelling, formation/resorption is also
+#          calculated for the stitched images (<joint>_12MO_TO_03MO_FORMATION.mha, ...).
+#
+# Notes: Directory images must be named BHS_<subject>_<visit>_<joint>[_<stack>][_SEG].mha,
+#        e.g. BHS_030_03MO_MCP2_MID.mha and BHS_030_03MO_MCP2_MID_SEG.mha.
+#        A CSV manifest must have the columns input_03MO_gray, input_12MO_gray,
+#        input_03MO_seg and input_12MO_seg. A pair_id column is optional.
+#        Pairs whose status file says 'done' are skipped unless --force is given.
+#        With --cache, --force only repeats the optimization of pairs whose images or settings
+#        changed. The other pairs use their cached transform (see BHS_cache.py).
+#        The multi-start registrations of a pair (--multi-start) share its -t threads: by default they run
+#        in up to -t processes with one thread each, and in the worker process itself with -t 1.
+#        If the middle stack of a joint fails, its other stacks are registered from the image centres.
+#        If a worker process dies (e.g. it is killed for running out of memory), a new process pool is
+#        started and the other pairs carry on. The pairs that were running are retried one at a time,
+#        and a pair that kills its worker again is marked failed.
+#-----------------------------------------------------
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import SimpleITK as sitk
+
+import BHS_stitch
+import BHS_resample
+import BHS_remodelling
+import BHS_remodellingStats
+from BHS_reg import BHS_reg, REGISTRATION_PROFILES
+from util.util.imageNames import parseImageName, getPairID
+
+IMAGE_EXTENSIONS = ('.mha', '.nii', '.nii.gz')
+MANIFEST_COLUMNS = ('input_03MO_gray', 'input_12MO_gray', 'input_03MO_seg', 'input_12MO_seg')
+
+# Stacks of one joint, proximal to distal. The middle stack is registered first (--stacks).
+STACK_ORDER = ('PRX', 'MID', 'DST')
+REFERENCE_STACK = 'MID'
+
+# A job is marked failed after its worker process pool broke this many times (see BHS_batch)
+MAX_BREAKS = 3
+
+
+def getJointStack(pair):
+    # The joint (BHS_<subject>_<joint>) and stack of a pair, from the 03MO grayscale image name
+    info = parseImageName(pair['input_03MO_gray'])
+    if info is None :
+        return pair['pair_id'], ''
+    return 'BHS_' + info['subject'] + '_' + info['joint'], info['stack']
+
+
+def groupStacks(pairs):
+    # Joint -> pairs of that joint, proximal to distal (stacks not in STACK_ORDER go last)
+    joints = {}
+    for pair in pairs :
+        joints.setdefault(getJointStack(pair)[0], []).append(pair)
+
+    def stackOrder(pair) :
+        stack = getJointStack(pair)[1]
+        return (STACK_ORDER.index(stack) if stack in STACK_ORDER else len(STACK_ORDER), stack)
+
+    for jointPairs in joints.values() :
+        jointPairs.sort(key=stackOrder)
+    return joints
+
+
+def getReferencePairs(pairs):
+    # Joint -> the middle stack pair, for joints that have a middle stack and at least one other stack
+    references = {}
+    for jointID, jointPairs in groupStacks(pairs).items() :
+        for pair in jointPairs :
+            if len(jointPairs) > 1 and getJointStack(pair)[1] == REFERENCE_STACK :
+                references[jointID] = pair
+    return references
+
+
+def findPairs(inputDirectory, baseline=3, followup=12):
+    # Group images by subject/joint/stack and keep groups with all four images
+    groups = {}
+    for filename in sorted(os.listdir(inputDirectory)) :
+        info = parseImageName(filename, IMAGE_EXTENSIONS)
+        if info is None or info['visit'] not in (baseline, followup) :
+            continue
+
+        key = ( 'input_03MO' if info['visit'] == baseline else 'input_12MO' ) + ( '_seg' if info['seg'] else '_gray' )
+        groups.setdefault(getPairID(info), {})[key] = os.path.join(inputDirectory, filename)
+
+    pairs = []
+    for pairID, images in groups.items() :
+        missing = [column for column in MANIFEST_COLUMNS if column not in images]
+        if missing :
+            print('Warning: Skipping {} (missing {})'.format(pairID, ', '.join(missing)))
+            continue
+
+        images['pair_id'] = pairID
+        pairs.append(images)
+
+    return pairs
+
+
+def readManifest(manifestPath):
+    pairs = []
+    with open(manifestPath, newline='') as f :
+        reader = csv.DictReader(f)
+        missing = [column for column in MANIFEST_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing :
+            print()
+            print('Error: The manifest is missing the column(s): ' + ', '.join(missing))
+            sys.exit(1)
+
+        for row in reader :
+            if not row.get('pair_id') :
+                info = parseImageName(row['input_03MO_gray'])
+                row['pair_id'] = getPairID(info) if info else os.path.splitext(os.path.basename(row['input_03MO_gray']))[0]
+            pairs.append(row)
+
+    return pairs
+
+
+def getOutputPaths(pair, outDirectory):
+    return {
+        'output_12MO_to_03MO_reg': os.path.join(outDirectory, pair['pair_id'] + '_12MO_TO_03MO.mha'),
+        'output_12MO_to_03MO_seg_reg': os.path.join(outDirectory, pair['pair_id'] + '_12MO_TO_03MO_SEG.mha'),
+        'tmat': os.path.join(outDirectory, pair['pair_id'] + '_REG.tfm'),
+        'log': os.path.join(outDirectory, 'logs', pair['pair_id'] + '.log'),
+        'status': os.path.join(outDirectory, 'status', pair['pair_id'] + '.json')
+    }
+
+
+def getStitchPaths(jointID, outDirectory):
+    return {
+        'input_03MO_gray': os.path.join(outDirectory, jointID + '_03MO.mha'),
+        'input_03MO_seg': os.path.join(outDirectory, jointID + '_03MO_SEG.mha'),
+        'output_12MO_to_03MO_reg': os.path.join(outDirectory, jointID + '_12MO_TO_03MO.mha'),
+        'output_12MO_to_03MO_seg_reg': os.path.join(outDirectory, jointID + '_12MO_TO_03MO_SEG.mha'),
+        'log': os.path.join(outDirectory, 'logs', jointID + '_STITCH.log'),
+        'status': os.path.join(outDirectory, 'status', jointID + '_STITCH.json')
+    }
+
+
+def readStatus(statusPath):
+    try :
+        with open(statusPath) as f :
+            return json.load(f)
+    except (OSError, ValueError) :
+        return {}
+
+
+def writeStatus(statusPath, status):
+    # Write to a temporary file first so that a crash never leaves a half written status file
+    tmpPath = statusPath + '.tmp'
+    with open(tmpPath, 'w') as f :
+        json.dump(status, f, indent=2)
+    os.replace(tmpPath, statusPath)
+
+
+def hasStarted(statusPath, submitted):
+    # True if the job wrote its status file after it was submitted (at the time submitted)
+    return readStatus(statusPath).get('started', 0) >= submitted
+
+
+def getWorkerDiedStatus(statusPath, jobID):
+    # Mark a job whose worker process died as failed (the job could not write its own status)
+    status = readStatus(statusPath)
+    status.update({'pair_id': jobID, 'status': 'failed', 'finished': time.time(),
+                   'error': 'The worker process died (e.g. out of memory or a crash)'})
+    writeStatus(statusPath, status)
+    return status
+
+
+def isDone(pair, outDirectory):
+    outputs = getOutputPaths(pair, outDirectory)
+    if readStatus(outputs['status']).get('status') != 'done' :
+        return False
+
+    return all( os.path.isfile(outputs[key]) for key in ('output_12MO_to_03MO_reg', 'output_12MO_to_03MO_seg_reg', 'tmat') )
+
+
+def initWorker(numberOfThreads):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+
+
+def registerPair(pair, outDirectory, profileName='powell', useMask=False, maskDilation=0,
+                 crop=False, cropMargin=2.0, float32=False, remodellingParameters=None, cacheDirectory=None,
+                 grayInterpolator='linear', segInterpolator='nearest', initialTransformPath=None, multiStart=0, multiStartAngle=20.0,
+                 multiStartWorkers=None):
+    outputs = getOutputPaths(pair, outDirectory)
+    status = {'pair_id': pair['pair_id'], 'status': 'running', 'pid': os.getpid(), 'started': time.time(),
+              'initial_transform': initialTransformPath}
+    writeStatus(outputs['status'], status)
+
+    try :
+        with open(outputs['log'], 'w') as log, contextlib.redirect_stdout(log) :
+            BHS_reg(pair['input_03MO_gray'], pair['input_12MO_gray'], outputs['output_12MO_to_03MO_reg'],
+                    pair['input_03MO_seg'], pair['input_12MO_seg'], outputs['output_12MO_to_03MO_seg_reg'],
+                    outputs['tmat'], profileName, useMask, maskDilation, crop, cropMargin, float32,
+                    remodellingParameters, cacheDirectory, grayInterpolator, segInterpolator,
+                    initialTransform=initialTransformPath, multiStart=multiStart, multiStartAngle=multiStartAngle,
+                    multiStartWorkers=multiStartWorkers)
+    except Exception as e :
+        status.update({'status': 'failed', 'finished': time.time(), 'error': repr(e)})
+    else :
+        status.update({'status': 'done', 'finished': time.time()})
+
+    writeStatus(outputs['status'], status)
+    return status
+
+
+def stitchJoint(jointID, jointPairs, outDirectory, remodellingParameters=None):
+    # Stitch the 03MO and registered 12MO images of all stacks of one joint
+    # The middle stack goes first so that the stitched images have its grid
+    jointPairs = sorted(jointPairs, key=lambda pair: getJointStack(pair)[1] != REFERENCE_STACK)
+    stitchPaths = getStitchPaths(jointID, outDirectory)
+    status = {'pair_id': jointID + '_STITCH', 'status': 'running', 'pid': os.getpid(), 'started': time.time()}
+    writeStatus(stitchPaths['status'], status)
+
+    try :
+        with open(stitchPaths['log'], 'w') as log, contextlib.redirect_stdout(log) :
+            stitchInputs = {
+                'input_03MO_gray': [pair['input_03MO_gray'] for pair in jointPairs],
+                'input_03MO_seg': [pair['input_03MO_seg'] for pair in jointPairs],
+                'output_12MO_to_03MO_reg': [getOutputPaths(pair, outDirectory)['output_12MO_to_03MO_reg'] for pair in jointPairs],
+                'output_12MO_to_03MO_seg_reg': [getOutputPaths(pair, outDirectory)['output_12MO_to_03MO_seg_reg'] for pair in jointPairs]
+            }
+            # Only the field of view of the 12MO image is averaged in a registered stack (the rest is padding)
+            movingImagePaths = {'output_12MO_to_03MO_reg': [pair['input_12MO_gray'] for pair in jointPairs]}
+            transformPaths = [getOutputPaths(pair, outDirectory)['tmat'] for pair in jointPairs]
+            stitched = { key: BHS_stitch.BHS_stitch(stitchPaths[key], imagePaths, '_seg' in key, movingImagePaths.get(key), transformPaths)
+                         for key, imagePaths in stitchInputs.items() }
+
+            # Formation and resorption of the whole joint
+            if remodellingParameters is not None :
+                print('Calculating formation and resorption')
+                results = BHS_remodelling.remodelling(stitched['input_03MO_gray'], stitched['output_12MO_to_03MO_reg'],
+                                                      stitched['input_03MO_seg'], stitched['output_12MO_to_03MO_seg_reg'],
+                                                      remodellingParameters)
+                BHS_remodelling.writeRemodelling(results, os.path.splitext(stitchPaths['output_12MO_to_03MO_reg'])[0])
+    except Exception as e :
+        status.update({'status': 'failed', 'finished': time.time(), 'error': repr(e)})
+    else :
+        status.update({'status': 'done', 'finished': time.time()})
+
+    writeStatus(stitchPaths['status'], status)
+    return status
+
+
+def BHS_batch(inputPath, outDirectory, numberOfWorkers=None, numberOfThreads=1, force=False, profileName='powell',
+              useMask=False, maskDilation=0, crop=False, cropMargin=2.0, float32=False, remodellingParameters=None,
+              cacheDirectory=None, grayInterpolator='linear', segInterpolator='nearest', stacks=False, stitch=False,
+              multiStart=0, multiStartAngle=20.0, multiStartWorkers=None):
+    if os.path.isdir(inputPath) :
+        pairs = findPairs(inputPath)
+    elif os.path.isfile(inputPath) and inputPath.lower().endswith('.csv') :
+        pairs = readManifest(inputPath)
+    else :
+        print()
+        print('Error: The input must be a directory of images or a CSV manifest')
+        sys.exit(1)
+
+    for directory in (outDirectory, os.path.join(outDirectory, 'logs'), os.path.join(outDirectory, 'status')) :
+        os.makedirs(directory, exist_ok=True)
+
+    todo = [pair for pair in pairs if force or not isDone(pair, outDirectory)]
+    print('Found {} image pairs, {} already registered, {} to register'.format(len(pairs), len(pairs) - len(todo), len(todo)))
+
+    if not numberOfWorkers :
+        numberOfWorkers = max(1, (os.cpu_count() or 1) // numberOfThreads)
+
+    # With --stacks, the other stacks of a joint wait for its middle stack (unless it is already done)
+    references = getReferencePairs(pairs) if stacks else {}
+    todoIDs = {pair['pair_id'] for pair in todo}
+    waiting = {}
+
+    failed = []
+    # Jobs that were running when a worker process died are retried one at a time in their own pool
+    pools = {'main': ProcessPoolExecutor(max_workers=numberOfWorkers, initializer=initWorker, initargs=(numberOfThreads,)),
+             'retry': None}
+    running = {}
+    breaks = {}
+    def submit(job, statusPath, function, *args, pool='main') :
+        # Keep what is needed to find out what happened to the job if its worker process dies
+        if pools[pool] is None :
+            pools[pool] = ProcessPoolExecutor(max_workers=numberOfWorkers if pool == 'main' else 1,
+                                              initializer=initWorker, initargs=(numberOfThreads,))
+        submitted = time.time()
+        future = pools[pool].submit(function, *args)
+        running[future] = (job, statusPath, pool, pools[pool], submitted, function, args)
+
+    def submitPair(pair, initialTransformPath=None) :
+        submit(pair['pair_id'], getOutputPaths(pair, outDirectory)['status'], registerPair, pair, outDirectory, profileName,
+               useMask, maskDilation, crop, cropMargin, float32, remodellingParameters, cacheDirectory,
+               grayInterpolator, segInterpolator, initialTransformPath, multiStart, multiStartAngle, multiStartWorkers)
+
+    def waitForJobs() :
+        # Yield (job, status) as the running jobs finish
+        # If a worker process dies (e.g. out of memory), its whole pool is broken and a new pool is started.
+        # Jobs that had not started yet go back to the same pool. Jobs that had started (the job that
+        # killed the worker cannot be told apart from the ones killed with it) are retried one at a time,
+        # and a job that breaks that single process pool (or breaks MAX_BREAKS pools) is marked failed.
+        while running :
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished :
+                job, statusPath, pool, jobExecutor, submitted, function, args = running.pop(future)
+                try :
+                    status = future.result()
+                except BrokenProcessPool :
+                    if pools[pool] is jobExecutor :
+                        print('A worker process died, starting a new process pool')
+                        jobExecutor.shutdown(wait=False)
+                        pools[pool] = None
+
+                    breaks[job] = breaks.get(job, 0) + 1
+                    started = hasStarted(statusPath, submitted)
+                    if breaks[job] < MAX_BREAKS and not ( started and pool == 'retry' ) :
+                        submit(job, statusPath, function, *args, pool='retry' if started else pool)
+                        continue
+                    status = getWorkerDiedStatus(statusPath, job)
+                yield job, status
+
+    try :
+        for pair in todo :
+            reference = references.get( getJointStack(pair)[0] )
+            if reference is None or reference is pair :
+                submitPair(pair)
+            elif reference['pair_id'] in todoIDs :
+                waiting.setdefault(reference['pair_id'], []).append(pair)
+            else :
+                submitPair(pair, getOutputPaths(reference, outDirectory)['tmat'])
+
+        pairsByID = {pair['pair_id']: pair for pair in todo}
+        numberFinished = 0
+        for pairID, status in waitForJobs() :
+            numberFinished += 1
+            print('[{}/{}] {}: {}'.format(numberFinished, len(todo), status['pair_id'], status['status'].upper()))
+            if status['status'] != 'done' :
+                failed.append(status)
+
+            # Start the other stacks of the joint from the middle stack transform
+            initialTransformPath = getOutputPaths(pairsByID[pairID], outDirectory)['tmat'] if status['status'] == 'done' else None
+            for neighbour in waiting.pop(pairID, []) :
+                submitPair(neighbour, initialTransformPath)
+
+        # Stitch the joints whose stacks are all registered
+        if stitch :
+            joints = { jointID: jointPairs for jointID, jointPairs in groupStacks(pairs).items()
+                       if len(jointPairs) > 1 and all(isDone(pair, outDirectory) for pair in jointPairs) }
+            print('Stitching {} joints'.format(len(joints)))
+            for jointID, jointPairs in joints.items() :
+                submit(jointID + '_STITCH', getStitchPaths(jointID, outDirectory)['status'], stitchJoint, jointID, jointPairs, outDirectory, remodellingParameters)
+            for _, status in waitForJobs() :
+                print('{}: {}'.format(status['pair_id'], status['status'].upper()))
+                if status['status'] != 'done' :
+                    failed.append(status)
+    finally :
+        for executor in pools.values() :
+            if executor is not None :
+                executor.shutdown()
+
+    for status in failed :
+        print('FAILED: {} ({})'.format(status['pair_id'], status['error']))
+
+    # One table of formation/resorption statistics for the whole cohort
+    if remodellingParameters is not None :
+        BHS_remodellingStats.BHS_remodellingStats(outDirectory, os.path.join(outDirectory, 'remodelling_stats.csv'), numberOfWorkers)
+
+    return failed
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'input', type=str, help='A directory of images or a CSV manifest of image pairs' )
+    parser.add_argument( 'outDirectory', type=str, help='The output directory for registered images, transforms, logs and status files' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Number of registrations to run at once (default: number of cores / threads)' )
+    parser.add_argument( '-t', dest='threads', type=int, default=1, help='Number of ITK threads per registration (default: 1)' )
+    parser.add_argument( '--profile', type=str, default='powell', choices=sorted(REGISTRATION_PROFILES), help='The registration profile (default: powell)' )
+    parser.add_argument( '--mask', action='store_true', help='Only sample the metric inside the segmented bone' )
+    parser.add_argument( '--mask-dilation', dest='maskDilation', type=int, default=0, help='Dilate the segmented bone by this many voxels before using it as a mask (default: 0)' )
+    parser.add_argument( '--crop', action='store_true', help='Crop both images to the bounding box of the segmented bone before registration' )
+    parser.add_argument( '--crop-margin', dest='cropMargin', type=float, default=2.0, help='The margin around the bone bounding box in mm (default: 2.0)' )
+    parser.add_argument( '--float32', action='store_true', help='Register in single precision instead of double precision' )
+    parser.add_argument( '--remodelling', action='store_true', help='Calculate formation/resorption images after registration' )
+    BHS_remodelling.addParameterArguments(parser)
+    parser.add_argument( '--interpolator', type=str, default='linear', choices=BHS_resample.GRAY_INTERPOLATORS, help='The interpolator for the grayscale images (default: linear)' )
+    parser.add_argument( '--seg-interpolator', dest='segInterpolator', type=str, default='nearest', choices=BHS_resample.SEG_INTERPOLATORS, help='The interpolator for the segmented images (default: nearest)' )
+    parser.add_argument( '--cache', type=str, default='', help='The transform cache directory, shared by all pairs (default: no cache)' )
+    parser.add_argument( '--force', action='store_true', help='Register all pairs again, even those already done' )
+    parser.add_argument( '--stacks', action='store_true', help='Register the middle stack of each joint first and start its other stacks from that transform' )
+    parser.add_argument( '--stitch', action='store_true', help='Stitch the registered stacks of each joint into one image' )
+    parser.add_argument( '--multi-start', dest='multiStart', type=int, default=0, help='Number of coarse registrations to start each pair from (default: 0, see BHS_reg.py)' )
+    parser.add_argument( '--multi-start-angle', dest='multiStartAngle', type=float, default=20.0, help='The rotation of the multi-start starts in degrees (default: 20)' )
+    parser.add_argument( '--multi-start-workers', dest='multiStartWorkers', type=int, default=0, help='Number of processes for the multi-start registrations of each pair (default: up to -t, so 1 with -t 1)' )
+    args = parser.parse_args()
+
+    failed = BHS_batch(args.input, args.outDirectory, args.workers, args.threads, args.force, args.profile,
+                       args.mask, args.maskDilation, args.crop, args.cropMargin, args.float32,
+                       BHS_remodelling.getParameters(args) if args.remodelling else None, args.cache,
+                       args.interpolator, args.segInterpolator, args.stacks, args.stitch, args.multiStart, args.multiStartAngle,
+                       args.multiStartWorkers)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,248 @@
+#-----------------------------------------------------
+# BHS_benchmark.py
+#
+# Created on:   18-10-2026
+#
+# Description: Benchmark the speed and accuracy of the BHS_reg.py registration on
+#              synthetic phantoms, so that settings can be tuned without patient data.
+#              A trabecular-like phantom is generated inside an ellipsoidal bone with
+#              a cortical shell. The follow-up image is the phantom moved by a known
+#              Euler3D transform, with new noise and an intensity drift.
+#              The phantoms are made once, written to a temporary directory and read back by
+#              the cases, so phantom generation is not part of the measured memory.
+#              Each combination of profile, sampling percentage and shrink schedule is
+#              registered in its own process and the wall time, peak RSS, iteration
+#              count and recovered transform error are written to a JSON file.
+#
+#-----------------------------------------------------
+# Usage: python BHS_benchmark.py arg1 [--profiles ...] [--sampling ...] [--schedules ...]
+#
+# Where:  arg1 = The output JSON file for the benchmark results
+#
+# Options: --size = The phantom size in voxels (default: 128)
+#          --spacing = The phantom voxel size in mm (default: 0.0607, XCT-II)
+#          --repeats = The number of phantoms (each with a different known transform) (default: 3)
+#          --profiles = The registration profiles to run (default: all)
+#          --sampling = The metric sampling percentages to run (default: 0.005 0.01 0.05)
+#          --schedules = The shrink schedules to run, e.g. 1,1 4,2,1 (default: the profile's own)
+#          --mask, --crop, --float32 = Passed on to the registration (see BHS_reg.py)
+#
+# Notes: Peak RSS is read with the resource module, which is not available on Windows.
+#        readRSS_MB is the peak after reading the phantom images and peakRSS_MB the peak after
+#        the registration, the same as a BHS_reg.py run (see BHS_report.py).
+#-----------------------------------------------------
+import os
+import copy
+import json
+import time
+import argparse
+import tempfile
+import platform
+import itertools
+import contextlib
+import multiprocessing
+
+import numpy as np
+import SimpleITK as sitk
+
+from BHS_reg import REGISTRATION_PROFILES, registerImages
+from BHS_report import peakRSS
+
+
+def makePhantom(size=128, spacing=0.0607, seed=0):
+    # Return a trabecular-like grayscale phantom and its bone mask
+    rng = np.random.default_rng(seed)
+
+    # Trabeculae: a thin band around the zero level of smoothed noise gives a connected plate/rod network
+    noise = sitk.GetImageFromArray( rng.standard_normal((size, size, size)).astype(np.float32) )
+    noise.SetSpacing([spacing] * 3)
+    noise = sitk.GetArrayFromImage( sitk.SmoothingRecursiveGaussian(noise, 4 * spacing) )
+    trabeculae = np.abs(noise) < 0.25 * noise.std()
+
+    # Ellipsoidal bone with a cortical shell, slightly off centre so the geometric initializer has some work to do
+    z, y, x = np.ogrid[:size, :size, :size]
+    centre = np.array([0.5, 0.48, 0.52]) * size
+    radius = np.array([0.42, 0.3, 0.35]) * size
+    r = np.sqrt( ((z - centre[0]) / radius[0])**2 + ((y - centre[1]) / radius[1])**2 + ((x - centre[2]) / radius[2])**2 )
+    bone = r < 1.0
+    cortex = bone & (r > 0.9)
+
+    array = np.full((size, size, size), 0.0, dtype=np.float32)    # air
+    array[r < 1.1] = 200.0                                          # soft tissue
+    array[bone] = 400.0                                             # marrow
+    array[bone & trabeculae] = 1200.0                               # trabecular bone
+    array[cortex] = 1600.0                                          # cortical bone
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([spacing] * 3)
+    mask = sitk.GetImageFromArray( bone.astype(np.uint8) * 127 )
+    mask.CopyInformation(image)
+
+    return image, mask
+
+
+def randomTransform(image, rng, maxAngle=5.0, maxShift=1.0):
+    # A random rigid transform (angles in degrees, shift in mm) about the image centre
+    centre = image.TransformContinuousIndexToPhysicalPoint([ (s - 1) / 2.0 for s in image.GetSize() ])
+    angles = np.radians( rng.uniform(-maxAngle, maxAngle, 3) )
+    shift = rng.uniform(-maxShift, maxShift, 3)
+    return sitk.Euler3DTransform(centre, *angles, shift)
+
+
+def makeFollowup(image, mask, transform, rng, noise=40.0, gain=1.03, offset=-20.0):
+    # Move the phantom by a known transform, then add new noise and an intensity drift
+    followup = sitk.Resample(image, image, transform, sitk.sitkLinear, 0.0)
+    followupMask = sitk.Resample(mask, mask, transform, sitk.sitkNearestNeighbor, 0)
+
+    array = sitk.GetArrayFromImage(followup) * gain + offset
+    array += rng.normal(0.0, noise, array.shape).astype(np.float32)
+    followupNoisy = sitk.GetImageFromArray( array.astype(np.float32) )
+    followupNoisy.CopyInformation(followup)
+
+    return followupNoisy, followupMask
+
+
+def transformError(recovered, expected, mask):
+    # Mean and maximum distance (mm) between the recovered and expected transforms over the bone
+    # The follow-up image was made by resampling with the known transform T, so the
+    # registration (follow-up -> baseline) should recover the inverse of T
+    points = np.argwhere( sitk.GetArrayViewFromImage(mask)[::4, ::4, ::4] > 0 ) * 4
+    distances = []
+    for z, y, x in points :
+        point = mask.TransformIndexToPhysicalPoint( (int(x), int(y), int(z)) )
+        distances.append( np.linalg.norm( np.subtract(recovered.TransformPoint(point), expected.TransformPoint(point)) ) )
+
+    return float(np.mean(distances)), float(np.max(distances))
+
+
+def writePhantoms(outDirectory, repeats, size=128, spacing=0.0607):
+    # Make the phantom, its follow-up and the known transform of every repeat and write them
+    # Returns the file names of each repeat
+    phantomPaths = []
+    for repeat in range(repeats) :
+        rng = np.random.default_rng(repeat)
+        image, mask = makePhantom(size, spacing, seed=repeat)
+        trueTransform = randomTransform(image, rng)
+        followup, followupMask = makeFollowup(image, mask, trueTransform, rng)
+
+        paths = { name: os.path.join(outDirectory, 'PHANTOM_{}_{}.mha'.format(repeat, name.upper()))
+                  for name in ('image', 'mask', 'followup', 'followupMask') }
+        for name, phantom in (('image', image), ('mask', mask), ('followup', followup), ('followupMask', followupMask)) :
+            sitk.WriteImage(phantom, paths[name])
+        paths['transform'] = os.path.join(outDirectory, 'PHANTOM_{}.tfm'.format(repeat))
+        sitk.WriteTransform(trueTransform, paths['transform'])
+        phantomPaths.append(paths)
+
+    return phantomPaths
+
+
+def runCase(case):
+    # Run one registration in its own process so that the peak RSS belongs to this case only
+    paths = case['phantomPaths']
+    image, mask, followup, followupMask = [ sitk.ReadImage(paths[name]) for name in ('image', 'mask', 'followup', 'followupMask') ]
+    trueTransform = sitk.Euler3DTransform( sitk.ReadTransform(paths['transform']) )
+    readRSS = peakRSS()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull) :
+        startCPU = time.process_time()
+        finalTransform, info = registerImages(image, followup, mask, followupMask, case['profileSettings'],
+                                              case['mask'], 0, case['crop'], 2.0, case['float32'])
+        cpuTime = time.process_time() - startCPU
+
+    meanError, maxError = transformError(finalTransform, trueTransform.GetInverse(), mask)
+
+    result = {key: value for key, value in case.items() if key not in ('profileSettings', 'phantomPaths')}
+    result.update({
+        'wallTime': info['wallTime'],
+        'cpuTime': cpuTime,
+        'readRSS_MB': readRSS,
+        'peakRSS_MB': peakRSS(),
+        'iterations': info['iterations'],
+        'finalMetric': info['finalMetric'],
+        'stopCondition': info['stopCondition'],
+        'meanError_mm': meanError,
+        'maxError_mm': maxError,
+        'trueParameters': list(trueTransform.GetParameters())
+    })
+    return result
+
+
+def getCases(args, phantomPaths):
+    schedules = args.schedules or [None]
+    cases = []
+    for repeat, profileName, samplingPercentage, schedule in itertools.product(range(args.repeats), args.profiles, args.sampling, schedules) :
+        profile = copy.deepcopy(REGISTRATION_PROFILES[profileName])
+        profile['name'] = profileName
+        profile['samplingPercentage'] = samplingPercentage
+        if schedule :
+            # Smooth each level by half its shrink factor (in mm), with no smoothing at full resolution
+            profile['shrinkFactors'] = [int(factor) for factor in schedule.split(',')]
+            profile['smoothingSigmas'] = [0.5 * factor * args.spacing if factor > 1 else 0 for factor in profile['shrinkFactors']]
+
+        cases.append({
+            'repeat': repeat,
+            'profile': profileName,
+            'samplingPercentage': samplingPercentage,
+            'shrinkFactors': profile['shrinkFactors'],
+            'smoothingSigmas': profile['smoothingSigmas'],
+            'size': args.size,
+            'spacing': args.spacing,
+            'mask': args.mask,
+            'crop': args.crop,
+            'float32': args.float32,
+            'profileSettings': profile,
+            'phantomPaths': phantomPaths[repeat]
+        })
+
+    return cases
+
+
+def BHS_benchmark(args):
+    # A new process for each case (maxtasksperchild=1) keeps the peak RSS measurements separate
+    results = []
+    with tempfile.TemporaryDirectory() as phantomDirectory :
+        print('Making {} phantoms'.format(args.repeats))
+        cases = getCases(args, writePhantoms(phantomDirectory, args.repeats, args.size, args.spacing))
+        print('Running {} registrations'.format(len(cases)))
+
+        with multiprocessing.Pool(processes=args.workers, maxtasksperchild=1) as pool :
+            for i, result in enumerate(pool.imap(runCase, cases), 1) :
+                print('[{}/{}] {} sampling={} shrink={}: {:.2f} s, {} iterations, {:.0f} MB, error {:.4f} mm (max {:.4f} mm)'.format(
+                    i, len(cases), result['profile'], result['samplingPercentage'], result['shrinkFactors'], result['wallTime'],
+                    result['iterations'], result['peakRSS_MB'], result['meanError_mm'], result['maxError_mm']))
+                results.append(result)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'simpleitk': sitk.Version.VersionString(),
+        'cpuCount': os.cpu_count(),
+        'itkThreads': sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+        'results': results
+    }
+
+    print('Writing to {}'.format(args.output))
+    with open(args.output, 'w') as f :
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'output', type=str, help='The output JSON file for the benchmark results' )
+    parser.add_argument( '--size', type=int, default=128, help='The phantom size in voxels (default: 128)' )
+    parser.add_argument( '--spacing', type=float, default=0.0607, help='The phantom voxel size in mm (default: 0.0607)' )
+    parser.add_argument( '--repeats', type=int, default=3, help='The number of phantoms to register (default: 3)' )
+    parser.add_argument( '--profiles', type=str, nargs='+', default=sorted(REGISTRATION_PROFILES), choices=sorted(REGISTRATION_PROFILES), help='The registration profiles to run (default: all)' )
+    parser.add_argument( '--sampling', type=float, nargs='+', default=[0.005, 0.01, 0.05], help='The metric sampling percentages to run (default: 0.005 0.01 0.05)' )
+    parser.add_argument( '--schedules', type=str, nargs='+', default=[], help='The shrink schedules to run, e.g. 1,1 4,2,1 (default: the profile\'s own)' )
+    parser.add_argument( '--mask', action='store_true', help='Only sample the metric inside the phantom bone' )
+    parser.add_argument( '--crop', action='store_true', help='Crop the phantoms to the bone bounding box before registration' )
+    parser.add_argument( '--float32', action='store_true', help='Register in single precision instead of double precision' )
+    parser.add_argument( '-n', dest='workers', type=int, default=1, help='Number of registrations to run at once (default: 1, so timings do not compete)' )
+    args = parser.parse_args()
+
+    BHS_benchmark(args)
@@ -0,0 +1,105 @@
+#-----------------------------------------------------
+# BHS_cache.py
+#
+# Created on:   18-10-2026
+#
+# Description: Content-addressed cache of registration transforms for BHS_reg.py.
+#              Transforms are stored by a hash of the input images (the image key) and a
+#              hash of the registration parameters (the parameter key):
+#                   <cache directory>/<image key>/<parameter key>.tfm
+#                   <cache directory>/<image key>/<parameter key>.json
+#              If both keys match, the cached transform is used and the optimization is
+#              skipped. If only the image key matches (e.g. a different profile), the most
+#              recent cached transform of those images is used as the initial transform
+#              instead of the geometric centre initializer (unless an initial transform is given).
+#              A given initial transform is part of the registration parameters.
+#
+# Notes: The image hash covers the voxel data, pixel type, size, spacing, origin and
+#        direction, so a renamed or re-converted image still matches, but an image with
+#        any changed voxel does not.
+#        Files are written to a temporary name first, so several processes (e.g. BHS_batch.py)
+#        can share one cache directory.
+#-----------------------------------------------------
+import os
+import glob
+import json
+import hashlib
+
+import SimpleITK as sitk
+
+
+def hashImage(image):
+    # SHA-256 of the image information and voxel data (no copy of the voxel data is made)
+    h = hashlib.sha256()
+    h.update( json.dumps([image.GetPixelIDTypeAsString(), image.GetSize(), image.GetSpacing(),
+                          image.GetOrigin(), image.GetDirection()]).encode() )
+    h.update( memoryview( sitk.GetArrayViewFromImage(image) ).cast('B') )
+    return h.hexdigest()
+
+
+def hashParameters(parameters):
+    # SHA-256 of a JSON serializable dictionary of registration parameters
+    return hashlib.sha256( json.dumps(parameters, sort_keys=True).encode() ).hexdigest()
+
+
+def hashTransform(transform):
+    # SHA-256 of the transform type, parameters and fixed parameters (e.g. the centre of rotation)
+    return hashParameters({'type': transform.GetName(), 'parameters': list(transform.GetParameters()),
+                           'fixedParameters': list(transform.GetFixedParameters())})
+
+
+def getImageKey(fixedImage, movingImage):
+    return hashlib.sha256( (hashImage(fixedImage) + hashImage(movingImage)).encode() ).hexdigest()
+
+
+def getEulerTransform(transform):
+    # The registration returns a composite transform holding one Euler3DTransform.
+    # Return that Euler3DTransform (to start an optimization from), or None for any other transform.
+    transform = transform.Downcast()
+    if isinstance(transform, sitk.CompositeTransform) :
+        transform.FlattenTransform()
+        if transform.GetNumberOfTransforms() != 1 :
+            return None
+        transform = transform.GetNthTransform(0).Downcast()
+
+    if not isinstance(transform, sitk.Euler3DTransform) :
+        return None
+    return transform
+
+
+def readCachedTransform(cacheDirectory, imageKey, parameterKey):
+    # Returns (transform, True) for an exact match, (transform, False) for a transform of the
+    # same images with other parameters, or (None, False) if the images have not been registered
+    imageDirectory = os.path.join(cacheDirectory, imageKey)
+    exactPath = os.path.join(imageDirectory, parameterKey + '.tfm')
+    if os.path.isfile(exactPath) :
+        return sitk.ReadTransform(exactPath), True
+
+    # Skip transforms that another process is still writing
+    candidates = [path for path in glob.glob(os.path.join(imageDirectory, '*.tfm')) if not path.endswith('.tmp.tfm')]
+    candidates = sorted(candidates, key=os.path.getmtime, reverse=True)
+    for candidatePath in candidates :
+        transform = getEulerTransform( sitk.ReadTransform(candidatePath) )
+        if transform is not None :
+            return transform, False
+
+    return None, False
+
+
+def writeCachedTransform(cacheDirectory, imageKey, parameterKey, transform, parameters, info):
+    imageDirectory = os.path.join(cacheDirectory, imageKey)
+    os.makedirs(imageDirectory, exist_ok=True)
+
+    transformPath = os.path.join(imageDirectory, parameterKey + '.tfm')
+    tmpPath = os.path.join(imageDirectory, '{}.{}.tmp.tfm'.format(parameterKey, os.getpid()))
+    sitk.WriteTransform(transform, tmpPath)
+    os.replace(tmpPath, transformPath)
+
+    # The parameters and registration summary are kept for reference only
+    infoPath = os.path.join(imageDirectory, parameterKey + '.json')
+    tmpPath = infoPath + '.{}.tmp'.format(os.getpid())
+    with open(tmpPath, 'w') as f :
+        json.dump({'parameters': parameters, 'info': info}, f, indent=2)
+    os.replace(tmpPath, infoPath)
+
+    return transformPath
@@ -0,0 +1,229 @@
+#-----------------------------------------------------
+# BHS_components.py
+#
+# Created on:   18-10-2026
+#
+# Description: Out-of-core version of the cl_nr_extract step of BHS_remodelling.py (IPL
+#              cl_nr_extract, topology 6) for images that are too large to label in memory.
+#              The image is memory-mapped and labelled in slabs of z slices:
+#                   1. Each slab is labelled (6-connected) on its own, in parallel. Only the
+#                      component sizes and the labels of the first and last slice are kept.
+#                   2. Components that touch across a slab boundary (same x, y in the last
+#                      slice of one slab and the first slice of the next) are joined with a
+#                      vectorised union-find, which gives the size of every component of the whole image.
+#                   3. Each slab is labelled again, in parallel, and the components with at
+#                      least the minimum number of voxels are written to the memory-mapped output.
+#              Only a few slabs are in memory at once, and the result is the same as labelling
+#              the whole image at once.
+#
+#-----------------------------------------------------
+# Usage: python BHS_components.py arg1 arg2 [--min N] [--value N] [--slab N] [-n workers]
+#
+# Where:  arg1 = The input image (uncompressed .mha, or .mhd with a .raw data file)
+#         arg2 = The output image (.mha)
+#
+# Options: --min = Smallest component kept, in voxels (default: cl_nr_min of BHS_remodelling.py)
+#          --value = The value of the kept voxels (default: 127)
+#          --slab = Number of z slices per slab (default: 64)
+#          -n = Number of slabs to label at once (default: number of cores)
+#
+# Notes: Any non-zero voxel is an object voxel. Compressed MHA images cannot be memory-mapped
+#        (write them with useCompression=False, the SimpleITK default).
+#-----------------------------------------------------
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+import BHS_remodelling
+
+# MetaImage element type -> numpy type
+MET_TYPES = {
+    'MET_CHAR': np.int8,
+    'MET_UCHAR': np.uint8,
+    'MET_SHORT': np.int16,
+    'MET_USHORT': np.uint16,
+    'MET_INT': np.int32,
+    'MET_UINT': np.uint32,
+    'MET_LONG_LONG': np.int64,
+    'MET_ULONG_LONG': np.uint64,
+    'MET_FLOAT': np.float32,
+    'MET_DOUBLE': np.float64
+}
+
+# Header fields copied from the input to the output image
+COPIED_FIELDS = ('ObjectType', 'NDims', 'TransformMatrix', 'Offset', 'CenterOfRotation', 'AnatomicalOrientation', 'ElementSpacing', 'DimSize')
+
+
+def readMetaHeader(imagePath):
+    # Returns the header fields, the data file and the byte offset of the voxel data
+    fields = {}
+    with open(imagePath, 'rb') as f :
+        while True :
+            line = f.readline()
+            if not line :
+                raise ValueError('No ElementDataFile in the header of {}'.format(imagePath))
+            key, _, value = line.decode('latin-1').partition('=')
+            fields[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile' :
+                dataOffset = f.tell()
+                break
+
+    if fields.get('CompressedData', 'False').lower() == 'true' :
+        raise ValueError('Compressed images cannot be memory-mapped: {}'.format(imagePath))
+    if int(fields.get('ElementNumberOfChannels', 1)) != 1 or fields.get('ElementType') not in MET_TYPES :
+        raise ValueError('Only single channel {} images are supported: {}'.format(', '.join(MET_TYPES), imagePath))
+
+    dataFile = fields['ElementDataFile']
+    if dataFile == 'LOCAL' :
+        dataFile = imagePath
+    else :
+        dataFile = os.path.join(os.path.dirname(imagePath), dataFile)
+        dataOffset = int(fields.get('HeaderSize', 0))
+
+    return fields, dataFile, dataOffset
+
+
+def getVolume(imagePath, mode='r'):
+    # The voxel data as a (z, y, x) memory-mapped array
+    fields, dataFile, dataOffset = readMetaHeader(imagePath)
+    msb = fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False')).lower() == 'true'
+    dtype = np.dtype(MET_TYPES[fields['ElementType']]).newbyteorder('>' if msb else '<')
+    shape = tuple( int(size) for size in reversed(fields['DimSize'].split()) )
+    return np.memmap(dataFile, dtype=dtype, mode=mode, offset=dataOffset, shape=shape)
+
+
+def createOutput(inputPath, outputPath):
+    # An uncompressed MHA image with the grid of the input image and 8-bit voxels (all 0)
+    fields, _, _ = readMetaHeader(inputPath)
+    header = [ '{} = {}'.format(key, fields[key]) for key in COPIED_FIELDS if key in fields ]
+    header += ['BinaryData = True', 'BinaryDataByteOrderMSB = False', 'CompressedData = False',
+               'ElementType = MET_UCHAR', 'ElementDataFile = LOCAL']
+    header = ( '\n'.join(header) + '\n' ).encode('latin-1')
+
+    numberOfVoxels = int( np.prod([int(size) for size in fields['DimSize'].split()]) )
+    with open(outputPath, 'wb') as f :
+        f.write(header)
+        f.truncate(len(header) + numberOfVoxels)
+
+
+def getSlabs(numberOfSlices, slabSize):
+    return [ (start, min(start + slabSize, numberOfSlices)) for start in range(0, numberOfSlices, slabSize) ]
+
+
+def labelSlab(imagePath, start, stop):
+    # 6-connected components of the non-zero voxels of slices [start, stop)
+    objects = np.asarray( getVolume(imagePath)[start:stop] ) != 0
+    labels = sitk.ConnectedComponent( sitk.GetImageFromArray(objects.view(np.uint8)), False )
+    return sitk.GetArrayFromImage(labels)
+
+
+def countSlab(imagePath, start, stop):
+    # Pass 1: number of components, their sizes (index 0 is the background) and the boundary slices
+    labels = labelSlab(imagePath, start, stop)
+    sizes = np.bincount(labels.ravel())
+    return sizes, labels[0].copy(), labels[-1].copy()
+
+
+def writeSlab(imagePath, outputPath, start, stop, keep, value):
+    # Pass 2: write the kept components of the slab (keep is indexed by the slab labels)
+    labels = labelSlab(imagePath, start, stop)
+    output = getVolume(outputPath, 'r+')
+    output[start:stop] = keep[labels].astype(np.uint8) * value
+    output.flush()
+
+
+def compressPaths(parent):
+    # Point every label at its root: follow the parents of all labels at once until nothing changes
+    while True :
+        newParent = parent[parent]
+        if np.array_equal(newParent, parent) :
+            return parent
+        parent = newParent
+
+
+def joinSlabs(slabResults):
+    # Union-find over the slab labels. Slab i has the (global) labels offsets[i] (its background)
+    # to offsets[i + 1] - 1. Returns the component (root label) and component size of every label.
+    offsets = np.cumsum( [0] + [sizes.size for sizes, _, _ in slabResults] )
+    sizes = np.concatenate( [sizes for sizes, _, _ in slabResults] )
+
+    # Labels that touch across a slab boundary (both non-zero at the same x, y)
+    pairs = []
+    for i in range(len(slabResults) - 1) :
+        lastSlice = slabResults[i][2].ravel()
+        firstSlice = slabResults[i + 1][1].ravel()
+        touching = (lastSlice != 0) & (firstSlice != 0)
+        pairs.append( np.stack([lastSlice[touching] + offsets[i], firstSlice[touching] + offsets[i + 1]], axis=1) )
+    pairs = np.unique( np.concatenate(pairs), axis=0 ) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    # Every label points at a smaller (or the same) label. Hook the larger root of each touching pair
+    # onto the smaller one, then compress the paths, until both labels of every pair have the same root.
+    roots = np.arange(sizes.size)
+    while True :
+        rootsA = roots[pairs[:, 0]]
+        rootsB = roots[pairs[:, 1]]
+        if np.array_equal(rootsA, rootsB) :
+            break
+        np.minimum.at( roots, np.maximum(rootsA, rootsB), np.minimum(rootsA, rootsB) )
+        roots = compressPaths(roots)
+
+    componentSizes = np.bincount(roots, weights=sizes, minlength=sizes.size)[roots]
+    return roots, componentSizes, offsets
+
+
+def clNrExtractFile(inputPath, outputPath, minNumber, value=127, slabSize=64, numberOfWorkers=None):
+    # Same as BHS_remodelling.clNrExtract(), from one image file to another, one slab at a time
+    shape = getVolume(inputPath).shape
+    slabs = getSlabs(shape[0], slabSize)
+    print('Labelling {} ({} x {} x {}) in {} slabs of {} slices'.format(inputPath, shape[2], shape[1], shape[0], len(slabs), slabSize))
+
+    createOutput(inputPath, outputPath)
+    with ProcessPoolExecutor(max_workers=numberOfWorkers or None) as executor :
+        # Pass 1: label the slabs and join the components across the slab boundaries
+        slabResults = list( executor.map(countSlab, [inputPath] * len(slabs), *zip(*slabs)) )
+        roots, componentSizes, offsets = joinSlabs(slabResults)
+
+        # Pass 2: write the components with at least minNumber voxels (never the background)
+        keep = componentSizes >= minNumber
+        keep[offsets[:-1]] = False
+        components = np.ones(roots.size, dtype=bool)
+        components[offsets[:-1]] = False
+        numberOfComponents = np.unique(roots[components]).size
+        numberKept = np.unique(roots[keep]).size
+        print('{} components ({} slab labels), {} with at least {} voxels'.format(numberOfComponents, int(components.sum()), numberKept, minNumber))
+
+        futures = [ executor.submit(writeSlab, inputPath, outputPath, start, stop, keep[offsets[i]:offsets[i + 1]], value)
+                    for i, (start, stop) in enumerate(slabs) ]
+        for future in futures :
+            future.result()
+
+    print('Wrote {}'.format(outputPath))
+    return numberKept
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'input', type=str, help='The input image (path + filename, uncompressed .mha or .mhd)' )
+    parser.add_argument( 'output', type=str, help='The output image (path + filename, .mha)' )
+    parser.add_argument( '--min', dest='minNumber', type=int, default=BHS_remodelling.REMODELLING_PARAMETERS['cl_nr_min'], help='Smallest component kept, in voxels (default: {})'.format(BHS_remodelling.REMODELLING_PARAMETERS['cl_nr_min']) )
+    parser.add_argument( '--value', type=int, default=127, help='The value of the kept voxels (default: 127)' )
+    parser.add_argument( '--slab', dest='slabSize', type=int, default=64, help='Number of z slices per slab (default: 64)' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Number of slabs to label at once (default: number of cores)' )
+    args = parser.parse_args()
+
+    if not args.output.lower().endswith('.mha') :
+        print()
+        print('Error: The output image must be a .mha file')
+        sys.exit(1)
+
+    try :
+        clNrExtractFile(args.input, args.output, args.minNumber, args.value, args.slabSize, args.workers)
+    except ValueError as e :
+        print()
+        print('Error: {}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,319 @@
+#-----------------------------------------------------
+# BHS_longitudinal.py
+#
+# Created on:   18-10-2026
+#
+# Description: Register any number of follow-up visits (e.g. 06MO, 12MO, 24MO) to one baseline
+#              visit (e.g. 03MO). BHS_reg.py registers one pair at a time, so the baseline is cast,
+#              cropped, smoothed and shrunk again for every follow-up. Here, everything of the
+#              baseline that does not depend on the follow-up image is done once and shared by all
+#              visits:
+#                   -the cropped and cast (float32/float64) baseline image
+#                   -the smoothed and shrunk baseline image of every pyramid level of the profile
+#                   -the metric mask (segmented baseline bone)
+#                   -the metric sample points (a fixed random seed, so every visit is sampled at
+#                    the same baseline points)
+#              Each pyramid level is registered with its own (single level) registration method,
+#              starting from the transform of the level before.
+#              With --chain, each visit starts from the transform of the visit before it instead
+#              of matching the image centres (the bone changes little from one visit to the next).
+#
+#-----------------------------------------------------
+# Usage: python BHS_longitudinal.py arg1 arg2 [-n workers] [-t threads] [--baseline months] [--chain]
+#                                           [--profile name] [--mask] [--mask-dilation N] [--crop]
+#                                           [--crop-margin mm] [--float32] [--seed N] [--remodelling]
+#                                           [--interpolator name] [--seg-interpolator name]
+#
+# Where:  arg1 = A directory of MHA images named BHS_<subject>_<visit>_<joint>[_<stack>][_SEG].mha
+#         arg2 = The output directory
+#
+# Options: --baseline = The baseline visit in months (default: the first visit of each joint)
+#          --chain = Start each visit from the transform of the visit before it
+#          -n = Number of joints to register at once (default: number of cores / threads)
+#          -t = Number of ITK threads per joint (default: 1)
+#          The other options are the same as BHS_reg.py.
+#
+# Outputs: For every follow-up visit of every joint (<joint> = BHS_<subject>_<joint>[_<stack>]):
+#          <joint>_<visit>_TO_<baseline>.mha, <joint>_<visit>_TO_<baseline>_SEG.mha and
+#          <joint>_<visit>_REG.tfm, e.g. BHS_030_MCP2_MID_12MO_TO_03MO.mha (the image names of
+#          BHS_batch.py) and BHS_030_MCP2_MID_12MO_REG.tfm (BHS_batch.py writes <joint>_REG.tfm,
+#          but here a joint has one transform per follow-up visit).
+#          One run report per joint: <joint>_LONGITUDINAL_REPORT.json (see BHS_report.py).
+#          The console output of each joint is in <arg2>/logs.
+#
+# Notes: The pyramid is built with SmoothingRecursiveGaussian and Shrink, so the results are close
+#        to, but not exactly the same as, BHS_reg.py with the same profile.
+#-----------------------------------------------------
+import os
+import sys
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+
+import BHS_reg
+import BHS_cache
+import BHS_report
+import BHS_resample
+import BHS_remodelling
+import BHS_remodellingStats
+from util.util.imageNames import parseImageName, getPairID
+
+# Images that SimpleITK reads (AIMs must be converted first, see util/fileConverter.py)
+IMAGE_EXTENSIONS = ('.mha', '.nii', '.nii.gz')
+
+
+def getLevelImage(image, shrinkFactor, smoothingSigma):
+    # One level of the registration pyramid (smoothing sigma in mm)
+    if smoothingSigma > 0 :
+        image = sitk.SmoothingRecursiveGaussian(image, smoothingSigma)
+    if shrinkFactor > 1 :
+        image = sitk.Shrink(image, [shrinkFactor] * image.GetDimension())
+    return image
+
+
+def prepareFixedImage(fixedImage, fixedSegImage=None, profileName='powell', useMask=False, maskDilation=0,
+                      crop=False, cropMargin=2.0, float32=False):
+    # Everything of the baseline (fixed) image that registerVisit() needs, computed once
+    profileName, profile = BHS_reg.getProfile(profileName)
+
+    if crop :
+        fixedImage = BHS_reg.cropToBone(fixedImage, fixedSegImage, cropMargin)
+    pixelType = sitk.sitkFloat32 if float32 else sitk.sitkFloat64
+    image = sitk.Cast(fixedImage, pixelType)
+
+    return {
+        'profileName': profileName,
+        'profile': profile,
+        'pixelType': pixelType,
+        'crop': crop,
+        'cropMargin': cropMargin,
+        'image': image,
+        'levels': [ getLevelImage(image, shrinkFactor, smoothingSigma)
+                    for shrinkFactor, smoothingSigma in zip(profile['shrinkFactors'], profile['smoothingSigmas']) ],
+        'mask': BHS_reg.getMetricMask(fixedSegImage, maskDilation) if useMask else None
+    }
+
+
+def registerVisit(fixed, movingImage, movingSegImage=None, initialTransform=None, seed=1, verbose=0, report=None):
+    # Register one follow-up image to the prepared baseline (see prepareFixedImage)
+    # Returns the Euler3D transform and a summary of the run (the same as BHS_reg.registerImages)
+    profile = fixed['profile']
+    if report is None :
+        report = BHS_report.RunReport()
+
+    with report.stage('crop') :
+        if fixed['crop'] :
+            movingImage = BHS_reg.cropToBone(movingImage, movingSegImage, fixed['cropMargin'])
+        movingImage = sitk.Cast(movingImage, fixed['pixelType'])
+
+    with report.stage('initializer') :
+        if initialTransform is not None :
+            print('Starting from the given initial transform')
+            transform = sitk.Euler3DTransform(initialTransform)
+        else :
+            transform = sitk.CenteredTransformInitializer(fixed['image'], movingImage, sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY)
+
+    metricTrajectory = []
+    print('Start registration')
+    wallTime = 0.0
+    for level, fixedLevel in enumerate(fixed['levels']) :
+        with report.stage('registration') :
+            movingLevel = getLevelImage(movingImage, profile['shrinkFactors'][level], profile['smoothingSigmas'][level])
+
+            reg = BHS_reg.getRegistrationMethod(profile, fixed['mask'], seed, metricTrajectory, verbose, level)
+            reg.SetInitialTransform(transform, inPlace=False)
+            transform = BHS_cache.getEulerTransform( reg.Execute(fixedLevel, movingLevel) )
+        wallTime += report.stages[-1]['wallTime']
+
+    with report.stage('finalMetric') :
+        finalMetric = BHS_reg.evaluateMetric(fixed['image'], movingImage, transform, profile['samplingPercentage'], fixed['mask'])
+    info = {
+        'profile': fixed['profileName'],
+        'wallTime': wallTime,
+        'finalMetric': finalMetric,
+        'iterations': len(metricTrajectory),
+        'stopCondition': reg.GetOptimizerStopConditionDescription(),
+        'initializer': 'given' if initialTransform is not None else 'geometry',
+        'finalParameters': list( transform.GetParameters() ),
+        'metricTrajectory': metricTrajectory
+    }
+    print('Profile {}: {:.2f} s, final metric {:.5f} ({})'.format(fixed['profileName'], wallTime, finalMetric, info['stopCondition']))
+
+    return transform, info
+
+
+def getVisitName(visit):
+    return '{:02d}MO'.format(visit)
+
+
+def getVisitOutputPaths(jointID, visit, baselineVisit, outDirectory):
+    prefix = os.path.join(outDirectory, jointID + '_' + getVisitName(visit))
+    return {
+        'reg': prefix + '_TO_' + getVisitName(baselineVisit) + '.mha',
+        'seg_reg': prefix + '_TO_' + getVisitName(baselineVisit) + '_SEG.mha',
+        'tmat': prefix + '_REG.tfm'
+    }
+
+
+def findVisits(inputDirectory, baselineVisit=None):
+    # Joint -> [(visit, grayscale image, segmented image), ...] with the baseline visit first
+    # and the follow-up visits in order. Joints without a baseline and a follow-up are skipped.
+    groups = {}
+    for filename in sorted(os.listdir(inputDirectory)) :
+        info = parseImageName(filename, IMAGE_EXTENSIONS)
+        if info is None :
+            continue
+        visits = groups.setdefault(getPairID(info), {})
+        visits.setdefault(info['visit'], {})['seg' if info['seg'] else 'gray'] = os.path.join(inputDirectory, filename)
+
+    joints = {}
+    for jointID, visits in groups.items() :
+        complete = sorted( visit for visit, images in visits.items() if 'gray' in images and 'seg' in images )
+        baseline = baselineVisit if baselineVisit is not None else ( complete[0] if complete else None )
+        followups = [visit for visit in complete if baseline is not None and visit > baseline]
+        if baseline not in complete or not followups :
+            print('Warning: Skipping {} (needs a baseline and at least one follow-up visit with grayscale and segmented images)'.format(jointID))
+            continue
+        joints[jointID] = [ (visit, visits[visit]['gray'], visits[visit]['seg']) for visit in [baseline] + followups ]
+
+    return joints
+
+
+def BHS_longitudinal(jointID, visits, outDirectory, chain=False, profileName='powell', useMask=False, maskDilation=0,
+                     crop=False, cropMargin=2.0, float32=False, seed=1, remodellingParameters=None,
+                     grayInterpolator='linear', segInterpolator='nearest', verbose=0):
+    # Register the follow-up visits to the baseline visit (the first in the list of
+    # (visit, grayscale image, segmented image)). Returns visit -> transform.
+    (baselineVisit, baselineImagePath, baselineSegPath), followups = visits[0], visits[1:]
+
+    report = BHS_report.RunReport()
+    reportPath = os.path.join(outDirectory, jointID + '_LONGITUDINAL_REPORT.json')
+    report.info.update({
+        'baseline': [baselineVisit, baselineImagePath, baselineSegPath],
+        'settings': {'profile': BHS_reg.getProfile(profileName)[0], 'useMask': useMask, 'maskDilation': maskDilation, 'crop': crop,
+                     'cropMargin': cropMargin, 'float32': float32, 'seed': seed, 'chain': chain,
+                     'remodelling': remodellingParameters is not None, 'grayInterpolator': grayInterpolator,
+                     'segInterpolator': segInterpolator},
+        'visits': {}
+    })
+
+    #----------------------------------------------#
+    # STEP 1: Read and prepare the baseline once
+    #----------------------------------------------#
+    with report.stage('read') :
+        baselineImage = BHS_reg.readImage(baselineImagePath)
+        baselineSegImage = BHS_reg.readImage(baselineSegPath)
+
+    with report.stage('prepare') :
+        fixed = prepareFixedImage(baselineImage, baselineSegImage, profileName, useMask, maskDilation, crop, cropMargin, float32)
+
+    #----------------------------------------------#
+    # STEP 2: Register, resample and write each follow-up visit
+    #----------------------------------------------#
+    transforms = {}
+    previousTransform = None
+    for visit, imagePath, segPath in followups :
+        print()
+        print('Visit {} -> {}'.format(getVisitName(visit), getVisitName(baselineVisit)))
+        outputs = getVisitOutputPaths(jointID, visit, baselineVisit, outDirectory)
+
+        with report.stage('read') :
+            movingImage = BHS_reg.readImage(imagePath)
+            movingSegImage = BHS_reg.readImage(segPath)
+
+        transform, info = registerVisit(fixed, movingImage, movingSegImage, previousTransform if chain else None, seed, verbose, report)
+        info['inputs'] = [imagePath, segPath]
+        info['outputs'] = [outputs['reg'], outputs['seg_reg'], outputs['tmat']]
+        report.info['visits'][getVisitName(visit)] = info
+        transforms[visit] = previousTransform = transform
+
+        with report.stage('resample') :
+            resampled, segResampled = BHS_resample.resampleImages( [movingImage, movingSegImage], [baselineImage, baselineSegImage],
+                                                                   transform, [grayInterpolator, segInterpolator] )
+
+        with report.stage('write') :
+            for outputPath, output in ( (outputs['reg'], resampled), (outputs['seg_reg'], segResampled) ) :
+                print('Writing to {}'.format(outputPath))
+                sitk.WriteImage(output, outputPath)
+            print('Writing to {}'.format(outputs['tmat']))
+            sitk.WriteTransform(transform, outputs['tmat'])
+
+        if remodellingParameters is not None :
+            print('Calculating formation and resorption')
+            with report.stage('remodelling') :
+                results = BHS_remodelling.remodelling(baselineImage, resampled, baselineSegImage, segResampled, remodellingParameters)
+                BHS_remodelling.writeRemodelling(results, os.path.splitext(outputs['reg'])[0])
+                stats = BHS_remodellingStats.remodellingStats(results)
+            BHS_remodellingStats.printStats(stats)
+
+    print('Writing to {}'.format(reportPath))
+    report.write(reportPath)
+
+    return transforms
+
+
+def runJoint(jointID, visits, outDirectory, kwargs):
+    # Run BHS_longitudinal() for one joint with its console output in the log directory
+    logPath = os.path.join(outDirectory, 'logs', jointID + '_LONGITUDINAL.log')
+    try :
+        with open(logPath, 'w') as log, contextlib.redirect_stdout(log) :
+            BHS_longitudinal(jointID, visits, outDirectory, **kwargs)
+    except Exception as e :
+        return jointID, repr(e)
+    return jointID, None
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'inputDirectory', type=str, help='A directory of MHA images of all visits' )
+    parser.add_argument( 'outDirectory', type=str, help='The output directory for registered images, transforms, reports and logs' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Number of joints to register at once (default: number of cores / threads)' )
+    parser.add_argument( '-t', dest='threads', type=int, default=1, help='Number of ITK threads per joint (default: 1)' )
+    parser.add_argument( '--baseline', type=int, default=None, help='The baseline visit in months (default: the first visit of each joint)' )
+    parser.add_argument( '--chain', action='store_true', help='Start each visit from the transform of the visit before it' )
+    parser.add_argument( '--profile', type=str, default='powell', choices=sorted(BHS_reg.REGISTRATION_PROFILES), help='The registration profile (default: powell)' )
+    parser.add_argument( '--mask', action='store_true', help='Only sample the metric inside the segmented baseline bone' )
+    parser.add_argument( '--mask-dilation', dest='maskDilation', type=int, default=0, help='Dilate the segmented bone by this many voxels before using it as a mask (default: 0)' )
+    parser.add_argument( '--crop', action='store_true', help='Crop the images to the bounding box of the segmented bone before registration' )
+    parser.add_argument( '--crop-margin', dest='cropMargin', type=float, default=2.0, help='The margin around the bone bounding box in mm (default: 2.0)' )
+    parser.add_argument( '--float32', action='store_true', help='Register in single precision instead of double precision' )
+    parser.add_argument( '--seed', type=int, default=1, help='Random seed of the metric sample points, shared by all visits (default: 1)' )
+    parser.add_argument( '--remodelling', action='store_true', help='Calculate formation/resorption images for every follow-up visit' )
+    BHS_remodelling.addParameterArguments(parser)
+    parser.add_argument( '--interpolator', type=str, default='linear', choices=BHS_resample.GRAY_INTERPOLATORS, help='The interpolator for the grayscale images (default: linear)' )
+    parser.add_argument( '--seg-interpolator', dest='segInterpolator', type=str, default='nearest', choices=BHS_resample.SEG_INTERPOLATORS, help='The interpolator for the segmented images (default: nearest)' )
+    parser.add_argument( '-v', '--verbose', action='count', default=0, help='Print the metric at every optimizer iteration' )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.inputDirectory) :
+        print()
+        print('Error: The input must be a directory')
+        sys.exit(1)
+
+    joints = findVisits(args.inputDirectory, args.baseline)
+    print('Found {} joints'.format(len(joints)))
+    os.makedirs(os.path.join(args.outDirectory, 'logs'), exist_ok=True)
+
+    kwargs = {
+        'chain': args.chain, 'profileName': args.profile, 'useMask': args.mask, 'maskDilation': args.maskDilation,
+        'crop': args.crop, 'cropMargin': args.cropMargin, 'float32': args.float32, 'seed': args.seed,
+        'remodellingParameters': BHS_remodelling.getParameters(args) if args.remodelling else None,
+        'grayInterpolator': args.interpolator, 'segInterpolator': args.segInterpolator, 'verbose': args.verbose
+    }
+    numberOfWorkers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=numberOfWorkers, initializer=BHS_reg.setNumberOfThreads, initargs=(args.threads,)) as executor :
+        futures = [executor.submit(runJoint, jointID, visits, args.outDirectory, kwargs) for jointID, visits in joints.items()]
+        for i, future in enumerate(as_completed(futures), 1) :
+            jointID, error = future.result()
+            print('[{}/{}] {}: {}'.format(i, len(futures), jointID, 'FAILED' if error else 'DONE'))
+            if error :
+                failed.append( (jointID, error) )
+
+    for jointID, error in failed :
+        print('FAILED: {} ({})'.format(jointID, error))
+    sys.exit(1 if failed else 0)
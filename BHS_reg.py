@@ -1,4 +1,4 @@
-#----------------------------------------------------- 
+#-----------------------------------------------------
 # BHS_reg.py
 #
 # Created by:   Michael Kuczynski
@@ -6,7 +6,7 @@
 #
 # Description: Perform 3 month XCT to 12 month XCT image registration for MCP joints.
 #              First, an initial alignment of images is obtained by matching geometric
-#              image centres. Final image alignment is obtained by optimizing the mean 
+#              image centres. Final image alignment is obtained by optimizing the mean
 #              squares error.
 #              To obtain more accurate registration of the metacarpal bone, an image mask
 #              of the metacarpal is provided as input.
@@ -21,125 +21,640 @@
 #         arg5 = The input 12MO XCT segmented image
 #         arg6 = The registered output 12MO to 03MO XCT segmented image
 #
+# Options: --profile = The registration profile (see REGISTRATION_PROFILES below, default: powell)
+#          --mask = Only sample the metric inside the segmented 03MO bone (arg4)
+#          --mask-dilation = Dilate the segmented bone by this many voxels before using it as a mask (default: 0)
+#          --crop = Crop both images to the bounding box of the segmented bone before registration
+#          --crop-margin = The margin around the bone bounding box in mm (default: 2.0)
+#          --float32 = Register in single precision instead of double precision
+#          --remodelling = Calculate formation/resorption images with BHS_remodelling.py after registration
+#                          (written next to arg3, see BHS_remodelling.py for the threshold and calibration options)
+#          --cache = A transform cache directory (see BHS_cache.py). If these images were already registered
+#                    with the same settings (and --initial transform), the cached transform is used and only
+#                    the resampling is done. If they were registered with other settings, that transform is
+#                    the initial transform, unless --initial is given.
+#          -v = Print the metric and parameters at every optimizer iteration (not printed by default)
+#          --interpolator = The interpolator for the registered grayscale image: linear or bspline (default: linear)
+#          --seg-interpolator = The interpolator for the registered segmented image: nearest or label (label Gaussian)
+#                               (default: nearest)
+#          --initial = A transformation matrix (.tfm) to start from instead of matching the image centres,
+#                      e.g. the transform of the middle stack of the same joint when registering the
+#                      proximal or distal stack (see the --stacks option of BHS_batch.py). It must be a rigid
+#                      (Euler3D) transform, any other transform stops with an error.
+#          --multi-start = Number of coarse registrations to start from (default: 0, only match the image centres).
+#                          The starts are the geometry initializer, then the geometry initializer rotated by
+#                          +/- --multi-start-angle degrees about the z, x and y axes (7 starts), then the same
+#                          for the moments (centre of mass) initializer (up to 14 starts). The coarse
+#                          registrations run in parallel processes on shrunk images with few samples, and
+#                          only the best one is refined with the registration profile.
+#          --multi-start-angle = The rotation of the multi-start starts in degrees (default: 20)
+#          --multi-start-workers = Number of processes for the multi-start registrations (default: one per start,
+#                                  up to the ITK thread count). The ITK threads are split between the processes.
+#
+# Outputs: Besides the registered images, the transformation matrix (BHS_<subject>_<joint>[_<stack>]_REG.tfm,
+#          next to arg3) and a run report (<tfm name>_REPORT.json) are written. The 03MO image (arg1) must be
+#          named BHS_<subject>_<visit>MO_<joint>[_<stack>][.mha, .nii, .nii.gz or .aim]. The report has the wall time, CPU time, peak RSS
+#          and ITK thread count of every stage (read, initializer, registration, resample, write),
+#          and the metric trajectory and stop condition of the registration (see BHS_report.py).
+#
 # Notes: this script should work with NIfTI images as well, but hasn't been tested.
+#        To register a whole cohort, use BHS_batch.py which calls BHS_reg() for each pair.
 #-----------------------------------------------------
 import os
+import sys
+import math
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import SimpleITK as sitk
 
-#----------------------------------------------#
-# STEP 1: Read in images
-#----------------------------------------------#
-# Parse input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument( 'input_03MO_gray', type=str, help='The input 03MO XCT grayscale image (path + filename)' )
-parser.add_argument( 'input_12MO_gray', type=str, help='The input 12MO XCT grayscale image (path + filename)' )
-parser.add_argument( 'output_12MO_to_03MO_reg', type=str, help='The registered output 12MO to 03MO XCT grayscale image (path + filename)' )
-parser.add_argument( 'input_03MO_seg', type=str, help='The input 03MO XCT segmented image (path + filename)' )
-parser.add_argument( 'input_12MO_seg', type=str, help='The input 12MO XCT segmented image (path + filename)' )
-parser.add_argument( 'output_12MO_to_03MO_seg_reg', type=str, help='The registered output 12MO to 03MO XCT segmented image (path + filename)' )
-args = parser.parse_args()
-
-# Grayscale images
-XCT_3MO_image_path = args.input_03MO_gray
-XCT_12MO_image_path = args.input_12MO_gray
-XCT_12MO_TO_03MO_REG_path = args.output_12MO_to_03MO_reg
-
-# Segmented images
-XCT_3MO_SEG_image_path = args.input_03MO_seg
-XCT_12MO_SEG_image_path = args.input_12MO_seg
-XCT_12MO_TO_03MO_SEG_REG_path = args.output_12MO_to_03MO_seg_reg
-
-# Get the sample number from the input images
-sampleNum = ( XCT_3MO_image_path.rsplit('BHS_', 1)[1] ).rsplit('_', 1)[0]
-
-# Get the MCP joint number from the input images
-mcp = ( XCT_3MO_image_path.rsplit('3MO_', 1)[1] ).rsplit('.', 1)[0]
-
-# Get the output directory
-outDirectory, outFilename = os.path.split(XCT_12MO_TO_03MO_REG_path)
-
-# Registered 12MO image and transformation matrix (12MO -> 03MO XCT image space):
-XCT_12MO_to_3MO_TMAT_path = os.path.join(outDirectory, 'BHS_' + sampleNum + '_' + mcp + '_REG.tfm')
-
-# Read images
-# 03MO
-print('Reading in {}'.format(XCT_3MO_image_path))
-XCT_3MO_image = sitk.ReadImage(XCT_3MO_image_path)
-
-print('Reading in {}'.format(XCT_3MO_SEG_image_path))
-XCT_3MO_SEG_image = sitk.ReadImage(XCT_3MO_SEG_image_path)
-
-# 12MO
-print('Reading in {}'.format(XCT_12MO_image_path))
-XCT_12MO_image = sitk.ReadImage(XCT_12MO_image_path)
-
-print('Reading in {}'.format(XCT_12MO_SEG_image_path))
-XCT_12MO_SEG_image = sitk.ReadImage(XCT_12MO_SEG_image_path)
-
-#----------------------------------------------#
-# STEP 2: Perform landmark transformation
-#----------------------------------------------#
-# Set initial transform by matching geometric centres
-initalTransform_12MO_to_03MO = sitk.CenteredTransformInitializer(XCT_3MO_image, XCT_12MO_image, sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-#----------------------------------------------#
-# STEP 3: Setup registration method
-#----------------------------------------------#
-# Connect all of the observers so that we can perform plotting during registration.
-def command_iteration(method) :
-  print( '{0:3} = {1:10.5f} : {2}'.format( method.GetOptimizerIteration(), method.GetMetricValue(), method.GetOptimizerPosition() ) )
-
-# Set up registration (12MO -> 03MO)
-reg = sitk.ImageRegistrationMethod()
-
-# Similarity metric settings:
-reg.SetMetricAsMeanSquares()
-reg.SetMetricSamplingStrategy(reg.RANDOM)
-reg.SetMetricSamplingPercentage(0.01)   # Make this value smaller for faster (less accurate) results 
-
-#Set Interpolator
-reg.SetInterpolator(sitk.sitkLinear)
-
-# Optimizer settings.
-reg.SetOptimizerAsPowell(numberOfIterations=500)
-reg.SetOptimizerScalesFromPhysicalShift()
-
-# Setup for the multi-resolution framework.
-reg.SetShrinkFactorsPerLevel(shrinkFactors = [1, 1])
-reg.SetSmoothingSigmasPerLevel(smoothingSigmas=[1.0, 0])
-reg.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-reg.AddCommand( sitk.sitkIterationEvent, lambda: command_iteration(reg) )
-
-#----------------------------------------------#
-# STEP 4: Perform the registration
-#----------------------------------------------#
-# Register 12MO and 03MO grayscale images
-# Don't optimize in-place, we would possibly like to run this cell multiple times.
-reg.SetInitialTransform(initalTransform_12MO_to_03MO, inPlace=False)
-print('Start registration')
-finalTransform = reg.Execute( sitk.Cast(XCT_3MO_image, sitk.sitkFloat64), sitk.Cast(XCT_12MO_image, sitk.sitkFloat64) )
-print('Writing to {}'.format(XCT_12MO_to_3MO_TMAT_path))
-sitk.WriteTransform(finalTransform, XCT_12MO_to_3MO_TMAT_path)
-
-#----------------------------------------------#
-# STEP 5: Resample and write registered image
-#----------------------------------------------#
-# Resample 12MO grayscale image
-print('Resampling')
-XCT_12MO_resampled = sitk.Resample( XCT_12MO_image, XCT_3MO_image, finalTransform, sitk.sitkLinear, 0.0, XCT_12MO_image.GetPixelID() )
-
-print('Writing to {}'.format(XCT_12MO_TO_03MO_REG_path))
-sitk.WriteImage(XCT_12MO_resampled, XCT_12MO_TO_03MO_REG_path)
-
-#----------------------------------------------#
-# STEP 6: Transform the segmented 12MO image
-#----------------------------------------------#
-# Resample 12MO segmented image
-print('Resampling')
-XCT_12MO_SEG_resampled = sitk.Resample( XCT_12MO_SEG_image, XCT_3MO_SEG_image, finalTransform, sitk.sitkLinear, 0.0, XCT_12MO_SEG_image.GetPixelID() )
-
-print('Writing to {}'.format(XCT_12MO_TO_03MO_SEG_REG_path))
-sitk.WriteImage(XCT_12MO_SEG_resampled, XCT_12MO_TO_03MO_SEG_REG_path)
\ No newline at end of file
+import BHS_cache
+import BHS_report
+import BHS_resample
+import BHS_remodelling
+import BHS_remodellingStats
+from util.util.imageNames import parseImageName, getPairID
+
+# Registration profiles:
+#   powell          = The original settings. Powell optimizer with two full resolution levels.
+#   powell_pyramid  = Powell optimizer with a 4/2/1 shrink factor pyramid.
+#   gradient        = Regular step gradient descent with a 4/2/1 shrink factor pyramid.
+#   lbfgs2          = Limited memory BFGS (libLBFGS) with a 4/2/1 shrink factor pyramid.
+#                     LBFGS2 is used rather than LBFGS-B because LBFGS-B ignores the optimizer
+#                     scales, which leaves the rotations badly scaled against the translations.
+# The pyramid smoothing sigmas (in mm) are about half the shrink factor in XCT-II voxels (60.7 um).
+# Gradient based optimizers need far fewer metric evaluations per iteration than Powell.
+REGISTRATION_PROFILES = {
+    'powell': {
+        'optimizer': 'powell',
+        'numberOfIterations': 500,
+        'shrinkFactors': [1, 1],
+        'smoothingSigmas': [1.0, 0],
+        'samplingPercentage': 0.01
+    },
+    'powell_pyramid': {
+        'optimizer': 'powell',
+        'numberOfIterations': 500,
+        'shrinkFactors': [4, 2, 1],
+        'smoothingSigmas': [0.12, 0.06, 0],
+        'samplingPercentage': 0.01
+    },
+    'gradient': {
+        'optimizer': 'gradient',
+        'numberOfIterations': 200,
+        'learningRate': 1.0,
+        'minStep': 1e-4,
+        'relaxationFactor': 0.5,
+        'shrinkFactors': [4, 2, 1],
+        'smoothingSigmas': [0.12, 0.06, 0],
+        'samplingPercentage': 0.01
+    },
+    'lbfgs2': {
+        'optimizer': 'lbfgs2',
+        'numberOfIterations': 100,
+        'solutionAccuracy': 1e-5,
+        'shrinkFactors': [4, 2, 1],
+        'smoothingSigmas': [0.12, 0.06, 0],
+        'samplingPercentage': 0.01
+    }
+}
+
+# Coarse registrations of the multi-start initializer (see multiStartTransform)
+# Images are smoothed (sigma of half the shrink factor in voxels) and shrunk by up to shrinkFactor,
+# keeping at least minimumSize voxels along each axis, before they are sent to the worker processes
+MULTI_START = {
+    'optimizer': 'gradient',
+    'numberOfIterations': 100,
+    'learningRate': 2.0,
+    'minStep': 1e-3,
+    'relaxationFactor': 0.7,
+    'shrinkFactor': 4,
+    'minimumSize': 32,
+    'samplingPercentage': 0.05
+}
+
+MULTI_START_INITIALIZERS = {
+    'geometry': sitk.CenteredTransformInitializerFilter.GEOMETRY,
+    'moments': sitk.CenteredTransformInitializerFilter.MOMENTS
+}
+
+
+def setOptimizer(reg, profile):
+    if profile['optimizer'] == 'powell' :
+        reg.SetOptimizerAsPowell(numberOfIterations=profile['numberOfIterations'])
+        reg.SetOptimizerScalesFromPhysicalShift()
+    elif profile['optimizer'] == 'gradient' :
+        reg.SetOptimizerAsRegularStepGradientDescent(learningRate=profile['learningRate'], minStep=profile['minStep'],
+                                                     numberOfIterations=profile['numberOfIterations'],
+                                                     relaxationFactor=profile['relaxationFactor'])
+        reg.SetOptimizerScalesFromPhysicalShift()
+    elif profile['optimizer'] == 'lbfgs2' :
+        reg.SetOptimizerAsLBFGS2(solutionAccuracy=profile['solutionAccuracy'],
+                                 numberOfIterations=profile['numberOfIterations'])
+        reg.SetOptimizerScalesFromPhysicalShift()
+    else :
+        raise ValueError('Unknown optimizer: {}'.format(profile['optimizer']))
+
+
+def evaluateMetric(fixedImage, movingImage, transform, samplingPercentage=0.01, fixedMask=None):
+    # Evaluate the metric at full resolution with a fixed seed so that profiles can be compared
+    # With a fixed mask, only the samples inside it count, the same as in the registration
+    reg = sitk.ImageRegistrationMethod()
+    reg.SetMetricAsMeanSquares()
+    reg.SetMetricSamplingStrategy(reg.RANDOM)
+    reg.SetMetricSamplingPercentage(samplingPercentage, seed=1)
+    if fixedMask is not None :
+        reg.SetMetricFixedMask(fixedMask)
+    reg.SetInterpolator(sitk.sitkLinear)
+    reg.SetInitialTransform(transform)
+    return reg.MetricEvaluate(fixedImage, movingImage)
+
+
+def getMetricMask(segImage, dilationRadius=0):
+    # Any non-zero voxel of the segmented image is bone
+    mask = segImage != 0
+
+    if dilationRadius > 0 :
+        mask = sitk.BinaryDilate(mask, [int(dilationRadius)] * mask.GetDimension())
+
+    return mask
+
+
+def getRegistrationMethod(profile, fixedMask=None, seed=sitk.sitkWallClock, metricTrajectory=None, verbose=0, level=None):
+    # A registration method with the metric, sampling, mask, interpolator and optimizer of a profile
+    # (the pyramid and initial transform are set by the caller)
+    # The metric of every iteration is appended to metricTrajectory as [level, iteration, metric], where
+    # level is the pyramid level of the method unless one is given. With verbose > 0, it is also printed.
+    reg = sitk.ImageRegistrationMethod()
+
+    # Similarity metric settings:
+    reg.SetMetricAsMeanSquares()
+    reg.SetMetricSamplingStrategy(reg.RANDOM)
+    reg.SetMetricSamplingPercentage(profile['samplingPercentage'], seed=seed)   # Make this value smaller for faster (less accurate) results
+    if fixedMask is not None :
+        reg.SetMetricFixedMask(fixedMask)
+
+    #Set Interpolator
+    reg.SetInterpolator(sitk.sitkLinear)
+
+    # Optimizer settings.
+    setOptimizer(reg, profile)
+
+    # Connect the observer so that the metric of every iteration is kept for the run report
+    if metricTrajectory is not None :
+        def command_iteration() :
+          metricTrajectory.append( [reg.GetCurrentLevel() if level is None else level, reg.GetOptimizerIteration(), reg.GetMetricValue()] )
+          if verbose > 0 :
+            print( '{0:3} = {1:10.5f} : {2}'.format( reg.GetOptimizerIteration(), reg.GetMetricValue(), reg.GetOptimizerPosition() ) )
+        reg.AddCommand( sitk.sitkIterationEvent, command_iteration )
+
+    return reg
+
+
+def cropToBone(image, segImage, margin=2.0):
+    # Crop an image to the bounding box of the segmented bone plus a margin (in mm)
+    # The cropped image keeps its physical position, so a transform found on the
+    # cropped images is also valid for the full images
+    shapeStats = sitk.LabelShapeStatisticsImageFilter()
+    shapeStats.Execute( sitk.Cast(segImage != 0, sitk.sitkUInt8) )
+    if not shapeStats.HasLabel(1) :
+        print('Warning: The segmented image is empty, the image will not be cropped')
+        return image
+
+    # Bounding box in the segmented image: (x, y, z, size x, size y, size z)
+    dimension = segImage.GetDimension()
+    boundingBox = shapeStats.GetBoundingBox(1)
+    lowerCorner = segImage.TransformIndexToPhysicalPoint(boundingBox[:dimension])
+    upperCorner = segImage.TransformIndexToPhysicalPoint([boundingBox[i] + boundingBox[dimension + i] - 1 for i in range(dimension)])
+
+    # Find the same region in the (grayscale) image and grow it by the margin
+    lowerIndex = image.TransformPhysicalPointToContinuousIndex(lowerCorner)
+    upperIndex = image.TransformPhysicalPointToContinuousIndex(upperCorner)
+    start = []
+    stop = []
+    for i in range(dimension) :
+        marginVoxels = margin / image.GetSpacing()[i]
+        start.append( max(0, int(min(lowerIndex[i], upperIndex[i]) - marginVoxels)) )
+        stop.append( min(image.GetSize()[i], int(max(lowerIndex[i], upperIndex[i]) + marginVoxels) + 2) )
+
+    return sitk.RegionOfInterest(image, [stop[i] - start[i] for i in range(dimension)], start)
+
+
+def getStarts(numberOfStarts, angle):
+    # (initializer, rotation about x, y, z in radians): the geometry initializer without a rotation and
+    # rotated by +/- angle about z (the scan axis, along the finger), x and y, then the same for the
+    # moments initializer. 8 starts try every axis in both directions with the geometry initializer.
+    rotations = [(0.0, 0.0, 0.0)]
+    for axis in (2, 0, 1) :
+        for sign in (1, -1) :
+            rotation = [0.0, 0.0, 0.0]
+            rotation[axis] = sign * math.radians(angle)
+            rotations.append( tuple(rotation) )
+
+    starts = [(initializer, rotation) for initializer in MULTI_START_INITIALIZERS for rotation in rotations]
+    return starts[:numberOfStarts]
+
+
+def setNumberOfThreads(numberOfThreads):
+    # Initializer of the multi-start worker processes
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+
+
+def coarseRegister(fixedImage, movingImage, fixedMask, transformParameters, center, seed=1):
+    # One coarse registration of the multi-start initializer (run in a worker process)
+    # Returns the metric (same sample points inside the mask for every start) and the transform parameters
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(center)
+    transform.SetParameters(transformParameters)
+
+    reg = getRegistrationMethod(MULTI_START, fixedMask, seed)
+    reg.SetInitialTransform(transform, inPlace=True)
+    reg.Execute(fixedImage, movingImage)
+
+    return evaluateMetric(fixedImage, movingImage, transform, MULTI_START['samplingPercentage'], fixedMask), list( transform.GetParameters() )
+
+
+def multiStartTransform(fixedImage, movingImage, fixedMask=None, numberOfStarts=8, angle=20.0, numberOfWorkers=None):
+    # Run coarse registrations from several starts in parallel and return the best transform
+    # and the results of every start
+    # The registration may use as many cores as it has ITK threads (all cores when run on its own,
+    # -t in BHS_batch.py). By default, there is one worker process per start up to that number, and
+    # the threads are split between the workers. With one worker, the starts run in this process.
+    shrinkFactor = max( 1, min(MULTI_START['shrinkFactor'], min(fixedImage.GetSize()) // MULTI_START['minimumSize']) )
+    shrinkFactors = [shrinkFactor] * fixedImage.GetDimension()
+    coarseImages = []
+    for image in (fixedImage, movingImage) :
+        smoothed = sitk.SmoothingRecursiveGaussian( sitk.Cast(image, sitk.sitkFloat32), 0.5 * shrinkFactor * max(image.GetSpacing()) )
+        coarseImages.append( sitk.Shrink(smoothed, shrinkFactors) )
+    fixedCoarse, movingCoarse = coarseImages
+    maskCoarse = sitk.Shrink(sitk.Cast(fixedMask, sitk.sitkUInt8), shrinkFactors) if fixedMask is not None else None
+
+    # Euler3D transforms are sent to the workers as parameters and centre
+    starts = []
+    for initializer, rotation in getStarts(numberOfStarts, angle) :
+        transform = sitk.CenteredTransformInitializer(fixedImage, movingImage, sitk.Euler3DTransform(), MULTI_START_INITIALIZERS[initializer])
+        transform.SetRotation(*rotation)
+        starts.append( (initializer, rotation, transform.GetCenter(), transform.GetParameters()) )
+
+    numberOfThreads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    numberOfWorkers = max( 1, min(len(starts), numberOfWorkers or numberOfThreads) )
+    print('Running {} coarse registrations (shrink factor {}, {} worker(s))'.format(len(starts), shrinkFactor, numberOfWorkers))
+    if numberOfWorkers == 1 :
+        metrics = [ coarseRegister(fixedCoarse, movingCoarse, maskCoarse, parameters, center) for _, _, center, parameters in starts ]
+    else :
+        with ProcessPoolExecutor(max_workers=numberOfWorkers, initializer=setNumberOfThreads,
+                                 initargs=(max(1, numberOfThreads // numberOfWorkers),)) as executor :
+            futures = [ executor.submit(coarseRegister, fixedCoarse, movingCoarse, maskCoarse, parameters, center)
+                        for _, _, center, parameters in starts ]
+            metrics = [ future.result() for future in futures ]
+
+    results = []
+    for (initializer, rotation, center, _), (metric, parameters) in zip(starts, metrics) :
+        results.append({'initializer': initializer, 'rotation': list(rotation), 'metric': metric,
+                        'center': list(center), 'parameters': parameters})
+        print('  {:8} rotation ({:6.3f}, {:6.3f}, {:6.3f}): metric {:.5f}'.format(initializer, *rotation, metric))
+
+    best = min(results, key=lambda result: result['metric'])
+    print('Best start: {} rotation ({:.3f}, {:.3f}, {:.3f})'.format(best['initializer'], *best['rotation']))
+
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(best['center'])
+    transform.SetParameters(best['parameters'])
+    return transform, results
+
+
+def getTransformPath(XCT_3MO_image_path, XCT_12MO_TO_03MO_REG_path):
+    # Registered 12MO image and transformation matrix (12MO -> 03MO XCT image space):
+    # BHS_<subject>_<joint>[_<stack>]_REG.tfm in the output directory of the registered image
+    info = parseImageName(XCT_3MO_image_path)
+    if info is None :
+        raise ValueError('Cannot name the transformation matrix after {}, the 03MO image must be named '
+                         'BHS_<subject>_<visit>MO_<joint>[_<stack>]'.format(XCT_3MO_image_path))
+
+    return os.path.join(os.path.dirname(XCT_12MO_TO_03MO_REG_path), getPairID(info) + '_REG.tfm')
+
+
+def getProfile(profileName):
+    # Returns the profile name and settings for a name from REGISTRATION_PROFILES or a profile dictionary
+    if isinstance(profileName, dict) :
+        return profileName.get('name', 'custom'), profileName
+    return profileName, REGISTRATION_PROFILES[profileName]
+
+
+def getCacheKeys(XCT_3MO_image, XCT_12MO_image, XCT_3MO_SEG_image, XCT_12MO_SEG_image,
+                 profileName='powell', useMask=False, maskDilation=0, crop=False, cropMargin=2.0, float32=False,
+                 multiStart=0, multiStartAngle=20.0, initialTransform=None) :
+    # Keys of the transform cache (see BHS_cache.py): one for the grayscale images and
+    # one for everything else that changes the registration result
+    profileName, profile = getProfile(profileName)
+    parameters = {
+        'profile': {key: value for key, value in profile.items() if key != 'name'},
+        'useMask': useMask,
+        'maskDilation': maskDilation if useMask else 0,
+        'crop': crop,
+        'cropMargin': cropMargin if crop else 0,
+        'float32': float32
+    }
+    if multiStart :
+        parameters['multiStart'] = {'starts': multiStart, 'angle': multiStartAngle, 'settings': MULTI_START}
+    if initialTransform is not None :
+        parameters['initialTransform'] = BHS_cache.hashTransform(initialTransform)
+
+    # The segmented images only change the result if they are used as a mask or for cropping
+    if useMask or crop :
+        parameters['XCT_3MO_SEG'] = BHS_cache.hashImage(XCT_3MO_SEG_image)
+    if crop :
+        parameters['XCT_12MO_SEG'] = BHS_cache.hashImage(XCT_12MO_SEG_image)
+
+    return BHS_cache.getImageKey(XCT_3MO_image, XCT_12MO_image), BHS_cache.hashParameters(parameters), parameters
+
+
+def registerImages(XCT_3MO_image, XCT_12MO_image, XCT_3MO_SEG_image=None, XCT_12MO_SEG_image=None,
+                   profileName='powell', useMask=False, maskDilation=0, crop=False, cropMargin=2.0, float32=False,
+                   initialTransform=None, verbose=0, report=None, multiStart=0, multiStartAngle=20.0, multiStartWorkers=None) :
+    # Register the 12MO image to the 03MO image and return the transform and a summary of the run
+    # A profile name from REGISTRATION_PROFILES or a profile dictionary can be given
+    # If an initial transform is given (e.g. from the transform cache), it is used instead of
+    # matching the geometric image centres
+    # Otherwise, with multiStart > 0, the best of that many coarse registrations is the initial transform
+    # (run by multiStartWorkers processes, see multiStartTransform)
+    # The stages are timed in the given RunReport (see BHS_report.py)
+    # With verbose > 0, the metric is printed at every optimizer iteration
+    profileName, profile = getProfile(profileName)
+    if report is None :
+        report = BHS_report.RunReport()
+
+    # Register the bone bounding boxes only. The full images are still used for resampling.
+    if crop :
+        with report.stage('crop') :
+            XCT_3MO_reg_image = cropToBone(XCT_3MO_image, XCT_3MO_SEG_image, cropMargin)
+            XCT_12MO_reg_image = cropToBone(XCT_12MO_image, XCT_12MO_SEG_image, cropMargin)
+        print('Cropped 03MO image from {} to {}'.format(XCT_3MO_image.GetSize(), XCT_3MO_reg_image.GetSize()))
+        print('Cropped 12MO image from {} to {}'.format(XCT_12MO_image.GetSize(), XCT_12MO_reg_image.GetSize()))
+    else :
+        XCT_3MO_reg_image = XCT_3MO_image
+        XCT_12MO_reg_image = XCT_12MO_image
+
+    #----------------------------------------------#
+    # STEP 2: Perform landmark transformation
+    #----------------------------------------------#
+    # Set initial transform by matching geometric centres
+    # Restrict metric sampling to the segmented bone so that samples are not spent on air and soft tissue
+    # Only the fixed mask is used. A moving mask discards samples that map outside the 12MO bone,
+    # which lets the optimizer lower the metric by shrinking the overlap instead of aligning the images.
+    # The mask is used by the multi-start ranking, the registration and the final metric.
+    fixedMask = None
+    if useMask :
+        print('Using the segmented 03MO image as the metric mask (dilation: {} voxels)'.format(maskDilation))
+        fixedMask = getMetricMask(XCT_3MO_SEG_image, maskDilation)
+
+    multiStartResults = None
+    with report.stage('initializer') :
+        if initialTransform is not None :
+            print('Starting from the given initial transform')
+            initalTransform_12MO_to_03MO = sitk.Euler3DTransform(initialTransform)
+        elif multiStart > 0 :
+            initalTransform_12MO_to_03MO, multiStartResults = multiStartTransform( XCT_3MO_reg_image, XCT_12MO_reg_image, fixedMask,
+                                                                                   multiStart, multiStartAngle, multiStartWorkers )
+        else :
+            initalTransform_12MO_to_03MO = sitk.CenteredTransformInitializer(XCT_3MO_reg_image, XCT_12MO_reg_image, sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY)
+
+    #----------------------------------------------#
+    # STEP 3: Setup registration method
+    #----------------------------------------------#
+
+    # Set up registration (12MO -> 03MO)
+    # The metric of every iteration (over all levels) is kept for the run report.
+    metricTrajectory = []
+    reg = getRegistrationMethod(profile, fixedMask, metricTrajectory=metricTrajectory, verbose=verbose)
+
+    # Setup for the multi-resolution framework.
+    reg.SetShrinkFactorsPerLevel(shrinkFactors = profile['shrinkFactors'])
+    reg.SetSmoothingSigmasPerLevel(smoothingSigmas=profile['smoothingSigmas'])
+    reg.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+    #----------------------------------------------#
+    # STEP 4: Perform the registration
+    #----------------------------------------------#
+    # Register 12MO and 03MO grayscale images
+    # Don't optimize in-place, we would possibly like to run this cell multiple times.
+    reg.SetInitialTransform(initalTransform_12MO_to_03MO, inPlace=False)
+    print('Start registration')
+    pixelType = sitk.sitkFloat32 if float32 else sitk.sitkFloat64
+    XCT_3MO_image_float = sitk.Cast(XCT_3MO_reg_image, pixelType)
+    XCT_12MO_image_float = sitk.Cast(XCT_12MO_reg_image, pixelType)
+
+    with report.stage('registration') :
+        finalTransform = reg.Execute( XCT_3MO_image_float, XCT_12MO_image_float )
+    wallTime = report.stages[-1]['wallTime']
+
+    # Report the final metric at full resolution so that profiles can be compared
+    with report.stage('finalMetric') :
+        finalMetric = evaluateMetric(XCT_3MO_image_float, XCT_12MO_image_float, finalTransform, profile['samplingPercentage'], fixedMask)
+    info = {
+        'profile': profileName,
+        'wallTime': wallTime,
+        'finalMetric': finalMetric,
+        'iterations': len(metricTrajectory),
+        'stopCondition': reg.GetOptimizerStopConditionDescription(),
+        'initializer': 'given' if initialTransform is not None else ( 'multi-start' if multiStartResults else 'geometry' ),
+        'multiStart': multiStartResults,
+        'finalParameters': list( BHS_cache.getEulerTransform(finalTransform).GetParameters() ),
+        'metricTrajectory': metricTrajectory
+    }
+    print('Profile {}: {:.2f} s, final metric {:.5f} ({})'.format(profileName, wallTime, finalMetric, info['stopCondition']))
+
+    return finalTransform, info
+
+
+def getInitialTransform(initialTransform) :
+    # The Euler3DTransform of an initial transform (a transform or .tfm file)
+    # Any other transform is an error rather than silently matching the image centres instead
+    name = 'The initial transform'
+    if isinstance(initialTransform, str) :
+        print('Reading in {}'.format(initialTransform))
+        name = initialTransform
+        initialTransform = sitk.ReadTransform(initialTransform)
+
+    eulerTransform = BHS_cache.getEulerTransform(initialTransform)
+    if eulerTransform is None :
+        raise ValueError('{} is not a rigid (Euler3D) transform ({}). The registration can only start from '
+                         'a rigid transform, e.g. one written by BHS_reg.py'.format(name, initialTransform.Downcast().GetName()))
+    return eulerTransform
+
+
+def readImage(imagePath, imageCache=None) :
+    # Read an image, or take it from the image cache if it has not changed since it was read.
+    # The cache can be any dictionary-like object (e.g. the LRU cache of BHS_worker.py).
+    print('Reading in {}'.format(imagePath))
+    if imageCache is None :
+        return sitk.ReadImage(imagePath)
+
+    stat = os.stat(imagePath)
+    key = (os.path.abspath(imagePath), stat.st_mtime_ns, stat.st_size)
+    image = imageCache.get(key)
+    if image is None :
+        image = sitk.ReadImage(imagePath)
+        imageCache[key] = image
+    else :
+        print('Using the cached image')
+
+    return image
+
+
+def BHS_reg(XCT_3MO_image_path, XCT_12MO_image_path, XCT_12MO_TO_03MO_REG_path,
+            XCT_3MO_SEG_image_path, XCT_12MO_SEG_image_path, XCT_12MO_TO_03MO_SEG_REG_path,
+            XCT_12MO_to_3MO_TMAT_path=None, profileName='powell', useMask=False, maskDilation=0,
+            crop=False, cropMargin=2.0, float32=False, remodellingParameters=None, cacheDirectory=None,
+            grayInterpolator='linear', segInterpolator='nearest', verbose=0, imageCache=None, initialTransform=None,
+            multiStart=0, multiStartAngle=20.0, multiStartWorkers=None) :
+    # The transformation matrix is named after the sample and MCP joint unless a path is given
+    # An initial transform (a transform or .tfm file) is part of the cache key. It is used unless the
+    # cache has a transform of these images with the same settings and initial transform.
+    if not XCT_12MO_to_3MO_TMAT_path :
+        XCT_12MO_to_3MO_TMAT_path = getTransformPath(XCT_3MO_image_path, XCT_12MO_TO_03MO_REG_path)
+
+    # Every stage is timed and written to a JSON report next to the transformation matrix
+    report = BHS_report.RunReport()
+    reportPath = os.path.splitext(XCT_12MO_to_3MO_TMAT_path)[0] + '_REPORT.json'
+    report.info.update({
+        'inputs': [XCT_3MO_image_path, XCT_12MO_image_path, XCT_3MO_SEG_image_path, XCT_12MO_SEG_image_path],
+        'outputs': [XCT_12MO_TO_03MO_REG_path, XCT_12MO_TO_03MO_SEG_REG_path, XCT_12MO_to_3MO_TMAT_path],
+        'settings': {'profile': getProfile(profileName)[0], 'useMask': useMask, 'maskDilation': maskDilation, 'crop': crop,
+                     'cropMargin': cropMargin, 'float32': float32, 'remodelling': remodellingParameters is not None,
+                     'cache': cacheDirectory or None, 'grayInterpolator': grayInterpolator, 'segInterpolator': segInterpolator,
+                     'initialTransform': initialTransform if isinstance(initialTransform, str) else initialTransform is not None,
+                     'multiStart': multiStart, 'multiStartAngle': multiStartAngle, 'multiStartWorkers': multiStartWorkers}
+    })
+
+    if initialTransform is not None :
+        initialTransform = getInitialTransform(initialTransform)
+
+    #----------------------------------------------#
+    # STEP 1: Read in images
+    #----------------------------------------------#
+    with report.stage('read') :
+        # 03MO
+        XCT_3MO_image = readImage(XCT_3MO_image_path, imageCache)
+        XCT_3MO_SEG_image = readImage(XCT_3MO_SEG_image_path, imageCache)
+
+        # 12MO
+        XCT_12MO_image = readImage(XCT_12MO_image_path, imageCache)
+        XCT_12MO_SEG_image = readImage(XCT_12MO_SEG_image_path, imageCache)
+
+    # Look for a transform of the same images in the cache.
+    # Same parameters: skip the optimization. Other parameters: start from the cached transform.
+    cachedTransform = None
+    exact = False
+    if cacheDirectory :
+        with report.stage('cache') :
+            imageKey, parameterKey, parameters = getCacheKeys(XCT_3MO_image, XCT_12MO_image, XCT_3MO_SEG_image, XCT_12MO_SEG_image,
+                                                              profileName, useMask, maskDilation, crop, cropMargin, float32,
+                                                              multiStart, multiStartAngle, initialTransform)
+            cachedTransform, exact = BHS_cache.readCachedTransform(cacheDirectory, imageKey, parameterKey)
+
+        if exact :
+            print('Using the cached transform {}'.format(os.path.join(cacheDirectory, imageKey, parameterKey + '.tfm')))
+        elif cachedTransform is not None and initialTransform is None :
+            print('Using a cached transform of these images as the initial transform')
+
+    # A given initial transform wins over a cached transform of other settings
+    if not exact and initialTransform is not None :
+        cachedTransform = initialTransform
+
+    if exact :
+        finalTransform = cachedTransform
+        report.info['registration'] = {'cached': True}
+    else :
+        finalTransform, info = registerImages(XCT_3MO_image, XCT_12MO_image, XCT_3MO_SEG_image, XCT_12MO_SEG_image,
+                                              profileName, useMask, maskDilation, crop, cropMargin, float32, cachedTransform,
+                                              verbose, report, multiStart, multiStartAngle, multiStartWorkers)
+        report.info['registration'] = info
+        if cacheDirectory :
+            BHS_cache.writeCachedTransform(cacheDirectory, imageKey, parameterKey, finalTransform, parameters, info)
+
+    #----------------------------------------------#
+    # STEP 5: Resample the grayscale and segmented 12MO images
+    #----------------------------------------------#
+    # Both images are resampled with the same transform. The segmented image uses a label
+    # interpolator so that its values stay 0/127 (sitkLinear blurs the mask edges).
+    print('Resampling')
+    with report.stage('resample') :
+        XCT_12MO_resampled, XCT_12MO_SEG_resampled = BHS_resample.resampleImages( [XCT_12MO_image, XCT_12MO_SEG_image],
+                                                                                  [XCT_3MO_image, XCT_3MO_SEG_image],
+                                                                                  finalTransform, [grayInterpolator, segInterpolator] )
+
+    #----------------------------------------------#
+    # STEP 6: Write the transformation matrix and registered images
+    #----------------------------------------------#
+    with report.stage('write') :
+        print('Writing to {}'.format(XCT_12MO_to_3MO_TMAT_path))
+        sitk.WriteTransform(finalTransform, XCT_12MO_to_3MO_TMAT_path)
+
+        print('Writing to {}'.format(XCT_12MO_TO_03MO_REG_path))
+        sitk.WriteImage(XCT_12MO_resampled, XCT_12MO_TO_03MO_REG_path)
+
+        print('Writing to {}'.format(XCT_12MO_TO_03MO_SEG_REG_path))
+        sitk.WriteImage(XCT_12MO_SEG_resampled, XCT_12MO_TO_03MO_SEG_REG_path)
+
+    #----------------------------------------------#
+    # STEP 7: Formation and resorption (optional)
+    #----------------------------------------------#
+    # Same as BHS_REMODELLING_JUNE2020.COM, using the images that are already in memory
+    if remodellingParameters is not None :
+        print('Calculating formation and resorption')
+        with report.stage('remodelling') :
+            results = BHS_remodelling.remodelling(XCT_3MO_image, XCT_12MO_resampled, XCT_3MO_SEG_image, XCT_12MO_SEG_resampled, remodellingParameters)
+            BHS_remodelling.writeRemodelling(results, os.path.splitext(XCT_12MO_TO_03MO_REG_path)[0])
+            stats = BHS_remodellingStats.remodellingStats(results)
+        BHS_remodellingStats.printStats(stats)
+
+    print('Writing to {}'.format(reportPath))
+    report.write(reportPath)
+
+    return finalTransform
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'input_03MO_gray', type=str, help='The input 03MO XCT grayscale image (path + filename)' )
+    parser.add_argument( 'input_12MO_gray', type=str, help='The input 12MO XCT grayscale image (path + filename)' )
+    parser.add_argument( 'output_12MO_to_03MO_reg', type=str, help='The registered output 12MO to 03MO XCT grayscale image (path + filename)' )
+    parser.add_argument( 'input_03MO_seg', type=str, help='The input 03MO XCT segmented image (path + filename)' )
+    parser.add_argument( 'input_12MO_seg', type=str, help='The input 12MO XCT segmented image (path + filename)' )
+    parser.add_argument( 'output_12MO_to_03MO_seg_reg', type=str, help='The registered output 12MO to 03MO XCT segmented image (path + filename)' )
+    parser.add_argument( '--profile', type=str, default='powell', choices=sorted(REGISTRATION_PROFILES), help='The registration profile (default: powell)' )
+    parser.add_argument( '--mask', action='store_true', help='Only sample the metric inside the segmented bone' )
+    parser.add_argument( '--mask-dilation', dest='maskDilation', type=int, default=0, help='Dilate the segmented bone by this many voxels before using it as a mask (default: 0)' )
+    parser.add_argument( '--crop', action='store_true', help='Crop both images to the bounding box of the segmented bone before registration' )
+    parser.add_argument( '--crop-margin', dest='cropMargin', type=float, default=2.0, help='The margin around the bone bounding box in mm (default: 2.0)' )
+    parser.add_argument( '--float32', action='store_true', help='Register in single precision instead of double precision' )
+    parser.add_argument( '--remodelling', action='store_true', help='Calculate formation/resorption images after registration' )
+    BHS_remodelling.addParameterArguments(parser)
+    parser.add_argument( '--cache', type=str, default='', help='The transform cache directory (default: no cache)' )
+    parser.add_argument( '-v', '--verbose', action='count', default=0, help='Print the metric at every optimizer iteration' )
+    parser.add_argument( '--interpolator', type=str, default='linear', choices=BHS_resample.GRAY_INTERPOLATORS, help='The interpolator for the grayscale image (default: linear)' )
+    parser.add_argument( '--seg-interpolator', dest='segInterpolator', type=str, default='nearest', choices=BHS_resample.SEG_INTERPOLATORS, help='The interpolator for the segmented image (default: nearest)' )
+    parser.add_argument( '--multi-start', dest='multiStart', type=int, default=0, help='Number of coarse registrations to start from, the best is refined (default: 0, match the image centres)' )
+    parser.add_argument( '--multi-start-angle', dest='multiStartAngle', type=float, default=20.0, help='The rotation of the multi-start starts in degrees (default: 20)' )
+    parser.add_argument( '--multi-start-workers', dest='multiStartWorkers', type=int, default=0, help='Number of processes for the multi-start registrations (default: one per start up to the ITK thread count)' )
+    parser.add_argument( '--initial', type=str, default=None, help='A transformation matrix (.tfm) to start the registration from (default: match the image centres)' )
+    args = parser.parse_args()
+
+    # The transformation matrix is named after the subject and joint of the 03MO image
+    # A file name that does not parse or an --initial transform that is not rigid stops the run
+    try :
+        tmatPath = getTransformPath(args.input_03MO_gray, args.output_12MO_to_03MO_reg)
+        BHS_reg(args.input_03MO_gray, args.input_12MO_gray, args.output_12MO_to_03MO_reg,
+                args.input_03MO_seg, args.input_12MO_seg, args.output_12MO_to_03MO_seg_reg,
+                tmatPath, profileName=args.profile, useMask=args.mask, maskDilation=args.maskDilation,
+                crop=args.crop, cropMargin=args.cropMargin, float32=args.float32,
+                remodellingParameters=BHS_remodelling.getParameters(args) if args.remodelling else None,
+                cacheDirectory=args.cache, grayInterpolator=args.interpolator, segInterpolator=args.segInterpolator,
+                verbose=args.verbose, initialTransform=args.initial, multiStart=args.multiStart, multiStartAngle=args.multiStartAngle,
+                multiStartWorkers=args.multiStartWorkers)
+    except ValueError as e :
+        print()
+        print('Error: {}'.format(e))
+        sys.exit(1)
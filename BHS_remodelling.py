@@ -0,0 +1,262 @@
+#-----------------------------------------------------
+# BHS_remodelling.py
+#
+# Created on:   18-10-2026
+#
+# Description: Python version of BHS_REMODELLING_JUNE2020.COM. Calculates bone formation
+#              (gain) and resorption (loss) from registered 03MO and 12MO XCT images, so the
+#              images do not have to be sent back to the UCT system after BHS_reg.py.
+#              The IPL steps are:
+#                   1. norm_max               -> slab of the common (registered) region
+#                   2. gobj_maskaimpeel_ow    -> 03MO/12MO masks cropped to the peeled slab (MIDMASK)
+#                   3. subtract_aims          -> 12MO - 03MO (gain) and 03MO - 12MO (loss)
+#                   4. threshold              -> differences above THRESHOLD_SEG
+#                   5. cl_nr_extract          -> remove components smaller than cl_nr_min voxels
+#                   6. seg_gauss              -> segmented 03MO bone
+#                   7. concat                 -> colour-coded map (grey bone, green gain, purple loss)
+#              All steps use multi-threaded SimpleITK filters.
+#
+#-----------------------------------------------------
+# Usage: python BHS_remodelling.py arg1 arg2 arg3 arg4 arg5
+#
+# Where:  arg1 = The 03MO XCT grayscale image
+#         arg2 = The registered 12MO to 03MO XCT grayscale image (from BHS_reg.py)
+#         arg3 = The 03MO XCT mask (segmented) image
+#         arg4 = The registered 12MO to 03MO XCT mask (segmented) image (from BHS_reg.py)
+#         arg5 = The output path + prefix, e.g. /data/BHS_030_MCP2
+#
+# Outputs: <arg5>_SLAB.mha, <arg5>_03MO_MIDMASK.mha, <arg5>_12MO_MIDMASK.mha,
+#          <arg5>_FORMATION.mha, <arg5>_RESORPTION.mha and <arg5>_ADD_SEG.mha
+#
+# Options: --aim-log = The AIM processing log of the images (the .txt written by fileConverter.py, or the AIM
+#                      itself). Mu_Scaling, Density: slope and Density: intercept are read from it.
+#          --mu-scaling, --density-slope, --density-intercept = Override the calibration of the log
+#          (see addParameterArguments for the thresholds and cl_nr_min)
+#
+# Notes: Thresholds are given in mg HA/ccm (IPL unit 2) and converted to native image values
+#        with the density calibration of the scanner (Mu_Scaling, Density: slope and
+#        Density: intercept in the AIM processing log). MHA images do not keep the log, so
+#        without --aim-log the calibration is the scanner default below unless it is given.
+#        The defaults reproduce the seg_gauss example in the README (125 mg HA/ccm = 2586 native).
+#        For difference images too large to label in memory, BHS_components.py does the
+#        cl_nr_extract step one slab at a time (memory-mapped, same result).
+#-----------------------------------------------------
+import os
+import sys
+import math
+import argparse
+
+import SimpleITK as sitk
+
+import BHS_resample
+from util.util.aimIO import AIMFile
+from util.util.aimLog import parseAIMLog, readAIMLog
+from util.util.imageNames import splitImageName
+
+# Inputs of BHS_REMODELLING_JUNE2020.COM
+REMODELLING_PARAMETERS = {
+    'SIGMA_GAUSS': 1.2,
+    'SUPPORT_GAUSS': 2,
+    'THRESHOLD_SEG': 125,         # mg HA/ccm
+    'trab_threshold': 200,        # mg HA/ccm
+    'cl_nr_min': 5,
+    'COLOUR1': 11,                # PURPLE (loss)
+    'COLOUR2': 10,                # GREEN (gain)
+    'COLOUR4': 12,                # GREY
+    'PEEL_ITER': 5,               # peel of the slab mask
+    'MU_SCALING': 8192,
+    'DENSITY_SLOPE': 1652.92,
+    'DENSITY_INTERCEPT': -396.80
+}
+
+# Density calibration: parameter -> processing log key (see util/util/aimLog.py)
+CALIBRATION_FIELDS = {
+    'MU_SCALING': 'mu_scaling',
+    'DENSITY_SLOPE': 'density_slope',
+    'DENSITY_INTERCEPT': 'density_intercept'
+}
+
+
+def densityToNative(density, parameters):
+    # mg HA/ccm -> linear attenuation [1/cm] -> native image value
+    mu = (density - parameters['DENSITY_INTERCEPT']) / parameters['DENSITY_SLOPE']
+    return mu * parameters['MU_SCALING']
+
+
+def threshold(image, lower, upper=None, value=127):
+    # IPL threshold: voxels in [lower, upper] are set to value, all others to 0
+    inRange = image >= lower
+    if upper is not None :
+        inRange = inRange & (image <= upper)
+    return sitk.Cast(inRange, sitk.sitkUInt8) * value
+
+
+def segGauss(image, sigma, support, lower, upper=None, value=127):
+    # IPL seg_gauss: Gaussian smoothing (sigma in voxels, kernel support in sigmas) then threshold
+    kernelWidth = 2 * int(math.ceil(support * sigma)) + 1
+    smoothed = sitk.DiscreteGaussian( sitk.Cast(image, sitk.sitkFloat32), variance=sigma**2,
+                                      maximumKernelWidth=kernelWidth, maximumError=0.01, useImageSpacing=False )
+    return threshold(smoothed, lower, upper, value)
+
+
+def clNrExtract(image, minNumber, value=127):
+    # IPL cl_nr_extract (topology 6): keep connected components with at least minNumber voxels
+    labels = sitk.ConnectedComponent(image != 0, False)
+    labels = sitk.RelabelComponent(labels, minimumObjectSize=int(minNumber))
+    return sitk.Cast(labels != 0, sitk.sitkUInt8) * value
+
+
+def peelMask(image, gobj, peelIter=0):
+    # IPL gobj_maskaimpeel_ow: peel (erode) the gobj by peelIter voxels, then set the image to 0 outside it
+    mask = gobj != 0
+    if peelIter > 0 :
+        mask = sitk.BinaryErode(mask, [int(peelIter)] * mask.GetDimension(), sitk.sitkBall)
+    return sitk.Mask(image, mask)
+
+
+def setValue(image, valueObject, valueBackground=0):
+    # IPL set_value
+    objects = sitk.Cast(image != 0, sitk.sitkUInt8)
+    return objects * valueObject + (1 - objects) * valueBackground
+
+
+def concat(image1, image2):
+    # IPL concat with -add_not_overlay false: non-zero voxels of image2 are drawn over image1
+    return sitk.Mask(image1, image2 == 0) + image2
+
+
+def toReferenceGrid(image, reference):
+    # Masks are resampled (nearest neighbour) onto the grayscale image grid if their grids differ
+    if BHS_resample.sameGrid(image, reference) :
+        return image
+    return BHS_resample.resampleImages([image], reference, sitk.Transform(), ['nearest'])[0]
+
+
+def remodelling(baselineImage, followupImage, baselineMask, followupMask, parameters=REMODELLING_PARAMETERS):
+    # Returns the slab, masks, formation, resorption and colour-coded images as a dictionary
+    thresholdSeg = densityToNative(parameters['THRESHOLD_SEG'], parameters)
+    trabThreshold = densityToNative(parameters['trab_threshold'], parameters)
+
+    # Create a slab only containing the common region - this will determine the z axis border
+    # norm_max scales the 12MO image to a maximum of 127. Voxels that round to 0 are outside the slab.
+    maximum = sitk.GetArrayViewFromImage(followupImage).max()
+    slab = threshold(followupImage, 0.5 * maximum / 127.0)
+
+    # Crop the masks to only include the common region using the peeled slab mask
+    baselineMask = toReferenceGrid(baselineMask, baselineImage)
+    followupMask = toReferenceGrid(followupMask, baselineImage)
+    midMask3MO = peelMask(setValue(baselineMask, 127), slab, parameters['PEEL_ITER'])
+    midMask12MO = peelMask(setValue(followupMask, 127), slab, parameters['PEEL_ITER'])
+
+    # Differences are calculated as 32-bit integers so that 16-bit images cannot overflow
+    in1 = sitk.Cast(baselineImage, sitk.sitkInt32)
+    in2 = sitk.Cast(followupImage, sitk.sitkInt32)
+
+    # subtract BL image from FU image to represent bone gain
+    gain = peelMask(in2 - in1, midMask12MO)
+    gain = clNrExtract( threshold(gain, thresholdSeg), parameters['cl_nr_min'] )
+    gain = setValue(gain, parameters['COLOUR2'])
+
+    # subtract FU image from BL image to represent bone loss
+    loss = peelMask(in1 - in2, midMask3MO)
+    loss = clNrExtract( threshold(loss, thresholdSeg), parameters['cl_nr_min'] )
+    loss = setValue(loss, parameters['COLOUR1'])
+
+    # XT2 segmentation of the baseline image, then concatenate with gain/loss
+    seg = segGauss(baselineImage, parameters['SIGMA_GAUSS'], parameters['SUPPORT_GAUSS'], trabThreshold)
+    seg = clNrExtract( peelMask(seg, midMask3MO), parameters['cl_nr_min'] )
+    seg = setValue(seg, parameters['COLOUR4'])
+
+    combined = concat( concat(seg, gain), loss )
+
+    return {
+        'SLAB': slab,
+        '03MO_MIDMASK': midMask3MO,
+        '12MO_MIDMASK': midMask12MO,
+        'FORMATION': gain,
+        'RESORPTION': loss,
+        'ADD_SEG': combined
+    }
+
+
+def writeRemodelling(results, outputPrefix):
+    for name, image in results.items() :
+        outputPath = outputPrefix + '_' + name + '.mha'
+        print('Writing to {}'.format(outputPath))
+        sitk.WriteImage(image, outputPath)
+
+
+def BHS_remodelling(baselineImagePath, followupImagePath, baselineMaskPath, followupMaskPath, outputPrefix,
+                    parameters=REMODELLING_PARAMETERS):
+    images = []
+    for imagePath in (baselineImagePath, followupImagePath, baselineMaskPath, followupMaskPath) :
+        print('Reading in {}'.format(imagePath))
+        images.append( sitk.ReadImage(imagePath) )
+
+    print('Calculating formation and resorption')
+    results = remodelling(*images, parameters)
+    writeRemodelling(results, outputPrefix)
+
+    return results
+
+
+def addParameterArguments(parser):
+    # Command line options for the remodelling parameters (shared with BHS_reg.py)
+    defaults = REMODELLING_PARAMETERS
+    parser.add_argument( '--threshold', type=float, default=defaults['THRESHOLD_SEG'], help='Formation/resorption threshold in mg HA/ccm (default: {})'.format(defaults['THRESHOLD_SEG']) )
+    parser.add_argument( '--trab-threshold', dest='trabThreshold', type=float, default=defaults['trab_threshold'], help='Bone threshold of seg_gauss in mg HA/ccm (default: {})'.format(defaults['trab_threshold']) )
+    parser.add_argument( '--cl-nr-min', dest='clNrMin', type=int, default=defaults['cl_nr_min'], help='Smallest component kept, in voxels (default: {})'.format(defaults['cl_nr_min']) )
+    parser.add_argument( '--aim-log', dest='aimLog', type=str, default='', help='AIM processing log (.txt) or AIM to read the density calibration from (default: scanner defaults)' )
+    parser.add_argument( '--mu-scaling', dest='muScaling', type=float, default=None, help='Mu_Scaling of the images (default: from --aim-log, or {})'.format(defaults['MU_SCALING']) )
+    parser.add_argument( '--density-slope', dest='densitySlope', type=float, default=None, help='Density calibration slope (default: from --aim-log, or {})'.format(defaults['DENSITY_SLOPE']) )
+    parser.add_argument( '--density-intercept', dest='densityIntercept', type=float, default=None, help='Density calibration intercept (default: from --aim-log, or {})'.format(defaults['DENSITY_INTERCEPT']) )
+
+
+def readCalibration(logPath):
+    # The density calibration in the processing log of an AIM (or the .txt log written by fileConverter.py)
+    # Fields that are not in the log are left out
+    if splitImageName(logPath)[1] == '.aim' :
+        log = parseAIMLog( AIMFile(logPath).processingLog )
+    else :
+        log = readAIMLog(logPath)
+    return { parameter: log[key] for parameter, key in CALIBRATION_FIELDS.items() if isinstance(log[key], float) }
+
+
+def getParameters(args):
+    # The calibration is read from --aim-log if given, and the calibration options override it
+    parameters = dict(REMODELLING_PARAMETERS)
+    if args.aimLog :
+        if not os.path.isfile(args.aimLog) :
+            print()
+            print('Error: Cannot read the AIM processing log {}'.format(args.aimLog))
+            sys.exit(1)
+        calibration = readCalibration(args.aimLog)
+        missing = [ field for field in CALIBRATION_FIELDS if field not in calibration ]
+        if missing :
+            print('Warning: {} not found in {}, using the default'.format(', '.join(missing), args.aimLog))
+        parameters.update(calibration)
+
+    parameters.update({
+        'THRESHOLD_SEG': args.threshold,
+        'trab_threshold': args.trabThreshold,
+        'cl_nr_min': args.clNrMin
+    })
+    for parameter, value in (('MU_SCALING', args.muScaling), ('DENSITY_SLOPE', args.densitySlope), ('DENSITY_INTERCEPT', args.densityIntercept)) :
+        if value is not None :
+            parameters[parameter] = value
+    return parameters
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'input_03MO_gray', type=str, help='The 03MO XCT grayscale image (path + filename)' )
+    parser.add_argument( 'input_12MO_to_03MO_reg', type=str, help='The registered 12MO to 03MO XCT grayscale image (path + filename)' )
+    parser.add_argument( 'input_03MO_seg', type=str, help='The 03MO XCT mask image (path + filename)' )
+    parser.add_argument( 'input_12MO_to_03MO_seg_reg', type=str, help='The registered 12MO to 03MO XCT mask image (path + filename)' )
+    parser.add_argument( 'outputPrefix', type=str, help='The output path + prefix for the remodelling images' )
+    addParameterArguments(parser)
+    args = parser.parse_args()
+
+    BHS_remodelling(args.input_03MO_gray, args.input_12MO_to_03MO_reg, args.input_03MO_seg, args.input_12MO_to_03MO_seg_reg,
+                    args.outputPrefix, getParameters(args))
@@ -0,0 +1,176 @@
+#-----------------------------------------------------
+# BHS_remodellingStats.py
+#
+# Created on:   18-10-2026
+#
+# Description: Formation and resorption statistics, as given by voxgobj_scanco_param in
+#              BHS_REMODELLING_JUNE2020.COM, for a whole cohort. The statistics are
+#              calculated from the BHS_remodelling.py outputs with NumPy bincount
+#              reductions, so there is no need to copy numbers out of the IPL logs:
+#                   FORMATION   inside 12MO_MIDMASK
+#                   RESORPTION  inside 03MO_MIDMASK
+#                   BONE        (the seg_gauss baseline bone in ADD_SEG) inside 03MO_MIDMASK
+#              For each of these, the table has the object and mask voxel counts, the
+#              volumes (BV, TV) in mm^3, BV/TV and a histogram of connected component sizes.
+#
+#-----------------------------------------------------
+# Usage: python BHS_remodellingStats.py arg1 arg2 [-n workers]
+#
+# Where:  arg1 = A directory of BHS_remodelling.py outputs (e.g. the BHS_batch.py output directory)
+#         arg2 = The output table (.csv or .parquet)
+#
+# Notes: Each sample is found by its <prefix>_FORMATION.mha image. The other images must
+#        have the same prefix (<prefix>_RESORPTION.mha, <prefix>_03MO_MIDMASK.mha, ...).
+#        Writing Parquet needs pandas and pyarrow.
+#        Connected components use 6-connectivity, the same as cl_nr_extract.
+#-----------------------------------------------------
+import os
+import sys
+import csv
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+import BHS_remodelling
+
+# Lower edges of the component size histogram bins (voxels). The last bin has no upper edge.
+COMPONENT_SIZE_BINS = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+
+# (statistic name, remodelling image, mask image, colour in the image or None for any non-zero voxel)
+REMODELLING_STATS = [
+    ('FORMATION', 'FORMATION', '12MO_MIDMASK', None),
+    ('RESORPTION', 'RESORPTION', '03MO_MIDMASK', None),
+    ('BONE', 'ADD_SEG', '03MO_MIDMASK', BHS_remodelling.REMODELLING_PARAMETERS['COLOUR4'])
+]
+
+
+def getHistogramColumns(name):
+    edges = COMPONENT_SIZE_BINS + [None]
+    return [ '{}_cl_{}_{}'.format(name, lower, upper - 1) if upper else '{}_cl_{}_plus'.format(name, lower)
+             for lower, upper in zip(edges[:-1], edges[1:]) ]
+
+
+def componentSizes(objects):
+    # Voxel count of each 6-connected component of a boolean (z, y, x) array
+    if not objects.any() :
+        return np.zeros(0, dtype=np.int64)
+
+    labels = sitk.ConnectedComponent( sitk.GetImageFromArray(objects.astype(np.uint8)), False )
+    return np.bincount( sitk.GetArrayViewFromImage(labels).ravel() )[1:]
+
+
+def voxgobjParam(objects, mask, voxelVolume, name):
+    # voxgobj_scanco_param: object volume inside the mask. objects and mask are boolean (z, y, x) arrays.
+    # A single bincount gives the mask voxels with (3) and without (2) an object in one pass.
+    counts = np.bincount( (mask.ravel().view(np.uint8) << 1) | objects.ravel().view(np.uint8), minlength=4 )
+    objectVoxels = int(counts[3])
+    maskVoxels = int(counts[2] + counts[3])
+
+    sizes = componentSizes(objects & mask)
+    histogram = np.histogram(sizes, bins=COMPONENT_SIZE_BINS + [np.inf])[0]
+
+    stats = {
+        name + '_voxels': objectVoxels,
+        name + '_TV_voxels': maskVoxels,
+        name + '_BV_mm3': objectVoxels * voxelVolume,
+        name + '_TV_mm3': maskVoxels * voxelVolume,
+        name + '_BV_TV': objectVoxels / maskVoxels if maskVoxels else float('nan'),
+        name + '_cl_number': int(sizes.size),
+        name + '_cl_mean_voxels': float(sizes.mean()) if sizes.size else 0.0,
+        name + '_cl_max_voxels': int(sizes.max()) if sizes.size else 0
+    }
+    stats.update( zip(getHistogramColumns(name), histogram.tolist()) )
+
+    return stats
+
+
+def remodellingStats(results):
+    # Statistics from a dictionary of remodelling images (as returned by BHS_remodelling.remodelling())
+    spacing = results['03MO_MIDMASK'].GetSpacing()
+    voxelVolume = float(np.prod(spacing))
+
+    stats = {'voxel_size_mm': spacing[0]}
+    for name, imageName, maskName, colour in REMODELLING_STATS :
+        image = sitk.GetArrayViewFromImage(results[imageName])
+        mask = sitk.GetArrayViewFromImage(results[maskName]) != 0
+        objects = image == colour if colour is not None else image != 0
+        stats.update( voxgobjParam(objects, mask, voxelVolume, name) )
+
+    return stats
+
+
+def printStats(stats):
+    for name, _, maskName, _ in REMODELLING_STATS :
+        print('{} in {}: {} voxels, BV = {:.4f} mm^3, TV = {:.4f} mm^3, BV/TV = {:.6f}, {} components'.format(
+            name, maskName, stats[name + '_voxels'], stats[name + '_BV_mm3'], stats[name + '_TV_mm3'],
+            stats[name + '_BV_TV'], stats[name + '_cl_number']))
+
+
+def findSamples(inputDirectory):
+    # Prefixes of all complete sets of remodelling images in a directory
+    imageNames = {imageName for _, imageName, maskName, _ in REMODELLING_STATS} | {maskName for _, _, maskName, _ in REMODELLING_STATS}
+
+    prefixes = []
+    for formationPath in sorted(glob.glob(os.path.join(inputDirectory, '*_FORMATION.mha'))) :
+        prefix = formationPath[:-len('_FORMATION.mha')]
+        missing = [name for name in sorted(imageNames) if not os.path.isfile(prefix + '_' + name + '.mha')]
+        if missing :
+            print('Warning: Skipping {} (missing {})'.format(os.path.basename(prefix), ', '.join(missing)))
+            continue
+        prefixes.append(prefix)
+
+    return prefixes
+
+
+def sampleStats(prefix):
+    names = {imageName for _, imageName, _, _ in REMODELLING_STATS} | {maskName for _, _, maskName, _ in REMODELLING_STATS}
+    results = { name: sitk.ReadImage(prefix + '_' + name + '.mha') for name in names }
+
+    stats = {'sample': os.path.basename(prefix)}
+    stats.update( remodellingStats(results) )
+    return stats
+
+
+def writeTable(rows, outputPath):
+    if outputPath.lower().endswith('.parquet') :
+        # pandas is only imported here so that it is not needed for CSV tables
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(outputPath, index=False)
+        return
+
+    with open(outputPath, 'w', newline='') as f :
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['sample'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def BHS_remodellingStats(inputDirectory, outputPath, numberOfWorkers=None):
+    prefixes = findSamples(inputDirectory)
+    print('Found {} samples'.format(len(prefixes)))
+
+    with ProcessPoolExecutor(max_workers=numberOfWorkers or None) as executor :
+        rows = list( executor.map(sampleStats, prefixes) )
+
+    print('Writing to {}'.format(outputPath))
+    writeTable(rows, outputPath)
+
+    return rows
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'inputDirectory', type=str, help='A directory of BHS_remodelling.py outputs' )
+    parser.add_argument( 'output', type=str, help='The output table (.csv or .parquet)' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Number of samples to process at once (default: number of cores)' )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.inputDirectory) :
+        print()
+        print('Error: The input must be a directory')
+        sys.exit(1)
+
+    BHS_remodellingStats(args.inputDirectory, args.output, args.workers)
@@ -0,0 +1,93 @@
+#-----------------------------------------------------
+# BHS_report.py
+#
+# Created on:   18-10-2026
+#
+# Description: Per-stage instrumentation of BHS_reg.py. Each stage (read, initializer,
+#              registration, resample, write, ...) is timed with a context manager:
+#
+#                   report = RunReport()
+#                   with report.stage('read') :
+#                       image = sitk.ReadImage(imagePath)
+#                   report.write('BHS_030_MCP2_REPORT.json')
+#
+#              For each stage, the report has the wall time, CPU time, peak RSS and the
+#              number of ITK threads. Other results (e.g. the metric trajectory and stop
+#              condition of the registration) are added to report.info.
+#
+# Notes: Peak RSS is the peak of the whole process so far (it never goes down), so the
+#        stage where it rises is the stage that used the memory.
+#        Peak RSS is read with the resource module, which is not available on Windows.
+#        There, peakRSS_MB is null.
+#-----------------------------------------------------
+import os
+import sys
+import json
+import time
+import platform
+import contextlib
+
+import SimpleITK as sitk
+
+try :
+    import resource
+except ImportError :
+    resource = None
+
+
+def peakRSS():
+    # Peak resident set size of this process in MB (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+    if resource is None :
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024.0 if sys.platform != 'darwin' else maxrss / 1024.0**2
+
+
+class RunReport:
+    def __init__(self):
+        self.stages = []
+        self.info = {}
+        self.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Time the code inside the with block. The stage is recorded even if it raises an error.
+        startWall = time.perf_counter()
+        startCPU = time.process_time()
+        try :
+            yield
+        finally :
+            self.stages.append({
+                'name': name,
+                'wallTime': time.perf_counter() - startWall,
+                'cpuTime': time.process_time() - startCPU,
+                'peakRSS_MB': peakRSS(),
+                'itkThreads': sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+            })
+
+    def getTotals(self):
+        totals = {}
+        for stage in self.stages :
+            total = totals.setdefault(stage['name'], {'wallTime': 0.0, 'cpuTime': 0.0})
+            total['wallTime'] += stage['wallTime']
+            total['cpuTime'] += stage['cpuTime']
+        return totals
+
+    def toDict(self):
+        return {
+            'created': self.created,
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'simpleitk': sitk.Version.VersionString(),
+            'cpuCount': os.cpu_count(),
+            'pid': os.getpid(),
+            'wallTime': sum(stage['wallTime'] for stage in self.stages),
+            'peakRSS_MB': peakRSS(),
+            'stages': self.stages,
+            'totals': self.getTotals(),
+            'info': self.info
+        }
+
+    def write(self, fileName):
+        with open(fileName, 'w') as f :
+            json.dump(self.toDict(), f, indent=2)
@@ -0,0 +1,85 @@
+#-----------------------------------------------------
+# BHS_resample.py
+#
+# Created on:   18-10-2026
+#
+# Description: Resample any number of co-registered images with one transform.
+#              A single ResampleImageFilter is set up once per output grid and re-used for
+#              every image, each with its own interpolator:
+#                   grayscale images:   linear or B-spline
+#                   segmented images:   nearest neighbour or label Gaussian, so label values
+#                                       are never blended (sitkLinear turns the edge of a
+#                                       0/127 mask into values in between)
+#              Linear transforms (e.g. the Euler3D transform from BHS_reg.py) use the ITK
+#              fast path, which maps a whole scanline at a time. Other transforms are
+#              evaluated once per output voxel into a displacement field that is shared by
+#              all images on that grid.
+#              ITK runs each resampling on all threads (see SetGlobalDefaultNumberOfThreads).
+#
+#-----------------------------------------------------
+import math
+
+import SimpleITK as sitk
+
+INTERPOLATORS = {
+    'linear': sitk.sitkLinear,
+    'bspline': sitk.sitkBSpline,
+    'nearest': sitk.sitkNearestNeighbor,
+    'label': sitk.sitkLabelGaussian
+}
+
+GRAY_INTERPOLATORS = ('linear', 'bspline')
+SEG_INTERPOLATORS = ('nearest', 'label')
+
+
+def getGrid(image):
+    return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def sameGrid(image, reference):
+    # True if both images have the same size, origin, spacing and direction
+    if image.GetSize() != reference.GetSize() :
+        return False
+    return all( math.isclose(a, b, abs_tol=1e-6) for a, b in zip(image.GetOrigin() + image.GetSpacing() + image.GetDirection(),
+                                                                  reference.GetOrigin() + reference.GetSpacing() + reference.GetDirection()) )
+
+
+def getDisplacementField(transform, referenceImage):
+    # Evaluate the transform once for every voxel of the reference grid
+    size, origin, spacing, direction = getGrid(referenceImage)
+    field = sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat64, size, origin, spacing, direction)
+    return sitk.DisplacementFieldTransform(field)
+
+
+def resampleImages(images, referenceImages, transform, interpolators, defaultValues=None, useDisplacementField=None):
+    # Resample each image onto its reference image grid (one reference image can be given for all).
+    # Interpolators can be names from INTERPOLATORS or SimpleITK interpolator constants.
+    # Each output keeps the pixel type of its input image.
+    # useDisplacementField: None = only for non-linear transforms, True = always, False = never
+    if isinstance(referenceImages, sitk.Image) :
+        referenceImages = [referenceImages] * len(images)
+    if defaultValues is None :
+        defaultValues = [0] * len(images)
+    if useDisplacementField is None :
+        useDisplacementField = not transform.IsLinear()
+
+    resampler = sitk.ResampleImageFilter()
+    gridTransforms = []
+    outputs = []
+    for image, referenceImage, interpolator, defaultValue in zip(images, referenceImages, interpolators, defaultValues) :
+        # Images on the same grid share the transform (or displacement field)
+        for gridImage, gridTransform in gridTransforms :
+            if sameGrid(referenceImage, gridImage) :
+                break
+        else :
+            gridTransform = getDisplacementField(transform, referenceImage) if useDisplacementField else transform
+            gridTransforms.append( (referenceImage, gridTransform) )
+
+        resampler.SetReferenceImage(referenceImage)
+        resampler.SetTransform(gridTransform)
+        resampler.SetInterpolator( INTERPOLATORS.get(interpolator, interpolator) )
+        resampler.SetDefaultPixelValue(defaultValue)
+        resampler.SetOutputPixelType( image.GetPixelID() )
+        outputs.append( resampler.Execute(image) )
+
+    return outputs
@@ -0,0 +1,150 @@
+#-----------------------------------------------------
+# BHS_stitch.py
+#
+# Created on:   18-10-2026
+#
+# Description: Stitch the stacks of one joint (e.g. PRX, MID and DST) into one image.
+#              The stacks must be in the same image space (e.g. the 03MO images and the
+#              registered 12MO to 03MO images of each stack). The output grid has the spacing
+#              and direction of the first stack and covers all of the stacks.
+#              Where stacks overlap, grayscale images are averaged and segmented images
+#              keep the largest label value.
+#              A registered (resampled) stack only has data inside the field of view of its
+#              moving image; the rest is padding. Given the moving images and the transforms,
+#              only the voxels inside the moving image field of view are averaged.
+#
+#-----------------------------------------------------
+# Usage: python BHS_stitch.py arg1 arg2 [arg2 ...] [--seg] [--moving ... --transforms ...]
+#
+# Where:  arg1 = The stitched output image
+#         arg2 = The stack images, e.g. the PRX, MID and DST images of one joint
+#
+# Options: --seg = The stacks are segmented images (nearest neighbour, largest label in the overlap)
+#          --moving = For registered stacks: the moving image of each stack (only the header is read)
+#          --transforms = For registered stacks: the transformation matrix (.tfm) of each stack
+#-----------------------------------------------------
+import sys
+import math
+import argparse
+import itertools
+
+import SimpleITK as sitk
+
+import BHS_resample
+
+
+def getStitchGrid(images):
+    # The grid of the first image, grown to cover the corners of every image
+    reference = images[0]
+    dimension = reference.GetDimension()
+
+    lower = [math.inf] * dimension
+    upper = [-math.inf] * dimension
+    for image in images :
+        for corner in itertools.product(*[(-0.5, size - 0.5) for size in image.GetSize()]) :
+            point = image.TransformContinuousIndexToPhysicalPoint(corner)
+            index = reference.TransformPhysicalPointToContinuousIndex(point)
+            lower = [min(a, b) for a, b in zip(lower, index)]
+            upper = [max(a, b) for a, b in zip(upper, index)]
+
+    # Whole voxels of the reference grid (the grids of stacks from one scan line up)
+    start = [int(math.floor(value + 0.5 + 1e-3)) for value in lower]
+    stop = [int(math.ceil(value - 0.5 - 1e-3)) for value in upper]
+
+    grid = sitk.Image([b - a + 1 for a, b in zip(start, stop)], sitk.sitkUInt8)
+    grid.SetSpacing(reference.GetSpacing())
+    grid.SetDirection(reference.GetDirection())
+    grid.SetOrigin(reference.TransformIndexToPhysicalPoint(start))
+    return grid
+
+
+def getOnesImage(size, origin, spacing, direction):
+    ones = sitk.Image(size, sitk.sitkUInt8) + 1
+    ones.SetOrigin(origin)
+    ones.SetSpacing(spacing)
+    ones.SetDirection(direction)
+    return ones
+
+
+def getCoverage(image, movingImagePath=None, transform=None):
+    # 1 where the stack image has data, on the grid of the stack image. For a registered stack,
+    # this is the field of view of the moving image mapped through the registration transform.
+    if movingImagePath is None :
+        return getOnesImage(image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(movingImagePath)
+    reader.ReadImageInformation()
+    fieldOfView = getOnesImage(reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(), reader.GetDirection())
+    return BHS_resample.resampleImages([fieldOfView], image, transform, ['nearest'])[0]
+
+
+def stitchImages(images, seg=False, coverages=None):
+    # The stacks are resampled (identity transform) onto the stitched grid
+    # coverages: 0/1 images on the grid of each stack (see getCoverage), default the whole stack
+    grid = getStitchGrid(images)
+    interpolator = 'nearest' if seg else 'linear'
+    resampled = BHS_resample.resampleImages(images, grid, sitk.Transform(), [interpolator] * len(images))
+
+    if seg :
+        stitched = resampled[0]
+        for image in resampled[1:] :
+            stitched = sitk.Maximum(stitched, image)
+        return stitched
+
+    # Average of the stacks that cover each voxel
+    if coverages is None :
+        coverages = [getCoverage(image) for image in images]
+    coverages = BHS_resample.resampleImages(coverages, grid, sitk.Transform(), ['nearest'] * len(images))
+
+    total = sitk.Cast(resampled[0], sitk.sitkFloat32) * sitk.Cast(coverages[0], sitk.sitkFloat32)
+    count = sitk.Cast(coverages[0], sitk.sitkFloat32)
+    for image, covered in zip(resampled[1:], coverages[1:]) :
+        total += sitk.Cast(image, sitk.sitkFloat32) * sitk.Cast(covered, sitk.sitkFloat32)
+        count += sitk.Cast(covered, sitk.sitkFloat32)
+    stitched = total / sitk.Maximum(count, 1.0)
+
+    # Round back to the (integer) pixel type of the stacks
+    if images[0].GetPixelID() not in (sitk.sitkFloat32, sitk.sitkFloat64) :
+        stitched = sitk.Round(stitched)
+    return sitk.Cast(stitched, images[0].GetPixelID())
+
+
+def BHS_stitch(outputPath, imagePaths, seg=False, movingImagePaths=None, transformPaths=None):
+    # movingImagePaths and transformPaths (one per stack) give the field of view of registered stacks
+    images = []
+    for imagePath in imagePaths :
+        print('Reading in {}'.format(imagePath))
+        images.append( sitk.ReadImage(imagePath) )
+
+    coverages = None
+    if movingImagePaths and not seg :
+        coverages = []
+        for image, movingImagePath, transformPath in zip(images, movingImagePaths, transformPaths) :
+            print('Field of view of {} ({})'.format(movingImagePath, transformPath))
+            coverages.append( getCoverage(image, movingImagePath, sitk.ReadTransform(transformPath)) )
+
+    stitched = stitchImages(images, seg, coverages)
+
+    print('Writing to {}'.format(outputPath))
+    sitk.WriteImage(stitched, outputPath)
+
+    return stitched
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'output', type=str, help='The stitched output image (path + filename)' )
+    parser.add_argument( 'inputs', type=str, nargs='+', help='The stack images (path + filename)' )
+    parser.add_argument( '--seg', action='store_true', help='The stacks are segmented images' )
+    parser.add_argument( '--moving', type=str, nargs='+', default=[], help='For registered stacks: the moving image of each stack (path + filename)' )
+    parser.add_argument( '--transforms', type=str, nargs='+', default=[], help='For registered stacks: the transformation matrix of each stack (path + filename)' )
+    args = parser.parse_args()
+
+    if args.moving and not ( len(args.moving) == len(args.transforms) == len(args.inputs) ) :
+        print()
+        print('Error: --moving and --transforms need one image and one transformation matrix per stack')
+        sys.exit(1)
+
+    BHS_stitch(args.output, args.inputs, args.seg, args.moving, args.transforms)
@@ -0,0 +1,217 @@
+#-----------------------------------------------------
+# BHS_worker.py
+#
+# Created on:   18-10-2026
+#
+# Description: A long-running local worker that takes registration jobs from a file queue.
+#              Python and SimpleITK are only loaded once, and recently read images (e.g. a
+#              03MO image that is registered to several follow-up images) are kept in memory.
+#              Jobs are JSON files in a queue directory:
+#                   <queue>/pending     jobs waiting to run (run oldest first)
+#                   <queue>/running     jobs being run (moved here by the worker that takes them)
+#                   <queue>/done        finished jobs, with their result
+#                   <queue>/failed      jobs that raised an error, with the error
+#                   <queue>/logs        the console output of each job
+#              A job is taken by renaming it from pending to running, so several workers can
+#              share one queue directory.
+#
+#              Jobs are submitted from any Python process (e.g. a notebook):
+#                   from BHS_worker import submitJob, waitForJob
+#                   jobID = submitJob('/data/queue', 'register', XCT_3MO_image_path=..., ...)
+#                   result = waitForJob('/data/queue', jobID)
+#
+# Tasks:   register     = BHS_reg() in BHS_reg.py (keyword arguments of BHS_reg)
+#          remodelling  = BHS_remodelling() in BHS_remodelling.py
+#          transform    = BHS_segTransform() in util/BHS_segTransform.py
+#
+#-----------------------------------------------------
+# Usage: python BHS_worker.py arg1 [-t threads] [--max-images N] [--exit-when-empty]
+#
+# Where:  arg1 = The queue directory
+#
+# Notes: Jobs left in running by a worker that was killed are not restarted automatically.
+#        Move them back to pending to run them again.
+#-----------------------------------------------------
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import contextlib
+import collections
+
+import SimpleITK as sitk
+
+import BHS_cache
+import BHS_remodelling
+from BHS_reg import BHS_reg
+
+QUEUE_STATES = ('pending', 'running', 'done', 'failed', 'logs')
+
+
+class ImageCache(collections.OrderedDict):
+    # Keeps the most recently used images (least recently used images are dropped first)
+    def __init__(self, maxImages=8):
+        super().__init__()
+        self.maxImages = maxImages
+
+    def get(self, key, default=None):
+        if key not in self :
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, image):
+        super().__setitem__(key, image)
+        self.move_to_end(key)
+        while len(self) > self.maxImages :
+            self.popitem(last=False)
+
+
+def runRegister(kwargs, imageCache):
+    finalTransform = BHS_reg(**kwargs, imageCache=imageCache)
+    return {'parameters': list( BHS_cache.getEulerTransform(finalTransform).GetParameters() )}
+
+
+def runRemodelling(kwargs, imageCache):
+    BHS_remodelling.BHS_remodelling(**kwargs)
+    return {}
+
+
+def runTransform(kwargs, imageCache):
+    # util/BHS_segTransform.py only needs SimpleITK, so it is imported from the util folder
+    from util.BHS_segTransform import BHS_segTransform
+    return {'output': BHS_segTransform(**kwargs)}
+
+
+WORKER_TASKS = {
+    'register': runRegister,
+    'remodelling': runRemodelling,
+    'transform': runTransform
+}
+
+
+def getQueueDirectories(queueDirectory):
+    directories = {state: os.path.join(queueDirectory, state) for state in QUEUE_STATES}
+    for directory in directories.values() :
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+
+def writeJob(jobPath, job):
+    # Write to a temporary (hidden) file first so that a worker never reads a half written job
+    tmpPath = os.path.join(os.path.dirname(jobPath), '.' + os.path.basename(jobPath) + '.tmp')
+    with open(tmpPath, 'w') as f :
+        json.dump(job, f, indent=2)
+    os.replace(tmpPath, jobPath)
+
+
+def submitJob(queueDirectory, task, **kwargs):
+    # Add a job to the queue and return its ID. Job IDs sort in the order they were submitted.
+    if task not in WORKER_TASKS :
+        raise ValueError('Unknown task: {}'.format(task))
+
+    directories = getQueueDirectories(queueDirectory)
+    jobID = '{:020d}_{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+    job = {'id': jobID, 'task': task, 'kwargs': kwargs, 'submitted': time.time()}
+    writeJob(os.path.join(directories['pending'], jobID + '.json'), job)
+
+    return jobID
+
+
+def getJob(queueDirectory, jobID):
+    # Returns the job and its state, or (None, None) if there is no such job
+    for state in ('done', 'failed', 'running', 'pending') :
+        jobPath = os.path.join(queueDirectory, state, jobID + '.json')
+        try :
+            with open(jobPath) as f :
+                return json.load(f), state
+        except (OSError, ValueError) :
+            continue
+    return None, None
+
+
+def waitForJob(queueDirectory, jobID, timeout=None, pollInterval=0.5):
+    # Wait until the job is done or failed and return it
+    startTime = time.time()
+    while True :
+        job, state = getJob(queueDirectory, jobID)
+        if state in ('done', 'failed') :
+            return job
+        if timeout is not None and time.time() - startTime > timeout :
+            raise TimeoutError('Job {} is still {}'.format(jobID, state))
+        time.sleep(pollInterval)
+
+
+def takeJob(directories):
+    # Move the oldest pending job to running. Returns None if there are no pending jobs.
+    for filename in sorted(os.listdir(directories['pending'])) :
+        if filename.startswith('.') or not filename.endswith('.json') :
+            continue
+        runningPath = os.path.join(directories['running'], filename)
+        try :
+            os.rename(os.path.join(directories['pending'], filename), runningPath)
+        except FileNotFoundError :
+            # Another worker took this job first
+            continue
+        with open(runningPath) as f :
+            return json.load(f), runningPath
+    return None, None
+
+
+def runJob(job, directories, imageCache):
+    job.update({'pid': os.getpid(), 'started': time.time()})
+    logPath = os.path.join(directories['logs'], job['id'] + '.log')
+
+    try :
+        with open(logPath, 'w') as log, contextlib.redirect_stdout(log) :
+            result = WORKER_TASKS[job['task']](job['kwargs'], imageCache)
+    except Exception as e :
+        job.update({'status': 'failed', 'finished': time.time(), 'error': repr(e)})
+    else :
+        job.update({'status': 'done', 'finished': time.time(), 'result': result})
+
+    return job
+
+
+def BHS_worker(queueDirectory, numberOfThreads=None, maxImages=8, exitWhenEmpty=False, pollInterval=1.0):
+    if numberOfThreads :
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+
+    directories = getQueueDirectories(queueDirectory)
+    imageCache = ImageCache(maxImages)
+    print('Worker {} waiting for jobs in {}'.format(os.getpid(), queueDirectory))
+
+    numberOfJobs = 0
+    while True :
+        job, runningPath = takeJob(directories)
+        if job is None :
+            if exitWhenEmpty :
+                break
+            time.sleep(pollInterval)
+            continue
+
+        job = runJob(job, directories, imageCache)
+        writeJob(os.path.join(directories[job['status']], job['id'] + '.json'), job)
+        os.remove(runningPath)
+
+        numberOfJobs += 1
+        print('{} {}: {} ({:.2f} s)'.format(job['id'], job['task'], job['status'].upper(), job['finished'] - job['started']))
+
+    return numberOfJobs
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'queueDirectory', type=str, help='The queue directory' )
+    parser.add_argument( '-t', dest='threads', type=int, default=0, help='Number of ITK threads (default: all cores)' )
+    parser.add_argument( '--max-images', dest='maxImages', type=int, default=8, help='Number of images to keep in memory between jobs (default: 8)' )
+    parser.add_argument( '--exit-when-empty', dest='exitWhenEmpty', action='store_true', help='Stop when there are no pending jobs instead of waiting for more' )
+    args = parser.parse_args()
+
+    try :
+        BHS_worker(args.queueDirectory, args.threads, args.maxImages, args.exitWhenEmpty)
+    except KeyboardInterrupt :
+        sys.exit(0)
@@ -0,0 +1,170 @@
+#-----------------------------------------------------
+# test_aimIO.py
+#
+# Description: Tests of the AIM v020 reader and writer in util/util/aimIO.py
+#-----------------------------------------------------
+import os
+import sys
+import struct
+
+import pytest
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.util.aimIO import (AIMFile, readAIM, writeAIM, compressBin, decompressBin, vmsToFloat, floatToVMS,
+                             AIM_PRE_HEADER_SIZE, AIM_IMAGE_STRUCT_SIZE,
+                             AIM_TYPE_CHAR, AIM_TYPE_SHORT, AIM_TYPE_INT, AIM_TYPE_FLOAT, AIM_TYPE_BINCMP)
+
+AIM_TYPES = [
+    (np.int8, AIM_TYPE_CHAR),
+    (np.int16, AIM_TYPE_SHORT),
+    (np.int32, AIM_TYPE_INT),
+    (np.float32, AIM_TYPE_FLOAT)
+]
+
+# D1TbinCmp data: length (int32), the two values, then run lengths of 3 x 0, 2 x 127 and
+# 255 + 1 x 0 (a run of 255 is followed by more of the same value)
+BINCMP_DATA = b'\x0a\x00\x00\x00' + b'\x00\x7f' + bytes([3, 2, 255, 1])
+BINCMP_VOXELS = np.array([0] * 3 + [127] * 2 + [0] * 256, dtype=np.int8)
+
+
+def makeImage(dtype):
+    rng = np.random.default_rng(6)
+    info = np.iinfo(dtype) if np.issubdtype(dtype, np.integer) else None
+    if info is not None :
+        array = rng.integers(info.min, info.max, size=(3, 4, 5), endpoint=True).astype(dtype)
+    else :
+        array = rng.normal(size=(3, 4, 5)).astype(dtype)
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([0.0607, 0.0607, 0.0821])
+    image.SetOrigin([0.0607 * 10, 0.0607 * -3, 0.0821 * 7])
+    return image
+
+
+def makeAIMBytes():
+    # A 2 x 2 x 1 D1Tshort AIM at position (1, 2, 3) with an element size of 0.5 mm, built by hand
+    preHeader = struct.pack('<5i', 20, 140, 4, 8, 0)
+    imageStruct = struct.pack('<6i', 0, 0, 0, 0, 0, 0x00020002)
+    imageStruct += struct.pack('<3i', 1, 2, 3) + struct.pack('<3i', 2, 2, 1) + b'\0' * 60
+    imageStruct += b'\x00\x40\x00\x00' * 3      # 0.5 as a VMS F-float (2.0 as an IEEE float, words swapped)
+    imageStruct += b'\0' * (140 - len(imageStruct))
+    return preHeader + imageStruct + b'log\0' + struct.pack('<4h', -1, 2, 300, -400)
+
+
+@pytest.mark.parametrize('dtype, aimType', AIM_TYPES)
+def test_round_trip(tmp_path, dtype, aimType):
+    image = makeImage(dtype)
+    fileName = str(tmp_path / 'image.aim')
+    writeAIM(fileName, image, 'test log')
+
+    aim = AIMFile(fileName)
+    assert aim.type == aimType
+    assert not aim.compressed
+    assert aim.dimensions == image.GetSize()
+    assert aim.processingLog == 'test log'
+
+    result = readAIM(fileName)
+    assert result.GetPixelID() == image.GetPixelID()
+    assert np.allclose(result.GetSpacing(), image.GetSpacing())
+    assert np.allclose(result.GetOrigin(), image.GetOrigin())
+    assert np.array_equal(sitk.GetArrayViewFromImage(result), sitk.GetArrayViewFromImage(image))
+
+
+@pytest.mark.parametrize('shape, runLength', [((3, 4, 5), 1), ((2, 30, 40), 255), ((2, 30, 40), 510), ((3, 50, 7), 600)])
+def test_compressed_round_trip(tmp_path, shape, runLength):
+    # Random binary voxels with a run of the first value that needs several 255 runs
+    rng = np.random.default_rng(runLength)
+    array = np.where(rng.random(shape) < 0.5, 0, 127).astype(np.int8)
+    array.ravel()[:runLength] = 127
+    fileName = str(tmp_path / 'image.aim')
+    writeAIM(fileName, array, '', compress=True)
+
+    aim = AIMFile(fileName)
+    assert aim.type == AIM_TYPE_BINCMP
+    assert aim.compressed
+    assert aim.imageDataSize == len(compressBin(array))
+    assert np.array_equal(aim.getArray(), array)
+
+
+def test_compressed_single_value():
+    array = np.full((2, 3, 4), 127, dtype=np.int8)
+    assert np.array_equal(decompressBin(compressBin(array), array.size), array.ravel())
+
+
+def test_compress_rejects_more_than_two_values(tmp_path):
+    array = np.arange(3, dtype=np.int8).reshape(1, 1, 3)
+    with pytest.raises(ValueError) :
+        compressBin(array)
+    with pytest.raises(ValueError) :
+        writeAIM(str(tmp_path / 'image.aim'), array.astype(np.int16), '', compress=True)
+
+
+def test_run_length_format():
+    assert np.array_equal(decompressBin(BINCMP_DATA, BINCMP_VOXELS.size), BINCMP_VOXELS)
+    assert compressBin(BINCMP_VOXELS) == BINCMP_DATA
+
+    with pytest.raises(ValueError) :
+        decompressBin(BINCMP_DATA, BINCMP_VOXELS.size + 1)
+
+
+def test_vms_float():
+    assert floatToVMS(1.0) == b'\x80\x40\x00\x00'
+    assert vmsToFloat(b'\x80\x40\x00\x00') == 1.0
+    assert vmsToFloat(floatToVMS(0.0607)) == pytest.approx(0.0607)
+
+
+def test_read_header(tmp_path):
+    fileName = str(tmp_path / 'image.aim')
+    with open(fileName, 'wb') as f :
+        f.write(makeAIMBytes())
+
+    aim = AIMFile(fileName)
+    assert aim.type == AIM_TYPE_SHORT
+    assert aim.position == (1, 2, 3)
+    assert aim.dimensions == (2, 2, 1)
+    assert aim.elementSize == (0.5, 0.5, 0.5)
+    assert aim.origin == (0.5, 1.0, 1.5)
+    assert aim.processingLogStart == 160
+    assert aim.imageDataStart == 164
+    assert aim.processingLog == 'log'
+    assert aim.getArray().tolist() == [[[-1, 2], [300, -400]]]
+
+
+def test_write_header(tmp_path):
+    array = np.array([[[-1, 2], [300, -400]]], dtype=np.int16)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([0.5, 0.5, 0.5])
+    image.SetOrigin([0.5, 1.0, 1.5])
+    fileName = str(tmp_path / 'image.aim')
+    writeAIM(fileName, image, 'log\0')
+
+    with open(fileName, 'rb') as f :
+        assert f.read() == makeAIMBytes()
+
+
+def test_write_fields(tmp_path):
+    array = np.zeros((3, 4, 5), dtype=np.int8)
+    fileName = str(tmp_path / 'image.aim')
+    writeAIM(fileName, array, 'processing log', compress=True)
+
+    with open(fileName, 'rb') as f :
+        data = f.read()
+    preHeader = struct.unpack('<5i', data[:20])
+    assert preHeader == (AIM_PRE_HEADER_SIZE, AIM_IMAGE_STRUCT_SIZE, len('processing log'), len(compressBin(array)), 0)
+
+    fields = struct.unpack('<6i21i', data[20:128])
+    assert fields[5] == AIM_TYPE_BINCMP
+    assert fields[6:9] == (0, 0, 0)
+    assert fields[9:12] == (5, 4, 3)
+    assert data[128:140] == floatToVMS(1.0) * 3
+    assert data[160:174] == b'processing log'
+
+
+def test_rejects_aim_v030(tmp_path):
+    fileName = str(tmp_path / 'image.aim')
+    with open(fileName, 'wb') as f :
+        f.write(b'AIMDATA_V030   \0' + b'\0' * 200)
+    with pytest.raises(ValueError) :
+        AIMFile(fileName)
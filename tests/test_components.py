@@ -0,0 +1,58 @@
+#-----------------------------------------------------
+# test_components.py
+#
+# Description: Tests of the slab-wise cl_nr_extract in BHS_components.py against
+#              the in-memory version in BHS_remodelling.py
+#-----------------------------------------------------
+import os
+import sys
+
+import pytest
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BHS_remodelling
+from BHS_components import clNrExtractFile
+
+MIN_NUMBER = 6
+
+
+def makeVolume():
+    # Random voxels (many small components) and components that cross the slab boundaries
+    rng = np.random.default_rng(19)
+    volume = ( rng.random((21, 16, 18)) < 0.3 ).astype(np.uint8)
+
+    # A rod through all slices
+    volume[:, 2, 2] = 1
+    # A U that is only joined in its last slice, so its two arms are separate in every other slab
+    volume[:, 8:11, 8] = 0
+    volume[:, 8:11, 12] = 0
+    volume[:, 9, 8] = 1
+    volume[:, 9, 12] = 1
+    volume[-1, 9, 8:13] = 1
+    volume[:-1, 9, 9:12] = 0
+    return volume
+
+
+@pytest.mark.parametrize('slabSize', [1, 5, 100])
+def test_clNrExtractFile_matches_clNrExtract(tmp_path, slabSize):
+    volume = makeVolume()
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing([0.0607, 0.0607, 0.0607])
+    image.SetOrigin([1.0, -2.0, 3.0])
+    inputPath = str(tmp_path / 'input.mha')
+    outputPath = str(tmp_path / 'output.mha')
+    sitk.WriteImage(image, inputPath)
+
+    clNrExtractFile(inputPath, outputPath, MIN_NUMBER, slabSize=slabSize, numberOfWorkers=2)
+    result = sitk.ReadImage(outputPath)
+    expected = BHS_remodelling.clNrExtract(image, MIN_NUMBER)
+
+    assert result.GetSize() == image.GetSize()
+    assert np.allclose(result.GetOrigin(), image.GetOrigin())
+    assert np.array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected))
+
+    # The U arms have fewer voxels than MIN_NUMBER in most slabs, but are kept as one component
+    assert sitk.GetArrayViewFromImage(result)[0, 9, 8] == 127
+    assert sitk.GetArrayViewFromImage(result)[0, 9, 12] == 127
@@ -0,0 +1,64 @@
+#-----------------------------------------------------
+# test_sitk_vtk.py
+#
+# Description: Tests of the SimpleITK/VTK image conversion in util/util/sitk_vtk.py
+#-----------------------------------------------------
+import os
+import gc
+import sys
+
+import pytest
+import numpy as np
+import SimpleITK as sitk
+
+pytest.importorskip('vtk')
+from vtk.util.numpy_support import vtk_to_numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.util.sitk_vtk import sitk2vtk, vtk2sitk
+
+
+def makeImage():
+    array = np.arange(4 * 5 * 6, dtype=np.int16).reshape(6, 5, 4)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([0.0607, 0.0607, 0.0821])
+    image.SetOrigin([-1.5, 2.25, 10.0])
+    image.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+    return image
+
+
+def test_sitk2vtk_shares_buffer():
+    image = makeImage()
+    vtk_image = sitk2vtk(image)
+    vtk_array = vtk_image.GetPointData().GetScalars()
+
+    imagePointer = sitk.GetArrayViewFromImage(image).__array_interface__['data'][0]
+    vtkPointer = vtk_to_numpy(vtk_array).__array_interface__['data'][0]
+    assert imagePointer == vtkPointer
+
+
+def test_sitk2vtk_keeps_image_alive():
+    image = makeImage()
+    expected = sitk.GetArrayFromImage(image).ravel()
+    vtk_image = sitk2vtk(image)
+    vtk_array = vtk_image.GetPointData().GetScalars()
+
+    assert vtk_array._sitk_image is image
+    del image
+    gc.collect()
+    assert np.array_equal(vtk_to_numpy(vtk_array), expected)
+
+
+def test_round_trip_keeps_image_information():
+    image = makeImage()
+    result = vtk2sitk(sitk2vtk(image))
+
+    assert result.GetSize() == image.GetSize()
+    assert result.GetPixelID() == image.GetPixelID()
+    assert np.allclose(result.GetSpacing(), image.GetSpacing())
+    assert np.allclose(result.GetOrigin(), image.GetOrigin())
+    assert np.array_equal(sitk.GetArrayViewFromImage(result), sitk.GetArrayViewFromImage(image))
+
+    # Image directions were added in VTK 9
+    if hasattr(sitk2vtk(image), 'GetDirectionMatrix') :
+        assert np.allclose(result.GetDirection(), image.GetDirection())
@@ -1,72 +1,267 @@
-#----------------------------------------------------- 
+#-----------------------------------------------------
 # BHS_segTransform.py
 #
 # Created by:   Michael Kuczynski
 # Created on:   05-02-2020
 #
+# Modified on:          18-10-2026
+# Modification Notes:   -The steps are functions that take and return images and transforms, so they
+#                        can be called from other scripts (e.g. BHS_worker.py) without a new process.
+#                       -The transformation matrix is read with sitk.ReadTransform. The old version called
+#                        SetInverse() on the file name and passed the file name to sitk.Resample, so it
+#                        stopped with an error before transforming anything.
+#                       -Any number of moving images (e.g. a whole MRI session and its masks) are transformed
+#                        in one run, in parallel. The transformation matrix is read once and can be inverted
+#                        and composed with other transformation matrices. The transform can be evaluated
+#                        once into a (single precision) displacement field that is shared by all images.
+#
 # Description: Transforms MRI image to XCT image space using a
 #              transformation matrix generated from the BHS_reg.py script.
-#              A linear interpolation is used.
+#              A linear interpolation is used for images and nearest neighbour
+#              interpolation for masks.
 #
 #-----------------------------------------------------
-# Usage: python BHS_segTransform.py arg1 arg2 arg3 arg4
+# Usage: python BHS_segTransform.py arg1 arg2 [arg2 ...] arg3 arg4 [--masks ...] [--compose ...] [--inverse]
+#                                   [--displacement-field file] [-n workers]
 #
 # Where:  arg1 = The fixed (XCT) image
-#         arg2 = The moving (MRI) image
-#         arg3 = The output directory for the transformed image
+#         arg2 = The moving (MRI) image(s)
+#         arg3 = The output directory for the transformed images
 #         arg4 = The transformation matrix (must be .tfm file)
+#
+# Options: --masks = Moving masks/segmented images (nearest neighbour or label Gaussian interpolation)
+#          --compose = More transformation matrices. The fixed image points are mapped by arg4 first,
+#                      then by each of these in the order given.
+#          --inverse = Use the inverse of the (composed) transform
+#          --interpolator = linear or bspline for the moving images (default: linear)
+#          --mask-interpolator = nearest or label for the masks (default: nearest)
+#          --displacement-field = Displacement field file. If it exists and was made from the same
+#                                 transformation matrices (and --inverse), it is used instead of them.
+#                                 If not, the transform is evaluated once on the fixed image grid and
+#                                 written to this file. The transformation matrices (paths and SHA-256
+#                                 of the files) and --inverse are written next to it (<file>.json).
+#                                 The field is read once and the images are transformed one at a time
+#                                 (each on all cores), so that only one copy of the field is in memory.
+#          -n = Number of images to transform at once without a displacement field (default: number of cores)
+#
+# Outputs: <moving basename>_TO_<fixed basename>.nii in the output directory
 #-----------------------------------------------------
 import os
+import json
+import math
+import hashlib
 import argparse
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
 import SimpleITK as sitk
 
-#----------------------------------------------#
-# STEP 1: Read in images
-#----------------------------------------------#
-# Parse input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument( 'fixedImagePath', type=str, help='The segmented XCT image (path + filename).' )
-parser.add_argument( 'movingImagePath', type=str, help='The MRI image (path + filename).' )
-parser.add_argument( 'outDirectory', type=str, help='The output directory to save the transformed image.' )
-parser.add_argument( 'tmatPath', type=str, help='The transformation matrix (path + filename). Muste be a .tfm file.' )
-args = parser.parse_args()
-
-fixedImagePath = args.fixedImagePath
-movingImagePath = args.movingImagePath
-outDirectory = args.outDirectory
-TMAT_path = args.tmatPath
-
-fixedDirectory, fixedFilename = os.path.split( fixedImagePath )
-fixedBasename, fixedExtension = os.path.splitext( fixedFilename )
-movingDirectory, movingFilename = os.path.split( movingImagePath )
-movingBasename, movingExtension = os.path.splitext( movingFilename )
-
-# Make sure the transformation matrix file is .tfm
-if not TMAT_path.endswith('.tfm'):
-    print('Error: The transformation matrix file must be a .tfm file...')
-    sys.exit(1)
-
-# Check if the transformation matrix is invertible
-if TMAT_path.SetInverse() == False :
-    print('No valuable inverse matrix')
-    sys.exit(1)
-
-#----------------------------------------------#
-# STEP 2: Transform image
-#----------------------------------------------#
-# Registered MRI image and transformation matrix (MRI -> XCT image space):
-Moving_to_Fixed_path = os.path.join( outDirectory, movingBasename + '_TO_' + fixedBasename + '.nii' )
-
-# Read images
-print('Reading in {}'.format(fixedImagePath))
-Fixed_image = sitk.ReadImage(fixedImagePath)
-
-print('Reading in {}'.format(movingImagePath))
-Moving_image = sitk.ReadImage( movingImagePath )
-
-print('Resampling')
-Image_resampled = sitk.Resample( Moving_image, Fixed_image, TMAT_path, sitk.sitkLinear, 0.0, Moving_image.GetPixelID() )
-
-print('Writing to {}'.format(Moving_to_Fixed_path))
-sitk.WriteImage( Image_resampled, Moving_to_Fixed_path )
+INTERPOLATORS = {
+    'linear': sitk.sitkLinear,
+    'bspline': sitk.sitkBSpline,
+    'nearest': sitk.sitkNearestNeighbor,
+    'label': sitk.sitkLabelGaussian
+}
+
+# Transforms and displacement fields already read by this process
+loadedTransforms = {}
+
+
+def readTransform(TMAT_path) :
+    # Make sure the transformation matrix file is .tfm
+    if not TMAT_path.endswith('.tfm'):
+        raise ValueError('The transformation matrix file must be a .tfm file: {}'.format(TMAT_path))
+
+    return sitk.ReadTransform(TMAT_path)
+
+
+def composeTransforms(transforms, inverse=False) :
+    # One transform that maps points by transforms[0] first, then transforms[1], ...
+    # (a CompositeTransform applies its last transform first)
+    composite = sitk.CompositeTransform( list(reversed(transforms)) )
+    composite.FlattenTransform()
+
+    # Only a transform that is used inverted has to be invertible
+    if inverse :
+        try :
+            composite = composite.GetInverse()
+        except RuntimeError :
+            raise ValueError('No valuable inverse matrix for the (composed) transform')
+    return composite
+
+
+def loadTransform(TMAT_paths, inverse=False) :
+    # Read one or more transformation matrices and compose them (see composeTransforms)
+    # The transform is only read once per process
+    if isinstance(TMAT_paths, str) :
+        TMAT_paths = [TMAT_paths]
+    key = (tuple(TMAT_paths), inverse)
+    if key not in loadedTransforms :
+        loadedTransforms[key] = composeTransforms([readTransform(TMAT_path) for TMAT_path in TMAT_paths], inverse)
+    return loadedTransforms[key]
+
+
+def readImageInformation(imagePath) :
+    # Size, origin, spacing and direction of an image, without reading the voxel data
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(imagePath)
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(), reader.GetDirection()
+
+
+def getFieldSource(TMAT_paths, inverse=False) :
+    # The transformation matrices (path and SHA-256 of the file) and inverse flag of a displacement field
+    source = {'transforms': [], 'inverse': inverse}
+    for TMAT_path in TMAT_paths :
+        if not os.path.isfile(TMAT_path) :
+            raise ValueError('Cannot read the transformation matrix file: {}'.format(TMAT_path))
+        with open(TMAT_path, 'rb') as f :
+            source['transforms'].append({'path': os.path.abspath(TMAT_path), 'sha256': hashlib.sha256(f.read()).hexdigest()})
+    return source
+
+
+def readFieldSource(displacementFieldPath) :
+    # The source written with the displacement field (None if there is none)
+    try :
+        with open(displacementFieldPath + '.json') as f :
+            return json.load(f)
+    except (OSError, ValueError) :
+        return None
+
+
+def makeDisplacementField(transform, fixedImagePath, displacementFieldPath, source=None) :
+    # Evaluate the transform once for every voxel of the fixed image grid and write it out
+    # The source is written last, so a field that was not written completely is never reused
+    if os.path.isfile(displacementFieldPath + '.json') :
+        os.remove(displacementFieldPath + '.json')
+    size, origin, spacing, direction = readImageInformation(fixedImagePath)
+    # Single precision halves the memory and file size of the field (3 components per fixed image voxel)
+    field = sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat32, size, origin, spacing, direction)
+    sitk.WriteImage(field, displacementFieldPath)
+    loadedTransforms.pop(displacementFieldPath, None)
+
+    if source is not None :
+        with open(displacementFieldPath + '.json', 'w') as f :
+            json.dump(source, f, indent=2)
+
+
+def readDisplacementField(displacementFieldPath, fixedImagePath) :
+    # Read a displacement field once per process. It must have the fixed image grid.
+    # The field is kept as an image: sitk.DisplacementFieldTransform would need a double precision copy.
+    if displacementFieldPath not in loadedTransforms :
+        field = sitk.ReadImage(displacementFieldPath, sitk.sitkVectorFloat32)
+        size, origin, spacing, direction = readImageInformation(fixedImagePath)
+        sameGrid = field.GetSize() == size and all( math.isclose(a, b, abs_tol=1e-5) for a, b in
+                                                    zip(field.GetOrigin() + field.GetSpacing() + field.GetDirection(), origin + spacing + direction) )
+        if not sameGrid :
+            raise ValueError('The displacement field {} does not have the grid of {}'.format(displacementFieldPath, fixedImagePath))
+        loadedTransforms[displacementFieldPath] = field
+    return loadedTransforms[displacementFieldPath]
+
+
+def transformImage(movingImage, fixedImage, transform, interpolator=sitk.sitkLinear) :
+    # Resample the moving image onto the fixed image grid. The output keeps the moving image pixel type.
+    return sitk.Resample( movingImage, fixedImage, transform, interpolator, 0.0, movingImage.GetPixelID() )
+
+
+def transformFile(movingImagePath, fixedImagePath, outputPath, TMAT_paths=(), inverse=False, interpolator=sitk.sitkLinear,
+                  displacementFieldPath=None) :
+    # Read, transform and write one moving image. Only the header of the fixed image is read.
+    # The transform is given as file names (transforms are read once per worker process, not sent to it)
+    # A displacement field has the fixed image grid, and the image is warped with it
+    movingImage = sitk.ReadImage(movingImagePath)
+    if displacementFieldPath :
+        field = readDisplacementField(displacementFieldPath, fixedImagePath)
+        resampled = sitk.Warp( movingImage, field, interpolator, field.GetSize(), field.GetOrigin(), field.GetSpacing(), field.GetDirection(), 0.0 )
+    else :
+        transform = loadTransform(TMAT_paths, inverse)
+        size, origin, spacing, direction = readImageInformation(fixedImagePath)
+        resampled = sitk.Resample( movingImage, size, transform, interpolator, origin, spacing, direction, 0.0, movingImage.GetPixelID() )
+    sitk.WriteImage(resampled, outputPath)
+
+    return outputPath
+
+
+def getOutputPath(fixedImagePath, movingImagePath, outDirectory) :
+    # Registered MRI image (MRI -> XCT image space): <moving>_TO_<fixed>.nii
+    fixedBasename = os.path.splitext( os.path.basename(fixedImagePath) )[0]
+    movingBasename = os.path.splitext( os.path.basename(movingImagePath) )[0]
+    return os.path.join( outDirectory, movingBasename + '_TO_' + fixedBasename + '.nii' )
+
+
+def BHS_segTransform(fixedImagePath, movingImagePath, outDirectory, TMAT_path, maskImagePaths=(), composePaths=(),
+                     inverse=False, interpolator='linear', maskInterpolator='nearest', displacementFieldPath=None,
+                     numberOfWorkers=None) :
+    # Transform one moving image (movingImagePath is a file name) or several (a list of file names).
+    # Returns the output file name(s).
+    movingImagePaths = [movingImagePath] if isinstance(movingImagePath, str) else list(movingImagePath)
+
+    #----------------------------------------------#
+    # STEP 1: Read in the transform
+    #----------------------------------------------#
+    TMAT_paths = [TMAT_path] + list(composePaths)
+
+    # An existing displacement field is only used if it was made from the same transform
+    source = getFieldSource(TMAT_paths, inverse) if displacementFieldPath else None
+    if displacementFieldPath and os.path.isfile(displacementFieldPath) and readFieldSource(displacementFieldPath) == source :
+        print('Using the displacement field {}'.format(displacementFieldPath))
+    else :
+        # Read here first so that a bad transformation matrix stops the run before any image is read
+        for path in TMAT_paths :
+            print('Reading in {}'.format(path))
+        transform = loadTransform(TMAT_paths, inverse)
+
+        if displacementFieldPath :
+            if os.path.isfile(displacementFieldPath) :
+                print('The displacement field {} was not made from these transformation matrices'.format(displacementFieldPath))
+            print('Writing displacement field to {}'.format(displacementFieldPath))
+            makeDisplacementField(transform, fixedImagePath, displacementFieldPath, source)
+
+    #----------------------------------------------#
+    # STEP 2: Transform images
+    #----------------------------------------------#
+    jobs = [ (imagePath, INTERPOLATORS[interpolator]) for imagePath in movingImagePaths ] + \
+           [ (imagePath, INTERPOLATORS[maskInterpolator]) for imagePath in maskImagePaths ]
+
+    outputPaths = []
+    if displacementFieldPath :
+        # Every worker process would hold its own copy of the field. Read it once here instead and
+        # transform the images one at a time (sitk.Warp uses all cores).
+        readDisplacementField(displacementFieldPath, fixedImagePath)
+        for imagePath, imageInterpolator in jobs :
+            outputPaths.append( transformFile(imagePath, fixedImagePath, getOutputPath(fixedImagePath, imagePath, outDirectory),
+                                              TMAT_paths, inverse, imageInterpolator, displacementFieldPath) )
+            print('Writing {} to {}'.format(imagePath, outputPaths[-1]))
+    else :
+        with ProcessPoolExecutor(max_workers=numberOfWorkers or None) as executor :
+            futures = [ executor.submit(transformFile, imagePath, fixedImagePath, getOutputPath(fixedImagePath, imagePath, outDirectory),
+                                        TMAT_paths, inverse, imageInterpolator) for imagePath, imageInterpolator in jobs ]
+            for (imagePath, _), future in zip(jobs, futures) :
+                outputPaths.append( future.result() )
+                print('Writing {} to {}'.format(imagePath, outputPaths[-1]))
+
+    return outputPaths[0] if isinstance(movingImagePath, str) and not maskImagePaths else outputPaths
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'fixedImagePath', type=str, help='The segmented XCT image (path + filename).' )
+    parser.add_argument( 'movingImagePaths', type=str, nargs='+', help='The MRI image(s) (path + filename).' )
+    parser.add_argument( 'outDirectory', type=str, help='The output directory to save the transformed images.' )
+    parser.add_argument( 'tmatPath', type=str, help='The transformation matrix (path + filename). Muste be a .tfm file.' )
+    parser.add_argument( '--masks', type=str, nargs='+', default=[], help='Moving masks/segmented images (path + filename).' )
+    parser.add_argument( '--compose', type=str, nargs='+', default=[], help='More transformation matrices, applied after tmatPath in the order given.' )
+    parser.add_argument( '--inverse', action='store_true', help='Use the inverse of the (composed) transform.' )
+    parser.add_argument( '--interpolator', type=str, default='linear', choices=['linear', 'bspline'], help='Interpolator for the moving images (default: linear).' )
+    parser.add_argument( '--mask-interpolator', dest='maskInterpolator', type=str, default='nearest', choices=['nearest', 'label'], help='Interpolator for the masks (default: nearest).' )
+    parser.add_argument( '--displacement-field', dest='displacementField', type=str, default='', help='Displacement field file to use, or to write if it does not exist.' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Number of images to transform at once without a displacement field (default: number of cores).' )
+    args = parser.parse_args()
+
+    try :
+        BHS_segTransform(args.fixedImagePath, args.movingImagePaths, args.outDirectory, args.tmatPath, args.masks, args.compose,
+                         args.inverse, args.interpolator, args.maskInterpolator, args.displacementField, args.workers)
+    except ValueError as e :
+        print('Error: {}'.format(e))
+        sys.exit(1)
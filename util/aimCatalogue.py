@@ -0,0 +1,200 @@
+#-----------------------------------------------------
+# aimCatalogue.py
+#
+# Created on:   18-10-2026
+#
+# Description: Keeps a SQLite catalogue of AIM and MHA images and their processing logs,
+#              so that image metadata can be queried without reading headers or images again.
+#              For each image, the catalogue has:
+#                   -the BHS subject, visit (months), joint and stack from the file name
+#                   -the image dimensions, element size and origin
+#                   -the processing log fields (see AIM_LOG_FIELDS in util/aimLog.py), e.g.
+#                    mu scaling, density calibration and seg/gray image type
+#              Images are only read again if their size or modification time changed.
+#-----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python aimCatalogue.py index <catalogue.db> <inputDirectory or glob> [...]
+#    OR:
+#    python aimCatalogue.py query <catalogue.db> [--subject 030] [--visit 12] [--joint MCP2] [--stack MID] [--type seg]
+#
+# Notes:
+#    -MHA images get their processing log from <basename>.txt next to the image (as written by
+#     fileConverter.py).
+#    -File names follow the BHS naming convention: BHS_<subject>_<visit>_<joint>[_<stack>][_SEG].
+#     The fields are empty for other file names.
+#-----------------------------------------------------
+
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+from util.aimIO import AIMFile
+from util.aimLog import AIM_LOG_FIELDS, parseAIMLog, readAIMLog
+from util.imageNames import getBaseName, findImages, parseImageName, splitImageName
+
+import SimpleITK as sitk
+
+# Name -> SQLite type of the catalogue columns
+CATALOGUE_COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('mtime', 'REAL'),
+    ('size', 'INTEGER'),
+    ('format', 'TEXT'),
+    ('log_path', 'TEXT'),
+    ('subject', 'TEXT'),
+    ('visit', 'INTEGER'),
+    ('joint', 'TEXT'),
+    ('stack', 'TEXT'),
+    ('image_type', 'TEXT'),
+    ('dim_x', 'INTEGER'), ('dim_y', 'INTEGER'), ('dim_z', 'INTEGER'),
+    ('el_size_x', 'REAL'), ('el_size_y', 'REAL'), ('el_size_z', 'REAL'),
+    ('origin_x', 'REAL'), ('origin_y', 'REAL'), ('origin_z', 'REAL')
+] + [ (key, 'TEXT' if valueType is str or key.startswith('isq_dim') else ('INTEGER' if valueType is int else 'REAL'))
+      for key, valueType in AIM_LOG_FIELDS.values() ] + [
+    ('log_fields', 'TEXT')
+]
+
+def getImageFormat(imagePath) :
+    return {'.aim': 'aim', '.mha': 'mha'}.get( splitImageName(imagePath)[1] )
+
+
+def parseBHSName(imagePath) :
+    # Subject, visit, joint and stack from a BHS_<subject>_<visit>MO_<joint>[_<stack>][_SEG] name
+    info = parseImageName(imagePath) or {}
+    return {key: info.get(key) for key in ('subject', 'visit', 'joint', 'stack')}
+
+
+def openCatalogue(catalogueFileName) :
+    connection = sqlite3.connect(catalogueFileName)
+    connection.row_factory = sqlite3.Row
+    connection.execute( 'CREATE TABLE IF NOT EXISTS images ({})'.format(', '.join(name + ' ' + columnType for name, columnType in CATALOGUE_COLUMNS)) )
+    for column in ('subject', 'visit', 'joint', 'image_type') :
+        connection.execute( 'CREATE INDEX IF NOT EXISTS images_{0} ON images ({0})'.format(column) )
+    return connection
+
+
+def readImageRecord(imagePath) :
+    # Read the header and processing log of one image (the voxel data is not read)
+    imageFormat = getImageFormat(imagePath)
+    if imageFormat == 'aim' :
+        aim = AIMFile(imagePath)
+        dimensions, elementSize, origin = aim.dimensions, aim.elementSize, aim.origin
+        logPath = None
+        log = parseAIMLog(aim.processingLog)
+    else :
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(imagePath)
+        reader.ReadImageInformation()
+        dimensions, elementSize, origin = reader.GetSize(), reader.GetSpacing(), reader.GetOrigin()
+        logPath = os.path.join(os.path.dirname(imagePath), getBaseName(imagePath) + '.txt')
+        log = readAIMLog(logPath) if os.path.isfile(logPath) else parseAIMLog('')
+        if not os.path.isfile(logPath) :
+            logPath = None
+
+    stat = os.stat(imagePath)
+    record = {
+        'path': os.path.abspath(imagePath),
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'format': imageFormat,
+        'log_path': os.path.abspath(logPath) if logPath else None
+    }
+    record.update( parseBHSName(imagePath) )
+    record.update({
+        'dim_x': dimensions[0], 'dim_y': dimensions[1], 'dim_z': dimensions[2],
+        'el_size_x': elementSize[0], 'el_size_y': elementSize[1], 'el_size_z': elementSize[2],
+        'origin_x': origin[0], 'origin_y': origin[1], 'origin_z': origin[2]
+    })
+    for key, _ in AIM_LOG_FIELDS.values() :
+        record[key] = json.dumps(log[key]) if isinstance(log[key], list) else log[key]
+    # Without a processing log, the image type is taken from the file name
+    record['image_type'] = log['image_type']
+    if record['image_type'] is None and getBaseName(imagePath).upper().endswith('_SEG') :
+        record['image_type'] = 'seg'
+    record['log_fields'] = json.dumps(log['fields'])
+
+    return record
+
+
+def updateCatalogue(catalogueFileName, imagePaths) :
+    # Add new images to the catalogue and update changed ones. Returns the number of images read.
+    connection = openCatalogue(catalogueFileName)
+    known = { row['path']: (row['mtime'], row['size']) for row in connection.execute('SELECT path, mtime, size FROM images') }
+
+    columns = [name for name, _ in CATALOGUE_COLUMNS]
+    insert = 'INSERT OR REPLACE INTO images ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' * len(columns)))
+
+    numberRead = 0
+    with connection :
+        for imagePath in imagePaths :
+            stat = os.stat(imagePath)
+            if known.get(os.path.abspath(imagePath)) == (stat.st_mtime, stat.st_size) :
+                continue
+            try :
+                record = readImageRecord(imagePath)
+            except Exception as e :
+                print('Warning: Could not read {} ({})'.format(imagePath, e))
+                continue
+            connection.execute(insert, [record[column] for column in columns])
+            numberRead += 1
+
+    connection.close()
+    return numberRead
+
+
+def queryCatalogue(catalogueFileName, subject=None, visit=None, joint=None, stack=None, imageType=None, imageFormat=None) :
+    # Returns the catalogue rows (as dictionaries) that match all of the given values
+    filters = {'subject': subject, 'visit': visit, 'joint': joint and joint.upper(), 'stack': stack and stack.upper(),
+               'image_type': imageType, 'format': imageFormat}
+    filters = {column: value for column, value in filters.items() if value is not None}
+
+    query = 'SELECT * FROM images'
+    if filters :
+        query += ' WHERE ' + ' AND '.join('{} = ?'.format(column) for column in filters)
+    query += ' ORDER BY subject, visit, joint, stack, path'
+
+    connection = openCatalogue(catalogueFileName)
+    rows = [dict(row) for row in connection.execute(query, list(filters.values()))]
+    connection.close()
+    return rows
+
+
+if __name__ == '__main__' :
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    indexParser = subparsers.add_parser('index', help='Add images to the catalogue')
+    indexParser.add_argument( 'catalogue', type=str, help='The catalogue file (SQLite database)' )
+    indexParser.add_argument( 'inputs', type=str, nargs='+', help='Directories or globs of AIM/MHA images' )
+
+    queryParser = subparsers.add_parser('query', help='List the images that match all of the given values')
+    queryParser.add_argument( 'catalogue', type=str, help='The catalogue file (SQLite database)' )
+    queryParser.add_argument( '--subject', type=str, default=None, help='Subject, e.g. 030' )
+    queryParser.add_argument( '--visit', type=int, default=None, help='Visit in months, e.g. 12' )
+    queryParser.add_argument( '--joint', type=str, default=None, help='Joint, e.g. MCP2' )
+    queryParser.add_argument( '--stack', type=str, default=None, help='Stack, e.g. MID' )
+    queryParser.add_argument( '--type', dest='imageType', type=str, default=None, choices=['seg', 'gray'], help='Segmented or grayscale images' )
+    queryParser.add_argument( '--format', dest='imageFormat', type=str, default=None, choices=['aim', 'mha'], help='Image file format' )
+    queryParser.add_argument( '--json', action='store_true', help='Print every catalogue field as JSON instead of the image paths' )
+    args = parser.parse_args()
+
+    if args.command == 'index' :
+        imagePaths = [imagePath for inputPath in args.inputs for imagePath in findImages(inputPath)]
+        numberRead = updateCatalogue(args.catalogue, imagePaths)
+        print('Found {} images, {} new or changed'.format(len(imagePaths), numberRead))
+
+    elif args.command == 'query' :
+        rows = queryCatalogue(args.catalogue, args.subject, args.visit, args.joint, args.stack, args.imageType, args.imageFormat)
+        if args.json :
+            print(json.dumps(rows, indent=2))
+        else :
+            for row in rows :
+                print(row['path'])
+
+    else :
+        parser.print_help()
+        sys.exit(1)
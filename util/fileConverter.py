@@ -9,6 +9,22 @@
 # Modification Notes:   -Modified original file converter script to only handle MHA and AIM files 
 #                        for the manuscript: S.C. Brunet et al. Calcif. Tissue Int. Submitted July 2020.
 #
+# Modified on:          18-10-2026
+# Modification Notes:   -AIM files are read and written with the NumPy AIM reader/writer in util/aimIO.py.
+#                        AIM voxel data is memory mapped and streamed to the MHA file, so large AIMs
+#                        no longer need several full copies in memory. The image position is kept.
+#                        vtkbone can still be used to read and write AIMs with --vtkbone.
+#                       -AXIS ORDER CHANGE: The old AIM to MHA conversion swapped the x and z axes
+#                        (a 4 x 5 x 6 AIM became a 6 x 5 x 4 MHA) and wrote a 1 mm spacing and zero origin.
+#                        Both readers (including --vtkbone) now keep the AIM axis order, element size and
+#                        position. MHAs converted by the old version are transposed relative to new ones,
+#                        and nothing detects this: reconvert them from the AIMs before mixing them with new
+#                        conversions (e.g. old and new visits of one cohort).
+#                       -Batch mode: a directory or glob of images is converted on a process pool.
+#                        Outputs that are newer than their input are skipped.
+#                       -AIM version numbers (;N) are no longer removed by renaming the input file.
+#                        They are only left out of the output file names.
+#
 # Description: Converts between MHA and AIM images.
 #              Currently supported conversions:
 #                   1. MHA to AIM
@@ -19,27 +35,115 @@
 # 2. python fileConverter.py <inputImage.ext> <outputImage.ext>
 #    OR:
 #    python fileConverter.py <inputImage.ext> <outputImage.ext> -l <AIMProcessingLog.txt>
+#    OR (to use vtkbone to read and write AIMs):
+#    python fileConverter.py <inputImage.ext> <outputImage.ext> -l <AIMProcessingLog.txt> --vtkbone
+#    OR (batch mode, to convert every image in a directory or matching a glob):
+#    python fileConverter.py <inputDirectory> <outputDirectory> --to mha -n 8
+#    python fileConverter.py "<inputDirectory>/*12MO*.AIM*" <outputDirectory> --to mha
 #
 # Notes: 
 #    -You may add another argument for AIM processing logs. If you don't provide this argument
 #     when reading in an AIM, the output base file name will be used to generate the header text file.
 #     When writing out an AIM, you MUST provide the processing log .TXT file.
+#    -In batch mode, AIM processing logs are written to <outputDirectory>/<basename>.txt. MHA images
+#     are converted to AIM with the processing log <basename>.txt next to the MHA image (as written
+#     by an AIM to MHA batch conversion). Outputs newer than their input are skipped unless --force is given.
 #-----------------------------------------------------
 
+import io
 import os
 import sys
+import glob
 import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from util.searchAIMLog import searchAIMLog
-from util.sitk_vtk import sitk2vtk, vtk2sitk
-
-import vtk
-import vtkbone
+from util.aimLog import isSegmentedLog
+from util.aimIO import AIMFile, writeAIM
+from util.imageNames import getBaseName, findImages
 
+import numpy as np
 import SimpleITK as sitk
 
 
-def fileConverter(inputImage, outputImage, AIMProcessingLog) :
+def readAIMVTKBone(inputImage) :
+    # Read an AIM with vtkbone and return the SimpleITK image and processing log
+    # vtkbone is only imported here so that it is not needed for the default AIM reader
+    import vtk
+    import vtkbone
+    from util.sitk_vtk import vtk2sitk
+
+    # Read in the AIM
+    imageReader = vtkbone.vtkboneAIMReader()
+    imageReader.SetFileName(inputImage)
+    imageReader.DataOnCellsOff()
+    imageReader.Update()
+    inputHeader = imageReader.GetProcessingLog()
+
+    # Determine scalar type to use
+    #   VTK_CHAR <-> D1char
+    #   VTK_SHORT <-> D1short
+    #   If it is of type BIT, CHAR, SIGNED CHAR, or UNSIGNED CHAR it is possible
+    #   to store in a CHAR.
+    inputScalarType = imageReader.GetOutput().GetScalarType()
+
+    if (inputScalarType == vtk.VTK_BIT or inputScalarType == vtk.VTK_CHAR or
+        inputScalarType == vtk.VTK_SIGNED_CHAR or
+        inputScalarType == vtk.VTK_UNSIGNED_CHAR) :
+
+        # Make sure the image will fit in the range
+        #   It is possible that the chars are defined in such a way that either
+        #   signed or unsigned chars don't fit inside the char. We can be safe
+        #   buy checking if the image range will fit inside the VTK_CHAR
+        scalarRange = imageReader.GetOutput().GetScalarRange()
+        if scalarRange[0] >= vtk.VTK_SHORT_MIN and scalarRange[1] <= vtk.VTK_SHORT_MAX :
+            outputScalarType = vtk.VTK_CHAR
+        else :
+            outputScalarType = vtk.VTK_SHORT
+    else :
+        outputScalarType = vtk.VTK_SHORT
+
+    # Cast
+    caster = vtk.vtkImageCast()
+    caster.SetOutputScalarType(outputScalarType)
+    caster.SetInputConnection(imageReader.GetOutputPort())
+    caster.ReleaseDataFlagOff()
+    caster.Update()
+
+    # Get VTK and SITK images
+    vtk_image = caster.GetOutput()
+    return vtk2sitk(vtk_image), inputHeader
+
+
+def writeAIMVTKBone(inputImage, outputImageFileName, header, segFile) :
+    # Write an MHA image as an AIM with vtkbone
+    import vtk
+    import vtkbone
+
+    # Need to cast grayscale images to VTK_SHORT type and binary images to VTK_CHAR type to display properly on the OpenVMS system
+    img = vtk.vtkMetaImageReader()
+    img.SetFileName(inputImage)
+    img.Update()
+
+    caster = vtk.vtkImageCast()
+    caster.SetInputData(img.GetOutput())
+    caster.SetOutputScalarType(vtk.VTK_CHAR if segFile else vtk.VTK_SHORT)
+    caster.ReleaseDataFlagOff()
+    caster.Update()
+
+    writer = vtkbone.vtkboneAIMWriter()
+    writer.SetInputData(caster.GetOutput())
+    writer.SetFileName( str(outputImageFileName) )
+
+    # Do not create a new processing log as this will add extra values that 
+    # will cause problems when processing the new AIM in IPL
+    writer.NewProcessingLogOff()    
+    writer.SetProcessingLog(header)
+    
+    writer.Update() 
+
+
+def fileConverter(inputImage, outputImage, AIMProcessingLog, useVTKBone=False) :
     print('******************************************************')
     print(f'CONVERTING: {inputImage} to {outputImage}')
 
@@ -69,14 +173,9 @@ def fileConverter(inputImage, outputImage, AIMProcessingLog) :
         inBasename, inExtension = os.path.splitext(inFilename)
 
         # Setup the correct reader based on the input image extension
+        # AIM files copied from the OpenVMS system may still have a version number (e.g. IMAGE.AIM;1)
         if '.aim' in inExtension.lower() :
 
-            # If the input AIM contains a version number, remove it and rename the file
-            if ';' in inExtension.lower() :
-                inputImageNew = inputImage.rsplit(';', 1)[0]
-                os.rename(inputImage, inputImageNew)
-                inputImage = inputImageNew
-
             # Get the processing log file extension
             procLogDir, procLogFilename = os.path.split(AIMProcessingLog.lower())
             procLogBasename, procLogExtension = os.path.splitext(procLogFilename)
@@ -89,130 +188,161 @@ def fileConverter(inputImage, outputImage, AIMProcessingLog) :
             else :
                 print('WRITING PROCESSING LOG: ' + AIMProcessingLog)   
 
-            # Read in the AIM
-            imageReader = vtkbone.vtkboneAIMReader()
-            imageReader.SetFileName(inputImage)
-            imageReader.DataOnCellsOff()
-            imageReader.Update()
-            inputHeader = imageReader.GetProcessingLog()
+            if useVTKBone :
+                sitk_image, inputHeader = readAIMVTKBone(inputImage)
+            else :
+                # Only the header is read here. The voxel data is memory mapped when it is written out.
+                # Char images stay char, everything else is stored as short (as with vtkbone).
+                aim = AIMFile(inputImage)
+                inputHeader = aim.processingLog
+                aimPixelType = np.int8 if aim.dtype == np.int8 else np.int16
 
             # Write out the processing log as a txt file
-            f = open(AIMProcessingLog, 'w')
-            f.write(inputHeader)
-
-            # Determine scalar type to use
-            #   VTK_CHAR <-> D1char
-            #   VTK_SHORT <-> D1short
-            #   If it is of type BIT, CHAR, SIGNED CHAR, or UNSIGNED CHAR it is possible
-            #   to store in a CHAR.
-            inputScalarType = imageReader.GetOutput().GetScalarType()
-
-            if (inputScalarType == vtk.VTK_BIT or inputScalarType == vtk.VTK_CHAR or
-                inputScalarType == vtk.VTK_SIGNED_CHAR or
-                inputScalarType == vtk.VTK_UNSIGNED_CHAR) :
-
-                # Make sure the image will fit in the range
-                #   It is possible that the chars are defined in such a way that either
-                #   signed or unsigned chars don't fit inside the char. We can be safe
-                #   buy checking if the image range will fit inside the VTK_CHAR
-                scalarRange = imageReader.GetOutput().GetScalarRange()
-                if scalarRange[0] >= vtk.VTK_SHORT_MIN and scalarRange[1] <= vtk.VTK_SHORT_MAX :
-                    outputScalarType = vtk.VTK_CHAR
-                else :
-                    outputScalarType = vtk.VTK_SHORT
-            else :
-                outputScalarType = vtk.VTK_SHORT
-        
-            # Cast
-            caster = vtk.vtkImageCast()
-            caster.SetOutputScalarType(outputScalarType)
-            caster.SetInputConnection(imageReader.GetOutputPort())
-            caster.ReleaseDataFlagOff()
-            caster.Update()
-
-            # Get VTK and SITK images
-            vtk_image = caster.GetOutput()
-            sitk_image = vtk2sitk(vtk_image)
+            with open(AIMProcessingLog, 'w') as f :
+                f.write(inputHeader)
 
         else :
+            aim = None
             sitk_image = sitk.ReadImage(inputImage)
 
     # Check if the input is a directory
     elif os.path.isdir(inputImage) :
         # DIRECTORY:
         print()
-        print('Error: Please provide a valid file, not a directory!')
+        print('Error: Please provide a valid file, not a directory! Directories are converted with fileConverterBatch().')
         sys.exit(1)
 
     # Setup the correct writer based on the output image extension
     if outExtension.lower() == '.mha' :
         print('WRITING IMAGE: ' + str(outputImage))
-        sitk.WriteImage(sitk_image, str(outputImageFileName))
+        if '.aim' in inExtension.lower() and not useVTKBone :
+            # Stream the AIM voxel data straight to the MHA file
+            aim.writeMHA(str(outputImageFileName), aimPixelType)
+        else :
+            sitk.WriteImage(sitk_image, str(outputImageFileName))
 
     elif outExtension.lower() == '.aim' :
         print('WRITING IMAGE: ' + str(outputImage))
 
-        # Handle the special case of MHA to AIM to avoid crashing due to SITK to VTK conversion
-        # Need to cast grayscale images to VTK_SHORT type and binary images to VTK_CHAR type to display properly on the OpenVMS system
-        # Scan the AIM log file to determine if the image is segmented or grayscale
-        segFile = searchAIMLog(AIMProcessingLog)
+        # Open the processing log for reading
+        with open(AIMProcessingLog, 'r') as f :
+            header = f.read()
 
-        if segFile and inExtension.lower() == '.mha' :
-            img = vtk.vtkMetaImageReader()
-            img.SetFileName(inputImage)
-            img.Update()
+        # Need to cast grayscale images to short and binary images to char to display properly on the OpenVMS system
+        # Scan the AIM log to determine if the image is segmented or grayscale
+        segFile = isSegmentedLog(header)
 
-            caster = vtk.vtkImageCast()
-            caster.SetInputData(img.GetOutput())
-            caster.SetOutputScalarType(vtk.VTK_CHAR)
-            caster.ReleaseDataFlagOff()
-            caster.Update()
+        if useVTKBone :
+            writeAIMVTKBone(inputImage, outputImageFileName, header, segFile)
+        else :
+            if aim is not None :
+                sitk_image = aim.getImage()
+            writeAIM( str(outputImageFileName), sitk.Cast(sitk_image, sitk.sitkInt8 if segFile else sitk.sitkInt16), header )
 
-            vtk_image = caster.GetOutput()
+    print ('DONE')
+    print('******************************************************')
+    print()
 
-        elif not segFile and inExtension.lower() == '.mha':
-            img = vtk.vtkMetaImageReader()
-            img.SetFileName(inputImage)
-            img.Update()
 
-            caster = vtk.vtkImageCast()
-            caster.SetInputData(img.GetOutput())
-            caster.SetOutputScalarType(vtk.VTK_SHORT)
-            caster.ReleaseDataFlagOff()
-            caster.Update()
+def getBatchJob(inputImage, outDirectory, outExtension) :
+    # Output image and processing log of one batch conversion
+    basename = getBaseName(inputImage)
+    outputImage = os.path.join(outDirectory, basename + outExtension)
+    if outExtension == '.aim' :
+        AIMProcessingLog = os.path.join(os.path.dirname(inputImage), basename + '.txt')
+    else :
+        AIMProcessingLog = os.path.join(outDirectory, basename + '.txt')
+    return inputImage, outputImage, AIMProcessingLog
+
+
+def isUpToDate(inputImage, outputImage, AIMProcessingLog) :
+    # The output (and the processing log written with it) must be newer than the input
+    outputs = [outputImage]
+    if '.aim' in os.path.splitext(inputImage)[1].lower() :
+        outputs.append(AIMProcessingLog)
+    inputTime = os.path.getmtime(inputImage)
+    return all( os.path.isfile(output) and os.path.getmtime(output) >= inputTime for output in outputs )
+
+
+def convertJob(job, useVTKBone=False) :
+    # Run one conversion in a worker process. The console output is kept in case the conversion fails.
+    output = io.StringIO()
+    try :
+        with contextlib.redirect_stdout(output) :
+            fileConverter(*job, useVTKBone)
+    except SystemExit :
+        # fileConverter() prints the error before it exits
+        return job, False, output.getvalue().strip().splitlines()[-1:]
+    except Exception as e :
+        return job, False, [repr(e)]
+    return job, True, []
+
+
+def fileConverterBatch(inputPath, outDirectory, outExtension='.mha', numberOfWorkers=None, force=False, useVTKBone=False,
+                       catalogueFileName=None) :
+    outExtension = '.' + outExtension.lower().lstrip('.')
+    if outExtension not in ('.mha', '.aim') :
+        print()
+        print('Error: output file extension must be MHA or AIM')
+        sys.exit(1)
 
-            vtk_image = caster.GetOutput()
-    
-        # Open the processing log for reading
-        f = open(AIMProcessingLog, 'r')
-        header = f.read()
+    # Only convert images that are not already in the output format
+    inputImages = [imagePath for imagePath in findImages(inputPath)
+                   if os.path.splitext( imagePath.rsplit(';', 1)[0] )[1].lower() != outExtension]
+    if not inputImages :
+        print()
+        print('Error: No AIM or MHA images found in ' + inputPath)
+        sys.exit(1)
 
-        writer = vtkbone.vtkboneAIMWriter()
-        writer.SetInputData(vtk_image)
-        writer.SetFileName( str(outputImageFileName) )
+    os.makedirs(outDirectory, exist_ok=True)
+    jobs = [getBatchJob(inputImage, outDirectory, outExtension) for inputImage in inputImages]
+    todo = [job for job in jobs if force or not isUpToDate(*job)]
+    print('Found {} images, {} up to date, {} to convert'.format(len(jobs), len(jobs) - len(todo), len(todo)))
 
-        # Do not create a new processing log as this will add extra values that 
-        # will cause problems when processing the new AIM in IPL
-        writer.NewProcessingLogOff()    
-        writer.SetProcessingLog(header)
-        
-        writer.Update() 
+    failed = []
+    with ProcessPoolExecutor(max_workers=numberOfWorkers or None) as executor :
+        futures = [executor.submit(convertJob, job, useVTKBone) for job in todo]
+        for i, future in enumerate(as_completed(futures), 1) :
+            job, success, messages = future.result()
+            print('[{}/{}] {} -> {}: {}'.format(i, len(todo), os.path.basename(job[0]), os.path.basename(job[1]), 'DONE' if success else 'FAILED'))
+            if not success :
+                failed.append( (job, messages) )
 
-    print ('DONE')
     print('******************************************************')
-    print()
+    print('CONVERTED: {}  SKIPPED: {}  FAILED: {}'.format(len(todo) - len(failed), len(jobs) - len(todo), len(failed)))
+    for job, messages in failed :
+        print('FAILED: {} ({})'.format(job[0], ' '.join(messages)))
+    print('******************************************************')
+
+    # Add the inputs and outputs to the image catalogue (see aimCatalogue.py)
+    if catalogueFileName :
+        from aimCatalogue import updateCatalogue
+        convertedImages = [path for job in jobs for path in job[:2] if os.path.isfile(path)]
+        print('Updated {} images in {}'.format(updateCatalogue(catalogueFileName, convertedImages), catalogueFileName))
+
+    return failed
 
 
 if __name__ == '__main__' :
     # Parse input arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument( 'inputImage', type=str, help='The input image (path + filename)' )
-    parser.add_argument( 'outputImage', type=str, help='The output image (path + filename)' )
+    parser.add_argument( 'inputImage', type=str, help='The input image (path + filename), or a directory or glob of images for batch mode' )
+    parser.add_argument( 'outputImage', type=str, help='The output image (path + filename), or the output directory for batch mode' )
     parser.add_argument( '-l', dest='log', type=str, default='', help='Processing log for the output AIM file (text file).' )
+    parser.add_argument( '--vtkbone', action='store_true', help='Read and write AIM files with vtkbone instead of the NumPy AIM reader/writer.' )
+    parser.add_argument( '--to', dest='outExtension', type=str, default='mha', choices=['mha', 'aim'], help='Batch mode: the output file format (default: mha)' )
+    parser.add_argument( '-n', dest='workers', type=int, default=0, help='Batch mode: number of images to convert at once (default: number of cores)' )
+    parser.add_argument( '--force', action='store_true', help='Batch mode: convert all images again, even those that are up to date' )
+    parser.add_argument( '--catalogue', type=str, default='', help='Batch mode: add the images to this image catalogue (see aimCatalogue.py)' )
     args = parser.parse_args()
 
     inputImage = args.inputImage
     outputImage = args.outputImage
     AIMProcessingLog = args.log
 
-    fileConverter(inputImage, outputImage, AIMProcessingLog)
\ No newline at end of file
+    # A directory or glob of images is converted in batch mode
+    if os.path.isdir(inputImage) or glob.has_magic(inputImage) :
+        failed = fileConverterBatch(inputImage, outputImage, args.outExtension, args.workers, args.force, args.vtkbone, args.catalogue)
+        sys.exit(1 if failed else 0)
+
+    fileConverter(inputImage, outputImage, AIMProcessingLog, args.vtkbone)
\ No newline at end of file
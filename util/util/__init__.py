@@ -1,4 +1,13 @@
 # __init__.py
 from .searchAIMLog import searchAIMLog
 from .sitk_vtk import sitk2vtk
-from .sitk_vtk import vtk2sitk
\ No newline at end of file
+from .sitk_vtk import vtk2sitk
+from .aimIO import AIMFile
+from .aimIO import readAIM
+from .aimIO import writeAIM
+from .aimLog import parseAIMLog
+from .aimLog import readAIMLog
+from .imageNames import getBaseName
+from .imageNames import findImages
+from .imageNames import parseImageName
+from .imageNames import getPairID
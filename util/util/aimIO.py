@@ -0,0 +1,270 @@
+#-----------------------------------------------------
+# aimIO.py
+#
+# Created on:   18-10-2026
+#
+# Description: Reads and writes AIM version 020 files with NumPy, without vtkbone.
+#              The header is parsed when the file is opened, the processing log is
+#              only read when it is asked for, and uncompressed voxel data is memory
+#              mapped straight from the file. Binary compressed (D1TbinCmp) images,
+#              as written by IPL with -compress_type bin, are decompressed on read.
+#
+#              AIM v020 layout (little endian):
+#                   pre-header:     5 x int32 = pre-header size, image struct size,
+#                                   processing log size, image data size, assoc. data size
+#                   image struct:   version, proc_log, data, id, reference, type (int32),
+#                                   pos, dim, off, supdim, suppos, subdim, testoff (3 x int32),
+#                                   el_size_mm (3 x VMS F-float), assoc. data
+#                   processing log: text
+#                   image data:     x varies fastest, then y, then z
+#
+# Notes: The element size is stored as a VMS F-float. The two 16-bit words are swapped
+#        compared to an IEEE float and the value is 4 times larger.
+#        The image orientation is not stored in an AIM. The image origin is the
+#        position (pos) times the element size, as in vtkboneAIMReader.
+#-----------------------------------------------------
+import struct
+
+import numpy as np
+import SimpleITK as sitk
+
+AIM_PRE_HEADER_SIZE = 20
+AIM_IMAGE_STRUCT_SIZE = 140
+
+# AIM data types: (type code) -> NumPy type
+AIM_TYPE_CHAR = 0x00010001
+AIM_TYPE_SHORT = 0x00020002
+AIM_TYPE_INT = 0x00030004
+AIM_TYPE_FLOAT = 0x001a0004
+AIM_TYPE_BINCMP = 0x00150001
+
+AIM_DTYPES = {
+    AIM_TYPE_CHAR: np.dtype('<i1'),
+    AIM_TYPE_SHORT: np.dtype('<i2'),
+    AIM_TYPE_INT: np.dtype('<i4'),
+    AIM_TYPE_FLOAT: np.dtype('<f4')
+}
+
+# MetaImage element types for the streaming MHA writer
+MHA_ELEMENT_TYPES = {
+    np.dtype('int8'): 'MET_CHAR',
+    np.dtype('uint8'): 'MET_UCHAR',
+    np.dtype('int16'): 'MET_SHORT',
+    np.dtype('int32'): 'MET_INT',
+    np.dtype('float32'): 'MET_FLOAT'
+}
+
+
+def vmsToFloat(data):
+    # VMS F-float (4 bytes) to a Python float
+    swapped = data[2:4] + data[0:2]
+    return struct.unpack('<f', swapped)[0] / 4.0
+
+
+def floatToVMS(value):
+    # Python float to a VMS F-float (4 bytes)
+    data = struct.pack('<f', value * 4.0)
+    return data[2:4] + data[0:2]
+
+
+def decompressBin(data, numberOfVoxels):
+    # D1TbinCmp: int32 length, the two voxel values, then run lengths (uint8) that alternate
+    # between the two values. A run of 255 is followed by more of the same value.
+    length = struct.unpack('<i', data[:4])[0]
+    values = np.frombuffer(data[4:6], dtype=np.int8)
+    runs = np.frombuffer(data[6:length], dtype=np.uint8).astype(np.int64)
+
+    # The value only changes after a run shorter than 255
+    toggles = np.concatenate(( [0], np.cumsum(runs[:-1] != 255) ))
+    runValues = values[toggles % 2]
+
+    decompressed = np.repeat(runValues, runs)
+    if decompressed.size != numberOfVoxels :
+        raise ValueError('Compressed AIM data has {} voxels, expected {}'.format(decompressed.size, numberOfVoxels))
+
+    return decompressed
+
+
+def compressBin(array):
+    # The inverse of decompressBin for images with at most two values
+    flat = np.ascontiguousarray(array, dtype=np.int8).ravel()
+    values = np.unique(flat)
+    if values.size > 2 :
+        raise ValueError('Binary compression needs an image with at most two values, found {}'.format(values.size))
+    if values.size == 1 :
+        values = np.array([values[0], values[0]], dtype=np.int8)
+
+    # Start with the first voxel's value so that the first run is never empty
+    if flat[0] != values[0] :
+        values = values[::-1]
+
+    # Run lengths of equal values, then split runs longer than 254 into 255 + ... + remainder
+    changes = np.flatnonzero(np.diff(flat)) + 1
+    runLengths = np.diff(np.concatenate(( [0], changes, [flat.size] )))
+
+    runs = []
+    for runLength in runLengths :
+        runs.extend([255] * (runLength // 255))
+        runs.append(runLength % 255)
+
+    body = values.tobytes() + np.asarray(runs, dtype=np.uint8).tobytes()
+    return struct.pack('<i', 4 + len(body)) + body
+
+
+class AIMFile:
+    # An AIM file opened for reading. Only the header is read when the file is opened.
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+        with open(fileName, 'rb') as f :
+            preHeader = f.read(AIM_PRE_HEADER_SIZE)
+            if preHeader[:12] == b'AIMDATA_V030' :
+                raise ValueError('{} is an AIM v030 file, only AIM v020 is supported'.format(fileName))
+
+            self.preHeaderSize, self.imageStructSize, self.processingLogSize, self.imageDataSize, self.assocDataSize = struct.unpack('<5i', preHeader)
+            if self.preHeaderSize != AIM_PRE_HEADER_SIZE :
+                raise ValueError('{} is not an AIM v020 file'.format(fileName))
+
+            imageStruct = f.read(self.imageStructSize)
+
+        fields = struct.unpack('<6i21i', imageStruct[:108])
+        self.version = fields[0]
+        self.type = fields[5]
+        self.position = fields[6:9]
+        self.dimensions = fields[9:12]
+        self.offset = fields[12:15]
+        self.elementSize = tuple( vmsToFloat(imageStruct[108 + 4*i:112 + 4*i]) for i in range(3) )
+
+        self.processingLogStart = self.preHeaderSize + self.imageStructSize
+        self.imageDataStart = self.processingLogStart + self.processingLogSize
+        self._processingLog = None
+
+    @property
+    def processingLog(self):
+        if self._processingLog is None :
+            with open(self.fileName, 'rb') as f :
+                f.seek(self.processingLogStart)
+                self._processingLog = f.read(self.processingLogSize).rstrip(b'\0').decode('latin-1')
+        return self._processingLog
+
+    @property
+    def origin(self):
+        return tuple( self.position[i] * self.elementSize[i] for i in range(3) )
+
+    @property
+    def compressed(self):
+        return self.type == AIM_TYPE_BINCMP
+
+    @property
+    def dtype(self):
+        if self.compressed :
+            return np.dtype('<i1')
+        if self.type not in AIM_DTYPES :
+            raise ValueError('Unsupported AIM data type: {:#010x}'.format(self.type))
+        return AIM_DTYPES[self.type]
+
+    def getArray(self):
+        # Voxel data as a (z, y, x) array. Uncompressed data is memory mapped (read only, no copy).
+        shape = tuple(reversed(self.dimensions))
+        if not self.compressed :
+            return np.memmap(self.fileName, dtype=self.dtype, mode='r', offset=self.imageDataStart, shape=shape)
+
+        with open(self.fileName, 'rb') as f :
+            f.seek(self.imageDataStart)
+            data = f.read(self.imageDataSize)
+        return decompressBin(data, int(np.prod(shape))).reshape(shape)
+
+    def getImage(self, pixelType=None):
+        # Voxel data as a SimpleITK image with the AIM element size and position
+        array = self.getArray()
+        if pixelType is not None :
+            array = array.astype(pixelType, copy=False)
+
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(self.elementSize)
+        image.SetOrigin(self.origin)
+        return image
+
+    def writeMHA(self, fileName, pixelType=None):
+        # Stream the voxel data to an uncompressed MetaImage one slice at a time
+        array = self.getArray()
+        dtype = np.dtype(pixelType) if pixelType is not None else array.dtype
+        writeMHAHeader(fileName, self.dimensions, self.elementSize, self.origin, dtype)
+
+        with open(fileName, 'ab') as f :
+            for z in range(array.shape[0]) :
+                f.write( np.ascontiguousarray(array[z], dtype=dtype.newbyteorder('<')).tobytes() )
+
+
+def readAIM(fileName, pixelType=None):
+    return AIMFile(fileName).getImage(pixelType)
+
+
+def writeMHAHeader(fileName, dimensions, spacing, origin, dtype):
+    header = [
+        'ObjectType = Image',
+        'NDims = 3',
+        'BinaryData = True',
+        'BinaryDataByteOrderMSB = False',
+        'CompressedData = False',
+        'TransformMatrix = 1 0 0 0 1 0 0 0 1',
+        'Offset = ' + ' '.join(str(value) for value in origin),
+        'CenterOfRotation = 0 0 0',
+        'AnatomicalOrientation = RAI',
+        'ElementSpacing = ' + ' '.join(str(value) for value in spacing),
+        'DimSize = ' + ' '.join(str(value) for value in dimensions),
+        'ElementType = ' + MHA_ELEMENT_TYPES[np.dtype(dtype)],
+        'ElementDataFile = LOCAL'
+    ]
+    with open(fileName, 'w') as f :
+        f.write('\n'.join(header) + '\n')
+
+
+def writeAIM(fileName, image, processingLog, compress=False):
+    # Write a SimpleITK image (or a (z, y, x) NumPy array) as an AIM v020 file.
+    # char (int8) and short (int16) images are written as D1Tchar and D1Tshort.
+    # With compress=True, a char image with at most two values is written as D1TbinCmp.
+    if isinstance(image, sitk.Image) :
+        array = sitk.GetArrayViewFromImage(image)
+        spacing = image.GetSpacing()
+        position = [ int(round(image.GetOrigin()[i] / spacing[i])) for i in range(3) ]
+    else :
+        array = image
+        spacing = (1.0, 1.0, 1.0)
+        position = [0, 0, 0]
+
+    dtype = np.dtype(array.dtype).newbyteorder('<')
+    aimTypes = {np.dtype(value): key for key, value in AIM_DTYPES.items()}
+    if dtype not in aimTypes :
+        raise ValueError('Unsupported pixel type for AIM: {}'.format(array.dtype))
+
+    if compress :
+        if dtype != np.dtype('<i1') :
+            raise ValueError('Only char (int8) images can be binary compressed')
+        aimType = AIM_TYPE_BINCMP
+        imageData = compressBin(array)
+        imageDataSize = len(imageData)
+    else :
+        aimType = aimTypes[dtype]
+        imageData = None
+        imageDataSize = array.size * dtype.itemsize
+
+    dimensions = tuple(reversed(array.shape))
+    logData = processingLog.encode('latin-1')
+
+    imageStruct = struct.pack('<6i21i', 0, 0, 0, 0, 0, aimType,
+                              *position, *dimensions, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    imageStruct += b''.join( floatToVMS(value) for value in spacing )
+    imageStruct += b'\0' * (AIM_IMAGE_STRUCT_SIZE - len(imageStruct))
+
+    with open(fileName, 'wb') as f :
+        f.write( struct.pack('<5i', AIM_PRE_HEADER_SIZE, AIM_IMAGE_STRUCT_SIZE, len(logData), imageDataSize, 0) )
+        f.write(imageStruct)
+        f.write(logData)
+
+        if imageData is not None :
+            f.write(imageData)
+        else :
+            # One slice at a time so that no full size copy is made
+            for z in range(array.shape[0]) :
+                f.write( np.ascontiguousarray(array[z], dtype=dtype).tobytes() )
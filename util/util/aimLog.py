@@ -0,0 +1,90 @@
+#-----------------------------------------------------
+# aimLog.py
+#
+# Created on:   18-10-2026
+#
+# Description: Parses the processing log (header) of an AIM file into a dictionary.
+#              The log is read once and every "name    value" line is split into its
+#              field name and value. The fields in AIM_LOG_FIELDS (scanner, patient,
+#              mu scaling and density/HU calibration) are converted to numbers.
+#              The image type is 'seg' if the log has 'Segmented Objects', 'gray' if it
+#              has 'Linear Attenuation' and None otherwise (same as searchAIMLog).
+#
+# Notes: IPL appends to the log of every image it writes, so a field can appear more
+#        than once. The last value is kept, which describes the image itself.
+#-----------------------------------------------------
+import re
+
+# Processing log field -> (dictionary key, type)
+AIM_LOG_FIELDS = {
+    'Created by': ('created_by', str),
+    'Time': ('time', str),
+    'Original file': ('original_file', str),
+    'Patient Name': ('patient_name', str),
+    'Index Patient': ('index_patient', int),
+    'Index Measurement': ('index_measurement', int),
+    'Site': ('site', int),
+    'Scanner ID': ('scanner_id', int),
+    'Scanner type': ('scanner_type', int),
+    'Energy [V]': ('energy_V', float),
+    'Intensity [uA]': ('intensity_uA', float),
+    'Orig-ISQ-Dim-p': ('isq_dim_p', int),
+    'Orig-ISQ-Dim-um': ('isq_dim_um', int),
+    'Mu_Scaling': ('mu_scaling', float),
+    'Calibration': ('calibration', str),
+    'Density: unit': ('density_unit', str),
+    'Density: slope': ('density_slope', float),
+    'Density: intercept': ('density_intercept', float),
+    'HU: mu water': ('hu_mu_water', float),
+    'Parameter name': ('parameter_name', str)
+}
+
+# A field name, at least two spaces, then the value
+FIELD_PATTERN = re.compile(r'^(\S.*?)\s{2,}(\S.*?)\s*$')
+
+
+def isSegmentedLog(text):
+    # True for a segmented image, False for a grayscale image, None if the log does not say
+    if 'Segmented Objects' in text :
+        return True
+    elif 'Linear Attenuation' in text :
+        return False
+    return None
+
+
+def convertValue(value, valueType):
+    # Numbers are converted with the given type. Several numbers (e.g. dimensions) give a list.
+    if valueType is str :
+        return value
+    try :
+        numbers = [valueType(float(token)) for token in value.split()]
+    except ValueError :
+        return None
+    return numbers[0] if len(numbers) == 1 else numbers
+
+
+def parseAIMLog(text):
+    # Returns a dictionary with the AIM_LOG_FIELDS values, the image type and all raw fields
+    rawFields = {}
+    for line in text.splitlines() :
+        if line.startswith('!') :
+            continue
+        match = FIELD_PATTERN.match(line)
+        if match :
+            rawFields[match.group(1)] = match.group(2)
+
+    log = { key: None for key, _ in AIM_LOG_FIELDS.values() }
+    for field, (key, valueType) in AIM_LOG_FIELDS.items() :
+        if field in rawFields :
+            log[key] = convertValue(rawFields[field], valueType)
+
+    segmented = isSegmentedLog(text)
+    log['image_type'] = None if segmented is None else ( 'seg' if segmented else 'gray' )
+    log['fields'] = rawFields
+
+    return log
+
+
+def readAIMLog(logFileName):
+    with open(logFileName, encoding='latin-1') as f :
+        return parseAIMLog(f.read())
@@ -0,0 +1,77 @@
+#-----------------------------------------------------
+# imageNames.py
+#
+# Created on:   18-10-2026
+#
+# Description: File name helpers shared by the batch scripts (BHS_batch.py, BHS_longitudinal.py,
+#              fileConverter.py and aimCatalogue.py): the base name of an image without its
+#              extension and AIM version number, finding images in a directory or glob, and
+#              splitting BHS_<subject>_<visit>MO_<joint>[_<stack>][_SEG] names into their parts and
+#              the BHS_<subject>_<joint>[_<stack>] ID of the 03MO/12MO pair (or visits) of an image.
+#-----------------------------------------------------
+import os
+import glob
+
+# Extensions of the image files, longest first so that .nii.gz is not taken for .gz
+IMAGE_EXTENSIONS = ('.nii.gz', '.aim', '.mha', '.nii')
+
+
+def splitImageName(imagePath):
+    # (file name without the extension and AIM version number, extension in lower case)
+    # IMAGE.AIM;1 -> (IMAGE, .aim), IMAGE.nii.gz -> (IMAGE, .nii.gz)
+    filename = os.path.basename(imagePath).rsplit(';', 1)[0]
+    for extension in IMAGE_EXTENSIONS :
+        if filename.lower().endswith(extension) :
+            return filename[:-len(extension)], extension
+    basename, extension = os.path.splitext(filename)
+    return basename, extension.lower()
+
+
+def getBaseName(imagePath):
+    return splitImageName(imagePath)[0]
+
+
+def findImages(inputPath, extensions=('.aim', '.mha')):
+    # All images with one of the extensions in a directory, or all images matching a glob
+    if os.path.isdir(inputPath) :
+        imagePaths = [os.path.join(inputPath, filename) for filename in os.listdir(inputPath)]
+    else :
+        imagePaths = glob.glob(inputPath)
+    return sorted( imagePath for imagePath in imagePaths if os.path.isfile(imagePath) and splitImageName(imagePath)[1] in extensions )
+
+
+def parseImageName(imagePath, extensions=IMAGE_EXTENSIONS):
+    # Split BHS_<subject>_<visit>MO_<joint>[_<stack>][_SEG].ext into its parts
+    # Returns None if the file name does not follow the BHS naming convention
+    # or does not have one of the extensions
+    basename, extension = splitImageName(imagePath)
+    if extension not in extensions :
+        return None
+
+    tokens = basename.split('_')
+    if len(tokens) < 4 or tokens[0].upper() != 'BHS' :
+        return None
+
+    seg = tokens[-1].upper() == 'SEG'
+    if seg :
+        tokens = tokens[:-1]
+
+    visit = tokens[2].upper()
+    if len(tokens) < 4 or not visit.endswith('MO') or not visit[:-2].isdigit() :
+        return None
+
+    return {
+        'subject': tokens[1],
+        'visit': int(visit[:-2]),
+        'joint': tokens[3].upper(),
+        'stack': '_'.join(tokens[4:]).upper(),
+        'seg': seg
+    }
+
+
+def getPairID(info):
+    # BHS_<subject>_<joint>[_<stack>] from the parts of an image name (see parseImageName)
+    pairID = 'BHS_' + info['subject'] + '_' + info['joint']
+    if info['stack'] :
+        pairID += '_' + info['stack']
+    return pairID
@@ -1,16 +1,19 @@
-#----------------------------------------------------- 
+#-----------------------------------------------------
 # searchAIMLog.py
 #
 # Created by:   Michael Kuczynski
 # Created on:   14-05-2020
 #
-# Description: Searches the header log file of an AIM file 
-#              to determine if the file is a segmented image 
+# Modified on:          18-10-2026
+# Modification Notes:   -The log file is read once and closed. The search is done by
+#                        isSegmentedLog() in aimLog.py, which also parses the other log fields.
+#
+# Description: Searches the header log file of an AIM file
+#              to determine if the file is a segmented image
 #              or grayscale image.
 #-----------------------------------------------------
+from .aimLog import isSegmentedLog
 
 def searchAIMLog(log):
-    if 'Segmented Objects' in open(log).read() :
-        return True
-    elif 'Linear Attenuation' in open(log).read() :
-        return False
\ No newline at end of file
+    with open(log, encoding='latin-1') as f :
+        return isSegmentedLog(f.read())
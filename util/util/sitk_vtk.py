@@ -1,68 +1,93 @@
-#----------------------------------------------------- 
+#-----------------------------------------------------
 # sitk-2-vtk.py
 #
 # Created by:   Michael Kuczynski
 # Created on:   21-01-2020
 #
+# Modified on:          18-10-2026
+# Modification Notes:   -The pixel type, spacing, origin and direction are kept in both directions.
+#                       -sitk2vtk shares the SimpleITK image buffer instead of copying it. The image
+#                        is kept alive by the VTK array, so the buffer cannot be freed while in use.
+#                       -vtk2sitk makes exactly one copy (SimpleITK images cannot wrap outside memory).
+#                        The old version also swapped the x and z axes.
+#                       -VTK is imported when a conversion is done, so importing util (e.g. for the
+#                        NumPy AIM reader) does not need VTK.
+#
 # Description: Converts between SimpleITK and VTK image types
 #-----------------------------------------------------
-import vtk
-from vtk.util.numpy_support import vtk_to_numpy
-
 import SimpleITK as sitk
 
-def sitk2vtk(img):
+def sitk2vtk(img, outputScalarType=None):
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk
+
     size = list(img.GetSize())
     origin = list(img.GetOrigin())
     spacing = list(img.GetSpacing())
+    direction = list(img.GetDirection())
     ncomp = img.GetNumberOfComponentsPerPixel()
 
-    # Cconvert the SimpleITK image to a numpy array
-    rawData = sitk.GetArrayFromImage(img)
-
-    # Send the numpy array to VTK with a vtkImageImport object
-    dataImporter = vtk.vtkImageImport()
-    dataImporter.SetImportVoidPointer(rawData)
-    dataImporter.SetNumberOfScalarComponents(ncomp)
-
     # VTK expects 3-dimensional parameters
     if len(size) == 2:
         size.append(1)
-
-    if len(origin) == 2:
         origin.append(0.0)
-
-    if len(spacing) == 2:
         spacing.append(spacing[0])
+        direction = direction[0:2] + [0.0] + direction[2:4] + [0.0, 0.0, 0.0, 1.0]
 
-    # Set the new VTK image's parameters
-    # For some reason we need to set both the data and whole extent...?
-    # Output image orientation will be lost when converting to a VTK image
-    dataImporter.SetDataExtent(0, size[0]-1, 0, size[1]-1, 0, size[2]-1)
-    dataImporter.SetWholeExtent(0, size[0]-1, 0, size[1]-1, 0, size[2]-1)
-    dataImporter.SetDataOrigin(origin)
-    dataImporter.SetDataSpacing(spacing)
-    dataImporter.Update()
+    # Get a view of the SimpleITK image buffer (no copy). Both SimpleITK and VTK store x fastest.
+    rawData = sitk.GetArrayViewFromImage(img).reshape(-1, ncomp)
 
-    vtk_image = dataImporter.GetOutput()
+    # Share the buffer with a VTK array (deep=False). numpy_to_vtk keeps a reference to the
+    # NumPy view and we also keep a reference to the SimpleITK image, which owns the memory.
+    vtk_array = numpy_to_vtk(rawData, deep=False)
+    vtk_array._sitk_image = img
 
-    # Cast the image data to VTK_SHORT so we can read it with UCT_3D
-    caster = vtk.vtkImageCast()
-    caster.SetInputData(vtk_image)
-    caster.SetOutputScalarType(vtk.VTK_CHAR)
-    caster.ReleaseDataFlagOff()
-    caster.Update()
+    vtk_image = vtk.vtkImageData()
+    vtk_image.SetDimensions(size)
+    vtk_image.SetOrigin(origin)
+    vtk_image.SetSpacing(spacing)
 
-    return caster.GetOutput()
+    # Image directions were added in VTK 9
+    if hasattr(vtk_image, 'SetDirectionMatrix'):
+        vtk_image.SetDirectionMatrix(direction)
+
+    vtk_image.GetPointData().SetScalars(vtk_array)
+
+    # Only cast if a scalar type is asked for (e.g. VTK_CHAR or VTK_SHORT for UCT_3D)
+    # This makes a copy of the image
+    if outputScalarType is not None and outputScalarType != vtk_image.GetScalarType():
+        caster = vtk.vtkImageCast()
+        caster.SetInputData(vtk_image)
+        caster.SetOutputScalarType(outputScalarType)
+        caster.ReleaseDataFlagOff()
+        caster.Update()
+        vtk_image = caster.GetOutput()
+
+    return vtk_image
 
 
 def vtk2sitk(img):
+    from vtk.util.numpy_support import vtk_to_numpy
+
     vtk_data = img.GetPointData().GetScalars()
-    numpy_data = vtk_to_numpy(vtk_data)
+    ncomp = vtk_data.GetNumberOfComponents()
     dims = img.GetDimensions()
-    numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0])
-    numpy_data = numpy_data.transpose(2, 1, 0)
 
-    sitk_image = sitk.GetImageFromArray(numpy_data)
+    # View of the VTK buffer (no copy). VTK stores x fastest, so the NumPy order is (z, y, x).
+    numpy_data = vtk_to_numpy(vtk_data)
+    if ncomp == 1:
+        numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0])
+    else:
+        numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0], ncomp)
+
+    # This is the only copy
+    sitk_image = sitk.GetImageFromArray(numpy_data, isVector=(ncomp > 1))
+    sitk_image.SetOrigin(img.GetOrigin())
+    sitk_image.SetSpacing(img.GetSpacing())
+
+    # Image directions were added in VTK 9
+    if hasattr(img, 'GetDirectionMatrix'):
+        directionMatrix = img.GetDirectionMatrix()
+        sitk_image.SetDirection([directionMatrix.GetElement(i, j) for i in range(3) for j in range(3)])
 
-    return sitk_image
\ No newline at end of file
+    return sitk_image